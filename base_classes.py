@@ -1,6 +1,7 @@
 from abc import ABC, abstractmethod
-from typing import Any, List, NoReturn
+from typing import Any, Callable, Dict, Iterator, List, NoReturn, Optional, Union
 from numpy import ndarray
+import numpy
 import xml.etree.ElementTree as ElementTree
 
 
@@ -26,11 +27,58 @@ class Component(ABC):
         """
         pass
 
+    def gauges(self) -> Dict[str, Callable[[], Any]]:
+        """ Statistics the component keeps track of (e.g. dropped frames), to
+            be reported with the other metrics when they are enabled.
+
+            Returns a dictionary mapping each statistic's name to a function
+            that reads its current value. The functions are only called when
+            a metrics snapshot is taken, so they should not do any work in the
+            main loop.
+        """
+        return dict()
+
+    async def reconfigure(self, component_config_root: ElementTree.Element) -> bool:
+        """ Executed on the main event loop when the component's element in
+            config.xml changes while the program is running (see
+            ConfigurationManager.watch). Anything slow (e.g. rebuilding lookup
+            tables) should be done off the event loop and the results swapped
+            in at once, so frames keep flowing with the old configuration
+            until the new one is ready.
+
+            Arguments:
+            - component_config_root: The component's new configuration.
+
+            Returns True if the new configuration was applied. The default
+            returns False, meaning that the component only picks up the
+            changes after a restart.
+        """
+        return False
+
 
 class FrameGeneratorBase(Component):
     """ Frame generators retrieve frames from an arbitrary source. These are the
         first steps in the path and therefore have no inputs.
+
+        Generators that know when their frames were captured should update
+        the following attributes every time get_frame() returns:
+        - frame_sequence: A counter that increases by one for every frame
+          captured from the source, including frames that were dropped.
+        - frame_timestamp: The wall-clock time (time.time()) at which the
+          returned frame was captured.
+        - dropped_frames: The total number of captured frames that were
+          never returned by get_frame().
+
+        `camera` is the tag of the camera the generator reads from, set by
+        ConfigurationManager from the `camera` attribute of its
+        `FrameGenerator` tag. It is empty when there is only one camera and
+        no tag was given.
     """
+    frame_sequence = 0
+    frame_timestamp = 0.0
+    dropped_frames = 0
+    camera = str()
+
     @abstractmethod
     def get_frame(self) -> ndarray:
         """ Retrieve a single frame from the generator.
@@ -70,19 +118,154 @@ class FrameData:
             self.angle = -1 * ((68.5 / frame_width) * (self.x - midway))
 
 
+DETECTION_DTYPE = numpy.dtype([
+    ("rect", numpy.int32, (4,)),  # [x1, y1, x2, y2]
+    ("center", numpy.float32, (2,)),  # [x, y]
+    ("angle", numpy.float32),
+    ("area", numpy.float32),
+    ("score", numpy.float32),
+])
+
+
+class Detection:
+    """ A view of a single row of a Detections batch. Provides the same
+        attributes as FrameData (rect, x, y, angle) plus area and score.
+    """
+    __slots__ = ("_record",)
+
+    def __init__(self, record: numpy.void):
+        self._record = record
+
+    @property
+    def rect(self) -> ndarray:
+        return self._record["rect"]
+
+    @property
+    def x(self) -> float:
+        return float(self._record["center"][0])
+
+    @property
+    def y(self) -> float:
+        return float(self._record["center"][1])
+
+    @property
+    def angle(self) -> float:
+        return float(self._record["angle"])
+
+    @property
+    def area(self) -> float:
+        return float(self._record["area"])
+
+    @property
+    def score(self) -> float:
+        return float(self._record["score"])
+
+
+class Detections:
+    """ A batch of detected objects stored in a single numpy structured array
+        (see DETECTION_DTYPE), with one row per object.
+
+        Detections behaves like a list of FrameData objects: len(), iteration
+        and integer indexing work, and each item has rect, x, y and angle
+        attributes. Slicing returns another Detections that shares the same
+        memory. Whole columns are available through the `array` attribute,
+        e.g. `detections.array["angle"]`.
+
+        The main loop sets `frame_sequence`, `frame_timestamp` and `camera` to
+        the frame generator's values for the frame the objects were detected
+        in (see FrameGeneratorBase), so postprocessors can tell how old a
+        result is and which camera it came from.
+    """
+    __slots__ = ("array", "frame_width", "frame_sequence", "frame_timestamp", "camera")
+
+    def __init__(self, array: Optional[ndarray] = None, frame_width: int = 640, frame_sequence: int = 0,
+                 frame_timestamp: float = 0.0, camera: str = ""):
+        """ Arguments:
+            - array: A structured array with dtype DETECTION_DTYPE. Defaults
+              to an empty batch.
+            - frame_width: The width of the frames the objects were detected in.
+            - frame_sequence: The sequence number of that frame.
+            - frame_timestamp: The wall-clock time at which that frame was
+              captured.
+            - camera: The tag of the camera that captured that frame.
+        """
+        self.array = numpy.empty(0, DETECTION_DTYPE) if array is None else array
+        self.frame_width = frame_width
+        self.frame_sequence = frame_sequence
+        self.frame_timestamp = frame_timestamp
+        self.camera = camera
+
+    @classmethod
+    def from_rects(cls, rects: ndarray, frame_width: int = 640, horizontal_fov: float = 68.5,
+                   areas: Optional[ndarray] = None) -> "Detections":
+        """ Builds a batch from an (N, 4) array of rects in [x1, y1, x2, y2]
+            format.
+
+            Arguments:
+            - rects: The rects circumscribing each detected object.
+            - frame_width: The width of the frames the objects were detected in.
+            - horizontal_fov: The camera's horizontal field of view in degrees.
+            - areas: The area of each object. Defaults to the area of its rect.
+              Each object's score is its area divided by the area of its rect.
+        """
+        rects = numpy.asarray(rects).reshape(-1, 4)
+        array = numpy.empty(len(rects), DETECTION_DTYPE)
+        array["rect"] = rects
+        centers = array["center"]
+        centers[:, 0] = (rects[:, 0] + rects[:, 2]) / 2
+        centers[:, 1] = (rects[:, 1] + rects[:, 3]) / 2
+        array["angle"] = (horizontal_fov / frame_width) * (frame_width / 2 - centers[:, 0])
+        rect_areas = (rects[:, 2] - rects[:, 0]) * (rects[:, 3] - rects[:, 1])
+        array["area"] = rect_areas if areas is None else areas
+        array["score"] = array["area"] / numpy.maximum(rect_areas, 1)
+        return cls(array, frame_width)
+
+    def __len__(self) -> int:
+        return len(self.array)
+
+    def __iter__(self) -> Iterator[Detection]:
+        for record in self.array:
+            yield Detection(record)
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[Detection, "Detections"]:
+        if isinstance(index, slice):
+            return Detections(self.array[index], self.frame_width, self.frame_sequence, self.frame_timestamp,
+                              self.camera)
+        return Detection(self.array[index])
+
+    def to_bytes(self) -> memoryview:
+        """ Returns the raw contents of the batch (len(self) *
+            DETECTION_DTYPE.itemsize bytes, in native byte order) as a view of
+            its memory, without copying it unless the batch is a non-contiguous
+            slice. The view changes if the batch is modified; callers that need
+            to keep the contents should copy it (e.g. with bytes()).
+        """
+        return memoryview(numpy.ascontiguousarray(self.array).view(numpy.uint8))
+
+    @classmethod
+    def from_bytes(cls, buffer: Union[bytes, memoryview], frame_width: int = 640) -> "Detections":
+        """ Wraps the output of to_bytes() without copying it.
+        """
+        return cls(numpy.frombuffer(buffer, DETECTION_DTYPE), frame_width)
+
+
 class ProcessorBase(Component):
     """ Processors take in frames from a FrameGenerator and output zero
-        or more detected objects (FrameData).
+        or more detected objects (Detections, or a list of FrameData).
     """
     @abstractmethod
-    def process(self, frame: ndarray) -> List[FrameData]:
+    def process(self, frame: ndarray, camera: str = "") -> Union[Detections, List[FrameData]]:
         """ Process a single frame and retrieve the locations of objects.
 
             Arguments:
             - frame: The input image to process
+            - camera: The camera the frame came from (see
+              FrameGeneratorBase.camera). When several cameras share the
+              processor, state kept between frames should be kept for each
+              camera separately.
 
-            Returns a list of FrameData objects, each of which corresponds to
-            a detected object.
+            Returns a Detections batch (or a list of FrameData objects), where
+            each item corresponds to a detected object.
         """
         pass
 
@@ -96,7 +279,15 @@ class PostProcessorBase(Component):
         All Postprocessors run asynchronously for two reasons:
         1.) Postprocessors usually rely on blocking I/O operations
         2.) Postprocessors do not depend on data from other Postprocessors
+
+        Each postprocessor runs on a thread of its own (see
+        PostProcessorRunner), unless it sets `main_thread` to True, in which
+        case it runs on the main event loop. That is needed for libraries that
+        only work on the main thread (e.g. OpenCV's HighGUI windows on macOS
+        and some Qt builds), and such postprocessors must not block.
     """
+    main_thread = False
+
     @abstractmethod
     async def postprocess(self, data: List[Any], frame: ndarray) -> NoReturn:
         """ Perform any operation on the detected objects and video frame.
@@ -0,0 +1,268 @@
+from typing import Any, Callable, Dict, List, NoReturn
+import xml.etree.ElementTree as ElementTree
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+import numpy
+
+from base_classes import FrameGeneratorBase, ProcessorBase, PostProcessorBase
+from postprocessor_runner import PostProcessorFanOut
+import configuration_manager
+
+""" Benchmarks every component in isolation and the whole pipeline end to end
+    by replaying a recording, and reports FPS, per-stage latency percentiles and
+    peak memory use as JSON.
+
+    Usage: python3 benchmark.py [--config_file <path>] [--video <path>] [--warmup <n>] [--iterations <n>]
+                                [--set <component>.<Setting>=<value> ...] [--output <path>]
+                                [--baseline <path>] [--tolerance <fraction>]
+
+    Frames are read with the `video_file` frame generator (using `--video` as its
+    `FileName`). The processor and postprocessors are the ones named in the config
+    file. `--set` overrides a single component setting, e.g.
+    `--set contour.DownscaleFactor=2`, so different settings can be compared
+    without editing config.xml.
+"""
+
+
+def apply_override(config_root: ElementTree.Element, override: str) -> NoReturn:
+    key, value = override.split("=", 1)
+    component_name, setting = key.split(".", 1)
+    for element in config_root.find("ComponentData").findall("Component"):
+        if element.attrib.get("name") == component_name:
+            setting_element = element.find(setting)
+            if setting_element is None:
+                setting_element = ElementTree.SubElement(element, setting)
+            setting_element.text = value
+            return
+    raise ValueError("No configuration for component " + component_name)
+
+
+def summarize(latencies: List[float], wall_time: float, peak_rss_before: int) -> Dict[str, float]:
+    """ Turns a list of per-iteration latencies (in seconds) into a JSON-friendly summary in milliseconds.
+        `peak_rss_before` is the peak RSS before the stage started (see peak_rss_kb()).
+    """
+    milliseconds = numpy.array(latencies) * 1000
+    return {
+        "iterations": len(latencies),
+        "fps": len(latencies) / wall_time if wall_time > 0 else 0.0,
+        "mean_ms": float(milliseconds.mean()),
+        "p50_ms": float(numpy.percentile(milliseconds, 50)),
+        "p95_ms": float(numpy.percentile(milliseconds, 95)),
+        "p99_ms": float(numpy.percentile(milliseconds, 99)),
+        "max_ms": float(milliseconds.max()),
+        # the peak RSS is a lifetime high for the whole process, so each stage reports how far it raised it
+        "peak_rss_growth_kb": peak_rss_kb() - peak_rss_before,
+    }
+
+
+def peak_rss_kb() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes everywhere else
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def time_iterations(function: Callable[[int], Any], warmup: int, iterations: int) -> Dict[str, float]:
+    peak_rss_before = peak_rss_kb()
+    for i in range(warmup):
+        function(i)
+    latencies = []
+    start = time.perf_counter()
+    for i in range(iterations):
+        iteration_start = time.perf_counter()
+        function(warmup + i)
+        latencies.append(time.perf_counter() - iteration_start)
+    return summarize(latencies, time.perf_counter() - start, peak_rss_before)
+
+
+def allocation_summary(function: Callable[[int], Any], iterations: int) -> Dict[str, float]:
+    """ Measures how much memory each call allocates on top of what is already allocated, as seen by tracemalloc
+        (which includes numpy and OpenCV images). Calls are not timed, since tracing slows them down.
+    """
+    if not hasattr(tracemalloc, "reset_peak"):
+        return {}  # Python < 3.9
+    tracemalloc.start()
+    try:
+        peaks = []
+        for i in range(iterations):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            function(i)
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+    kilobytes = numpy.array(peaks) / 1024
+    return {
+        "alloc_peak_kb_mean": float(kilobytes.mean()),
+        "alloc_peak_kb_max": float(kilobytes.max()),
+    }
+
+
+async def time_iterations_async(function: Callable[[int], Any], warmup: int, iterations: int) -> Dict[str, float]:
+    peak_rss_before = peak_rss_kb()
+    for i in range(warmup):
+        await function(i)
+    latencies = []
+    start = time.perf_counter()
+    for i in range(iterations):
+        iteration_start = time.perf_counter()
+        await function(warmup + i)
+        latencies.append(time.perf_counter() - iteration_start)
+    return summarize(latencies, time.perf_counter() - start, peak_rss_before)
+
+
+class Benchmark:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.manager = configuration_manager.ConfigurationManager(args.config_file)
+        apply_override(self.manager.config_root, "video_file.FileName=" + args.video)
+        # loop the recording when it is shorter than the run
+        apply_override(self.manager.config_root, "video_file.Loop=true")
+        for override in args.set or []:
+            apply_override(self.manager.config_root, override)
+        self.total = args.warmup + args.iterations
+        self.frames = []  # type: List[numpy.ndarray]
+        self.results = dict()  # type: Dict[str, Any]
+
+    async def load_frame_generator(self) -> FrameGeneratorBase:
+        return await self.manager.load_component("frame_generators.video_file")
+
+    async def run_frame_generator(self) -> NoReturn:
+        frame_generator = await self.load_frame_generator()
+
+        def grab(_):
+            self.frames.append(frame_generator.get_frame())
+
+        self.results["frame_generator"] = time_iterations(grab, self.args.warmup, self.args.iterations)
+        await frame_generator.cleanup()
+
+    async def run_processor(self, processor: ProcessorBase) -> List[Any]:
+        outputs = []
+
+        def process(i):
+            outputs.append(processor.process(self.frames[i]))
+
+        self.results["processor"] = time_iterations(process, self.args.warmup, self.args.iterations)
+        self.results["processor"]["mean_detections"] = float(numpy.mean([len(i) for i in outputs]))
+        self.results["processor"].update(allocation_summary(lambda i: processor.process(self.frames[i]),
+                                                            min(self.args.iterations, 50)))
+        return outputs
+
+    async def run_postprocessors(self, postprocessors: Dict[str, PostProcessorBase], outputs: List[Any]) -> NoReturn:
+        for name, postprocessor in postprocessors.items():
+            async def postprocess(i):
+                await postprocessor.postprocess(outputs[i], self.frames[i])
+
+            self.results["postprocessor." + name] = await time_iterations_async(postprocess, self.args.warmup,
+                                                                                self.args.iterations)
+
+    async def run_end_to_end(self, processor: ProcessorBase, postprocessors: Dict[str, PostProcessorBase]) -> NoReturn:
+        frame_generator = await self.load_frame_generator()
+        fan_out = PostProcessorFanOut(list(postprocessors.values()), self.manager.load_postprocessor_deadlines())
+
+        async def iteration(_):
+            frame = frame_generator.get_frame()
+            await fan_out.postprocess(processor.process(frame), frame)
+
+        try:
+            self.results["end_to_end"] = await time_iterations_async(iteration, self.args.warmup,
+                                                                     self.args.iterations)
+        finally:
+            fan_out.stop()
+            await frame_generator.cleanup()
+
+    async def run(self) -> Dict[str, Any]:
+        processor_name = self.manager.config_root.find("Processor").text
+        postprocessor_names = [element.text for element in
+                               self.manager.config_root.find("PostProcessors").findall("PostProcessor")]
+
+        await self.run_frame_generator()
+        processor = await self.manager.load_component("processors." + processor_name)
+        postprocessors = dict()
+        for name in postprocessor_names:
+            postprocessors[name] = await self.manager.load_component("postprocessors." + name)
+        try:
+            outputs = await self.run_processor(processor)
+            await self.run_postprocessors(postprocessors, outputs)
+            await self.run_end_to_end(processor, postprocessors)
+        finally:
+            for component in [processor] + list(postprocessors.values()):
+                await component.cleanup()
+
+        return {
+            "video": self.args.video,
+            "config_file": self.args.config_file,
+            "overrides": self.args.set or [],
+            "warmup": self.args.warmup,
+            "environment": {
+                "python": platform.python_version(),
+                "numpy": numpy.__version__,
+                "opencv": __import__("cv2").__version__,
+                "machine": platform.machine(),
+                "cpu_count": os.cpu_count(),
+            },
+            "stages": self.results,
+            "peak_rss_kb": peak_rss_kb(),
+        }
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> bool:
+    """ Prints how every stage changed compared to a baseline run. Returns False if any stage's FPS dropped or p99
+        latency grew by more than `tolerance` (a fraction).
+    """
+    passed = True
+    print("{:<32} {:>10} {:>10} {:>8} {:>10} {:>10} {:>8}".format(
+        "stage", "fps", "base fps", "change", "p99 ms", "base p99", "change"))
+    for stage, current in results["stages"].items():
+        if stage not in baseline["stages"]:
+            continue
+        previous = baseline["stages"][stage]
+        fps_change = current["fps"] / previous["fps"] - 1 if previous["fps"] else 0.0
+        p99_change = current["p99_ms"] / previous["p99_ms"] - 1 if previous["p99_ms"] else 0.0
+        regressed = fps_change < -tolerance or p99_change > tolerance
+        passed = passed and not regressed
+        print("{:<32} {:>10.1f} {:>10.1f} {:>+7.1%} {:>10.2f} {:>10.2f} {:>+7.1%}{}".format(
+            stage, current["fps"], previous["fps"], fps_change, current["p99_ms"], previous["p99_ms"], p99_change,
+            "  REGRESSION" if regressed else ""))
+    return passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config_file", help="use the specified config file", type=str, default="config.xml")
+    parser.add_argument("--video", help="the recording to replay", type=str, default="test_files/test_video.mp4")
+    parser.add_argument("--warmup", help="untimed iterations before measuring", type=int, default=20)
+    parser.add_argument("--iterations", help="timed iterations per stage", type=int, default=200)
+    parser.add_argument("--set", help="override a component setting (<component>.<Setting>=<value>)",
+                        type=str, action="append")
+    parser.add_argument("--output", help="write the results to this JSON file", type=str)
+    parser.add_argument("--baseline", help="compare the results against this JSON file", type=str)
+    parser.add_argument("--tolerance", help="allowed FPS/p99 regression against the baseline", type=float,
+                        default=0.05)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    results = loop.run_until_complete(Benchmark(args).run())
+    loop.close()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            if not compare(results, json.load(baseline_file), args.tolerance):
+                sys.exit(1)
@@ -1,9 +1,17 @@
 from base_classes import Component
-from typing import Dict, Union, List, NoReturn
+from pipeline import PipelineSettings
+from metrics import MetricsSettings
+from governor import GovernorSettings
+from typing import Dict, Union, List, NoReturn, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
 import xml.etree.ElementTree as ElementTree
+import asyncio
+import copy
 import importlib
 import inspect
 import logging
+import time
+import os
 
 
 class ComponentLoadError(Exception):
@@ -23,35 +31,142 @@ class ComponentConfigureError(Exception):
 
 class ConfigurationManager:
     def __init__(self, config_file_name: str):
+        self.config_file_name = config_file_name
         self.config_tree = ElementTree.parse(config_file_name)
         self.config_root = self.config_tree.getroot()
+        # the loaded components by name, as used in the `name` attribute of their `Component` tag
+        self.components = dict()  # type: Dict[str, Component]
+        # settings applied on top of a component's `Component` tag (e.g. by the latency governor), by component name
+        self.overrides = dict()  # type: Dict[str, Dict[str, str]]
+        # reconfigurations (reloads and overrides) run one at a time, so the last one always has the newest settings
+        self._reconfigure_lock = None  # type: Optional[asyncio.Lock]
+        # imports run off the event loop, but one at a time: some extension modules (e.g. cv2) aren't safe to import
+        # from several threads at once
+        self._import_executor = ThreadPoolExecutor(1, thread_name_prefix="import")
 
-    async def load_all_components(self) -> Dict[str, Union[Component, List[Component]]]:
-        out = dict()
+    def load_pipeline_settings(self) -> PipelineSettings:
+        return PipelineSettings(self.config_root.find("Pipeline"))
 
-        frame_generator_module_name = self.config_root.find("FrameGenerator").text
-        out["FRAME_GENERATOR"] = await self.load_component("frame_generators." + frame_generator_module_name)
+    def load_metrics_settings(self) -> MetricsSettings:
+        return MetricsSettings(self.config_root.find("Metrics"))
 
-        processor_module_name = self.config_root.find("Processor").text
-        out["PROCESSOR"] = await self.load_component("processors." + processor_module_name)
+    def load_governor_settings(self) -> GovernorSettings:
+        return GovernorSettings(self.config_root.find("Governor"))
 
+    def load_postprocessor_deadlines(self) -> List[Optional[float]]:
+        """ Returns the deadline of every postprocessor in the order they are
+            listed, taken from its `deadline` attribute or else from the
+            `PostProcessorDeadline` tag. None means no deadline.
+        """
+        default_deadline = self.config_root.findtext("PostProcessorDeadline")
+        deadlines = list()
+        for element in self.config_tree.find("PostProcessors").findall("PostProcessor"):
+            deadline = element.attrib.get("deadline", default_deadline)
+            deadlines.append(float(deadline) if deadline else None)
+        return deadlines
+
+    def load_reload_interval(self) -> float:
+        """ Returns the number of seconds between checks of the config file for
+            changes, taken from the `ReloadInterval` tag. 0 (the default)
+            means the file isn't watched.
+        """
+        return float(self.config_root.findtext("ReloadInterval", "0"))
+
+    async def load_all_components(self) -> Dict[str, Union[Component, List[Component]]]:
+        """ Imports and sets up every component at the same time. Imports run
+            on a worker thread, so they overlap with the setup of components
+            that are already imported. If any component fails to load, the
+            ones that did load are cleaned up and the first error is raised.
+
+            Returns the frame generators (one per camera) under
+            FRAME_GENERATORS, the processor under PROCESSOR and the
+            postprocessors under POSTPROCESSORS.
+        """
+        start = time.monotonic()
+        frame_generators = self.load_frame_generator_names()
+        processor_module_name = self.config_root.find("Processor").text
         postprocessor_root = self.config_tree.find("PostProcessors")
         postprocessor_module_names = [element.text for element in postprocessor_root.findall("PostProcessor")]
-        out["POSTPROCESSORS"] = list()
-        for name in postprocessor_module_names:
-            out["POSTPROCESSORS"].append(await self.load_component("postprocessors." + name))
 
+        components = await asyncio.gather(
+            *[self.load_component("frame_generators." + module_name, config_name)
+              for module_name, config_name, _ in frame_generators],
+            self.load_component("processors." + processor_module_name),
+            *[self.load_component("postprocessors." + name) for name in postprocessor_module_names],
+            return_exceptions=True
+        )
+        failures = [component for component in components if isinstance(component, BaseException)]
+        if len(failures) > 0:
+            # the components that did load may already hold resources (threads, sockets, worker processes)
+            for component in components:
+                if isinstance(component, BaseException):
+                    continue
+                logging.debug("Cleaning up component " + type(component).__name__)
+                try:
+                    await component.cleanup()
+                except Exception as e:
+                    logging.error("Failed to clean up {}: {}".format(type(component).__name__, e))
+            raise failures[0]
+        logging.info("Loaded all components in {:.2f}s".format(time.monotonic() - start))
+
+        for generator, (_, _, camera) in zip(components, frame_generators):
+            generator.camera = camera
+        out = dict()
+        out["FRAME_GENERATORS"] = list(components[:len(frame_generators)])
+        out["PROCESSOR"] = components[len(frame_generators)]
+        out["POSTPROCESSORS"] = list(components[len(frame_generators) + 1:])
         return out
 
-    async def load_component(self, module_name: str) -> Component:
+    def load_frame_generator_names(self) -> List[Tuple[str, str, str]]:
+        """ Returns the module name, configuration name and camera tag of every
+            `FrameGenerator` tag, in the order they are listed. The
+            configuration name is taken from the `config` attribute and
+            defaults to the module name. The camera tag is taken from the
+            `camera` attribute and defaults to the configuration name, or to
+            an empty string if there is only one frame generator.
+        """
+        elements = self.config_root.findall("FrameGenerator")
+        if len(elements) == 0:
+            raise ComponentConfigureError("No FrameGenerator given")
+        frame_generators = list()
+        for element in elements:
+            module_name = element.text.strip()
+            config_name = element.attrib.get("config", module_name)
+            camera = element.attrib.get("camera", config_name if len(elements) > 1 else "")
+            frame_generators.append((module_name, config_name, camera))
+
+        for index, name in ((1, "configuration"), (2, "camera")):
+            values = [frame_generator[index] for frame_generator in frame_generators]
+            for value in set(values):
+                if values.count(value) > 1:
+                    raise ValueError("More than one FrameGenerator uses the {} {}".format(name, value))
+        return frame_generators
+
+    async def load_component(self, module_name: str, config_name: Optional[str] = None) -> Component:
+        """ Imports a component's module and sets it up.
+
+            Arguments:
+            - module_name: The full name of the module, e.g.
+              `frame_generators.webcam`.
+            - config_name: The `name` attribute of the component's `Component`
+              tag. Defaults to the last part of the module name.
+        """
+        start = time.monotonic()
+        if config_name is None:
+            config_name = module_name.split(".")[1]
         try:
-            module = importlib.import_module(module_name)
+            module = await asyncio.get_event_loop().run_in_executor(self._import_executor, importlib.import_module,
+                                                                    module_name)
         except ImportError:
             raise ComponentLoadError(module_name)  # ImportError
+        imported = time.monotonic()
         for name, obj in inspect.getmembers(module):
-            if inspect.isclass(obj) and inspect.getmro(obj)[2] == Component:
+            if inspect.isclass(obj) and len(inspect.getmro(obj)) > 2 and inspect.getmro(obj)[2] == Component:
                 component = obj()
-                await self.setup_component(component, module_name.split(".")[1])
+                await self.setup_component(component, config_name)
+                self.components[config_name] = component
+                logging.info("Loaded {} in {:.2f}s (import {:.2f}s, setup {:.2f}s)".format(
+                    config_name, time.monotonic() - start, imported - start, time.monotonic() - imported))
                 return component
         # no components found in file
         raise ComponentLoadError("No component class found in " + module_name)
@@ -65,3 +180,96 @@ class ConfigurationManager:
                 return
         # no configuration found
         raise ComponentConfigureError("Missing configuration for " + obj.__class__.__name__)
+
+    async def watch(self, interval: float) -> NoReturn:
+        """ Checks the config file for changes every `interval` seconds, and
+            passes every loaded component whose `Component` tag changed its new
+            configuration (see Component.reconfigure), with its overrides
+            applied. Other changes (e.g. to which components are used) only
+            take effect after a restart.
+        """
+        last_modified = os.stat(self.config_file_name).st_mtime
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                modified = os.stat(self.config_file_name).st_mtime
+            except OSError as e:
+                logging.warning("Can't check {} for changes: {}".format(self.config_file_name, e))
+                continue
+            if modified == last_modified:
+                continue
+            last_modified = modified
+            await self.reload()
+
+    async def reload(self) -> NoReturn:
+        """ Re-reads the config file and reconfigures the loaded components
+            whose `Component` tag changed. Their overrides (see
+            set_overrides()) are kept.
+        """
+        try:
+            config_tree = ElementTree.parse(self.config_file_name)
+        except ElementTree.ParseError as e:
+            # e.g. the file is being written by an editor; the next change is picked up as usual
+            logging.error("Not reloading {}: {}".format(self.config_file_name, e))
+            return
+
+        async with self._reconfiguring():
+            old_elements = self._component_elements(self.config_root)
+            new_elements = self._component_elements(config_tree.getroot())
+            self.config_tree = config_tree
+            self.config_root = config_tree.getroot()
+            for name, component in self.components.items():
+                element = new_elements.get(name)
+                if element is None or name not in old_elements or \
+                        ElementTree.tostring(element) == ElementTree.tostring(old_elements[name]):
+                    continue
+                start = time.monotonic()
+                try:
+                    applied = await component.reconfigure(self.component_element(name))
+                except Exception as e:
+                    logging.error("Failed to reconfigure component {}: {}".format(name, e))
+                    continue
+                if applied:
+                    logging.info("Reconfigured component {} in {:.2f}s".format(name, time.monotonic() - start))
+                else:
+                    logging.warning("Component {} changed, but only picks up changes after a restart".format(name))
+
+    async def set_overrides(self, name: str, settings: Dict[str, str]) -> bool:
+        """ Replaces the settings that override the `Component` tag of the
+            component with the given name (an empty dict removes them), and
+            reconfigures the component with them. Returns the result of
+            Component.reconfigure. The overrides stay in place when the config
+            file is reloaded.
+        """
+        async with self._reconfiguring():
+            if settings:
+                self.overrides[name] = dict(settings)
+            else:
+                self.overrides.pop(name, None)
+            return await self.components[name].reconfigure(self.component_element(name))
+
+    def component_element(self, name: str) -> Optional[ElementTree.Element]:
+        """ Returns the current configuration of the component with the given
+            name, with its overrides applied, or None if there is none.
+        """
+        element = self._component_elements(self.config_root).get(name)
+        if element is None or not self.overrides.get(name):
+            return element
+        element = copy.deepcopy(element)
+        for setting, value in self.overrides[name].items():
+            setting_element = element.find(setting)
+            if setting_element is None:
+                setting_element = ElementTree.SubElement(element, setting)
+            setting_element.text = value
+        return element
+
+    def _reconfiguring(self) -> asyncio.Lock:
+        # created on first use, so it belongs to the event loop the components run on
+        if self._reconfigure_lock is None:
+            self._reconfigure_lock = asyncio.Lock()
+        return self._reconfigure_lock
+
+    @staticmethod
+    def _component_elements(config_root: ElementTree.Element) -> Dict[str, ElementTree.Element]:
+        return {element.attrib.get("name"): element
+                for element in config_root.find("ComponentData").findall("Component")}
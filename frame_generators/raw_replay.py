@@ -0,0 +1,84 @@
+from numpy import ndarray
+import xml.etree.ElementTree as ElementTree
+import logging
+import glob
+import time
+import os
+
+from base_classes import FrameGeneratorBase, Detections
+from raw_capture import RawCaptureReader
+
+
+class RawReplayFrameGenerator(FrameGeneratorBase):
+    """
+    Replays a capture written by the `raw_record` postprocessor. Frames are read-only views of the memory-mapped
+    capture, so nothing is decoded or copied, and every replay of a capture produces exactly the same frames.
+
+    Configuration info:
+
+    - `FileName`: The path to the capture to replay. If there is no such file, the newest capture that the
+    `raw_record` postprocessor wrote for that name (with the time it started recording added to it) is replayed, so
+    both can be given the same `FileName`.
+
+    - `RealTime` (optional, default false): If set to true, frames are returned with the same timing they were
+    recorded with. Otherwise they are returned as fast as they are requested.
+
+    - `Loop` (optional, default false): If set to true, the capture restarts from the first frame after the last one.
+    """
+    file_name = str()
+    real_time = bool()
+    loop = bool()
+    reader = None  # type: RawCaptureReader
+
+    position = 0
+    _replay_start = 0.0
+    _recording_start = 0.0
+
+    async def setup(self, component_config_root: ElementTree.Element):
+        self.file_name = self.find_capture(component_config_root.find("FileName").text)
+        self.real_time = component_config_root.findtext("RealTime", "false") in ['true', '1', 't', 'y', 'yes']
+        self.loop = component_config_root.findtext("Loop", "false") in ['true', '1', 't', 'y', 'yes']
+        self.reader = RawCaptureReader(self.file_name)
+
+    async def cleanup(self):
+        pass
+
+    @staticmethod
+    def find_capture(file_name: str) -> str:
+        """ Returns `file_name` if it exists, or else the newest timestamped capture recorded for it (e.g.
+        `recordings/capture_20190315-141502.raw` for `recordings/capture.raw`) if there is one.
+        """
+        if os.path.exists(file_name):
+            return file_name
+        stem, extension = os.path.splitext(file_name)
+        # timestamps are written as %Y%m%d-%H%M%S, so the newest capture sorts last
+        captures = sorted(glob.glob(glob.escape(stem) + "_" + "[0-9]" * 8 + "-" + "[0-9]" * 6 + glob.escape(extension)))
+        if len(captures) == 0:
+            return file_name
+        logging.info("Replaying {}, the newest capture for {}".format(captures[-1], file_name))
+        return captures[-1]
+
+    def get_frame(self) -> ndarray:
+        if self.position >= len(self.reader):
+            if not self.loop or len(self.reader) == 0:
+                raise FrameGeneratorBase.FrameException()
+            self.position = 0
+        if self.real_time:
+            timestamp = float(self.reader.index[self.position]["timestamp"])
+            if self.position == 0:
+                self._replay_start = time.monotonic()
+                self._recording_start = timestamp
+            delay = self._replay_start + (timestamp - self._recording_start) - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        frame = self.reader.frame(self.position)
+        self.position += 1
+        self.frame_sequence += 1
+        self.frame_timestamp = time.time()
+        return frame
+
+    def recorded_detections(self) -> Detections:
+        """ The detections recorded with the frame get_frame() returned last.
+        """
+        return self.reader.recorded_detections(self.position - 1)
@@ -1,51 +1,185 @@
+from typing import NoReturn
 from numpy import ndarray
-import cv2
 import xml.etree.ElementTree as ElementTree
+import threading
+import logging
+import queue
+import time
 
 from base_classes import FrameGeneratorBase
 
+# imported in setup(), so that importing this module doesn't load OpenCV
+cv2 = None
+
 
 class VideoFileFrameGenerator(FrameGeneratorBase):
     """
     Grabs frames from a video file.
-    
+
+    A background thread decodes (and resizes) frames ahead of time into a bounded queue, so `get_frame()` usually
+    returns immediately and replay speed is limited only by the decoder.
+
     Configuration info:
-    
+
     - `FileName`: The path to the video file to read.
-    
+
     - `ForceOutputSize`: If set to true, frames are resized to the size specified by `ForceOutputWidth` and
     `ForceOutputHeight`.
-    
+
     - `ForceOutputWidth`: If `ForceOutputSize` is set to true, frames are resized to this width.
-    
+
     - `ForceOutputHeight`: If `ForceOutputHeight` is set to true, frames are resized to this height.
+
+    - `QueueSize` (optional, default 8): The number of decoded frames kept ready ahead of time.
+
+    - `StartFrame` (optional, default 0): The index of the first frame to read.
+
+    - `EndFrame` (optional): The index of the frame to stop before. Defaults to the end of the file.
+
+    - `Stride` (optional, default 1): Only every this many frames is returned; the frames in between are skipped
+    without being decoded.
+
+    - `Loop` (optional, default false): If set to true, the video restarts from `StartFrame` after reaching the end,
+    so it can be replayed indefinitely.
+
+    - `RealTime` (optional, default false): If set to true, frames are returned no faster than the file's native frame
+    rate, like a webcam. Frames that are already late when the next one is due are skipped and counted in
+    `dropped_frames`.
     """
-    
+
     file_name = str()
     force_output_size = bool()
     forced_output_width = int()
     forced_output_height = int()
+    queue_size = int()
+    start_frame = int()
+    end_frame = None
+    stride = int()
+    loop = bool()
+    real_time = bool()
     cap = None
-    
+    fps = float()
+
+    _frames = None  # type: queue.Queue
+    _decode_thread = None
+    _running = False
+    _finished = False
+    _pacing_start = 0.0
+    _returned_frames = 0
+
     async def setup(self, component_config_root: ElementTree.Element):
+        # imported here so that the import is only paid for when this frame generator is configured
+        global cv2
+        import cv2
         self.file_name = component_config_root.find("FileName").text
         self.force_output_size = component_config_root.find("ForceOutputSize").text in \
             ['true', '1', 't', 'y', 'yes']
         if self.force_output_size:
             self.forced_output_width = int(component_config_root.find("ForcedOutputWidth").text)
             self.forced_output_height = int(component_config_root.find("ForcedOutputHeight").text)
-        
+        self.queue_size = int(component_config_root.findtext("QueueSize", "8"))
+        self.start_frame = int(component_config_root.findtext("StartFrame", "0"))
+        end_frame = component_config_root.findtext("EndFrame")
+        self.end_frame = int(end_frame) if end_frame else None
+        self.stride = int(component_config_root.findtext("Stride", "1"))
+        if self.stride < 1:
+            raise ValueError("Stride must be at least 1")
+        self.loop = component_config_root.findtext("Loop", "false") in ['true', '1', 't', 'y', 'yes']
+        self.real_time = component_config_root.findtext("RealTime", "false") in ['true', '1', 't', 'y', 'yes']
+
         self.cap = cv2.VideoCapture(self.file_name)
-    
+        if not self.cap.isOpened():
+            raise FrameGeneratorBase.FrameException("Could not open " + self.file_name)
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS) or 30.0
+
+        self._frames = queue.Queue(self.queue_size)
+        self._running = True
+        self._decode_thread = threading.Thread(target=self._decode_loop, name="video-decode", daemon=True)
+        self._decode_thread.start()
+
     async def cleanup(self):
+        self._running = False
+        # unblock the decode thread if it is waiting for room in the queue
+        while self._decode_thread.is_alive():
+            try:
+                self._frames.get_nowait()
+            except queue.Empty:
+                pass
+            self._decode_thread.join(0.05)
+        # the decode thread stopped without ending the stream, so wake up a get_frame() call (e.g. on a pipeline's
+        # capture thread) that is still waiting for a frame
+        try:
+            self._frames.put_nowait(None)
+        except queue.Full:
+            pass
         self.cap.release()
-    
+
     def get_frame(self) -> ndarray:
-        rval, frame = self.cap.read()
-        if not rval:
+        frame = self._next_frame()
+        if self.real_time:
+            if self._returned_frames == 0:
+                self._pacing_start = time.monotonic()
+            frame_interval = self.stride / self.fps
+            while True:
+                late = time.monotonic() - (self._pacing_start + self._returned_frames * frame_interval)
+                if late < frame_interval:
+                    break
+                # the next frame is already due, so skip this one the way a webcam overwrites frames nobody read
+                self._returned_frames += 1
+                self.frame_sequence += 1
+                self.dropped_frames += 1
+                frame = self._next_frame()
+            if late < 0:
+                time.sleep(-late)
+
+        self._returned_frames += 1
+        self.frame_sequence += 1
+        self.frame_timestamp = time.time()
+        return frame
+
+    def _next_frame(self) -> ndarray:
+        if self._finished:
+            raise FrameGeneratorBase.FrameException()
+        frame = self._frames.get()
+        if frame is None:
+            self._finished = True
             raise FrameGeneratorBase.FrameException()
-        
-        if self.force_output_size:
-            frame = cv2.resize(frame, (self.forced_output_width, self.forced_output_height))
-        
         return frame
+
+    def _decode_loop(self) -> NoReturn:
+        end_frame = self.end_frame
+        if end_frame is None:
+            end_frame = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT)) or None
+        try:
+            while self._running:
+                self.cap.set(cv2.CAP_PROP_POS_FRAMES, self.start_frame)
+                index = self.start_frame
+                decoded_frames = 0
+                while self._running and (end_frame is None or index < end_frame):
+                    if (index - self.start_frame) % self.stride != 0:
+                        # grab() skips a frame without decoding it
+                        if not self.cap.grab():
+                            break
+                        index += 1
+                        continue
+                    rval, frame = self.cap.read()
+                    if not rval:
+                        break
+                    index += 1
+                    decoded_frames += 1
+                    if self.force_output_size:
+                        frame = cv2.resize(frame, (self.forced_output_width, self.forced_output_height))
+                    self._put(frame)
+                if not self.loop or decoded_frames == 0:
+                    break
+        except Exception as e:
+            logging.error("Failed to decode {}: {}".format(self.file_name, e))
+        self._put(None)
+
+    def _put(self, frame: ndarray) -> NoReturn:
+        while self._running:
+            try:
+                self._frames.put(frame, timeout=0.1)
+                return
+            except queue.Full:
+                pass
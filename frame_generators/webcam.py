@@ -1,9 +1,14 @@
 from numpy import ndarray
-import cv2
 import xml.etree.ElementTree as ElementTree
+import threading
+import logging
+import time
 
 from base_classes import FrameGeneratorBase
 
+# imported in setup(), so that importing this module doesn't load OpenCV
+cv2 = None
+
 
 class WebcamFrameGenerator(FrameGeneratorBase):
     """
@@ -18,30 +23,94 @@ class WebcamFrameGenerator(FrameGeneratorBase):
     - `Height`: The desired height of each frame.
     
     - `FPS`: The desired framerate to retrieve frames at.
+    
+    - `ThreadedCapture` (optional, default false): If set to true, a background thread reads frames from the camera
+    as fast as the camera produces them and keeps only the newest one. `get_frame()` then returns the newest frame
+    without waiting on the camera driver, unless that frame has already been returned. Frames that are overwritten
+    before they are returned are counted in `dropped_frames`, so processing always works on a frame that is at most
+    one frame old.
     """
     camera_id = int()
     width = int()
     height = int()
     fps = int()
+    threaded_capture = bool()
     cap = None
     
+    _capture_thread = None
+    _frame_condition = None
+    _running = False
+    _capture_failed = False
+    _latest_frame = None
+    _latest_sequence = 0
+    _latest_timestamp = 0.0
+    
     async def setup(self, component_config_root: ElementTree.Element):
+        # imported here so that the import is only paid for when this frame generator is configured
+        global cv2
+        import cv2
         self.camera_id = int(component_config_root.find("CameraID").text)
         self.width = int(component_config_root.find("Width").text)
         self.height = int(component_config_root.find("Height").text)
         self.fps = int(component_config_root.find("FPS").text)
+        self.threaded_capture = component_config_root.findtext("ThreadedCapture", "false") in \
+            ['true', '1', 't', 'y', 'yes']
         
         self.cap = cv2.VideoCapture(self.camera_id)
         self.cap.set(3, self.width)
         self.cap.set(4, self.height)
         self.cap.set(5, self.fps)
+        
+        if self.threaded_capture:
+            self._frame_condition = threading.Condition()
+            self._running = True
+            self._capture_thread = threading.Thread(target=self._capture_loop, name="webcam-capture", daemon=True)
+            self._capture_thread.start()
     
     async def cleanup(self):
+        if self._capture_thread is not None:
+            self._running = False
+            self._capture_thread.join(1)
+            with self._frame_condition:
+                # wake up a get_frame() call (e.g. on a pipeline's capture thread) that is waiting for a frame that
+                # will never come
+                self._capture_failed = True
+                self._frame_condition.notify_all()
+            logging.info("Webcam capture dropped {} of {} frames".format(self.dropped_frames, self._latest_sequence))
         self.cap.release()
     
     def get_frame(self) -> ndarray:
-        rval, frame = self.cap.read()
-        if not rval:
-            raise FrameGeneratorBase.FrameException()
+        if not self.threaded_capture:
+            rval, frame = self.cap.read()
+            if not rval:
+                raise FrameGeneratorBase.FrameException()
+            
+            self.frame_sequence += 1
+            self.frame_timestamp = time.time()
+            return frame
         
-        return frame
+        with self._frame_condition:
+            # only wait when the newest frame has already been handed out
+            while self._latest_sequence == self.frame_sequence and not self._capture_failed:
+                self._frame_condition.wait()
+            if self._latest_sequence == self.frame_sequence:
+                raise FrameGeneratorBase.FrameException()
+            
+            self.dropped_frames += self._latest_sequence - self.frame_sequence - 1
+            self.frame_sequence = self._latest_sequence
+            self.frame_timestamp = self._latest_timestamp
+            return self._latest_frame
+    
+    def _capture_loop(self):
+        while self._running:
+            rval, frame = self.cap.read()
+            timestamp = time.time()
+            with self._frame_condition:
+                if not rval:
+                    self._capture_failed = True
+                    self._frame_condition.notify_all()
+                    return
+                self._latest_frame = frame
+                self._latest_sequence += 1
+                self._latest_timestamp = timestamp
+                self._frame_condition.notify_all()
@@ -0,0 +1,180 @@
+from typing import Dict, NoReturn, Optional, Set, TYPE_CHECKING
+import xml.etree.ElementTree as ElementTree
+import asyncio
+import logging
+import numpy
+
+from metrics import LatencyHistogram, Metrics
+from postprocessor_runner import PostProcessorFanOut
+
+if TYPE_CHECKING:
+    # configuration_manager imports this module for GovernorSettings
+    from configuration_manager import ConfigurationManager
+
+
+class GovernorLevel:
+    """ One degradation level, read from a `Level` tag inside the `Governor` tag.
+
+        Configuration info (every tag is optional and may be repeated where noted):
+
+        - `SkipFrames`: The number of captured frames skipped (neither processed nor postprocessed) after every frame
+          that is used. Defaults to 0.
+
+        - `Set` (repeatable): A component setting to override while this level is active, written as
+          `<component>.<Setting>=<value>`, e.g. `contour.DownscaleFactor=2`. The component must support
+          reconfiguring while running (see Component.reconfigure). Settings that track objects from one frame to the
+          next (e.g. `contour.RoiTracking`) only help when frames are processed one at a time, so they should only be
+          set in `serial` mode or with a single pipeline worker.
+
+        - `Disable` (repeatable): The name of a postprocessor (as used in `PostProcessor` tags) that is given no frames
+          while this level is active, e.g. `record` or `display`.
+
+        Levels are not cumulative: a level only skips frames, overrides settings and disables postprocessors as its
+        own tags say.
+    """
+    def __init__(self, level_config_root: Optional[ElementTree.Element] = None):
+        if level_config_root is None:
+            level_config_root = ElementTree.Element("Level")
+        self.skip_frames = int(level_config_root.findtext("SkipFrames", "0"))
+        self.settings = dict()  # type: Dict[str, Dict[str, str]]
+        for element in level_config_root.findall("Set"):
+            key, value = element.text.strip().split("=", 1)
+            component_name, setting = key.split(".", 1)
+            self.settings.setdefault(component_name, dict())[setting] = value
+        self.disabled = set()  # type: Set[str]
+        for element in level_config_root.findall("Disable"):
+            self.disabled.add(element.text.strip())
+
+
+class GovernorSettings:
+    """ Settings for the latency governor, read from the optional `Governor` tag in config.xml.
+
+        Configuration info:
+
+        - `Enabled`: If set to true, the governor is used. Defaults to false.
+
+        - `Budget`: The end-to-end latency budget in seconds, measured from when a frame is captured until every
+          postprocessor has been given its results. Defaults to 0.1.
+
+        - `Window`: The number of frames whose latency is compared with the budget at a time. Defaults to 30.
+
+        - `Percentile`: The percentile of the window's latencies that is compared with the budget. Defaults to 90.
+
+        - `Headroom`: The fraction of the budget the latency must stay under before the governor steps back up a
+          level. Defaults to 0.6.
+
+        - `Level` (repeatable): The degradation levels, from the mildest to the most severe (see GovernorLevel). Level
+          0, which changes nothing, comes before them.
+    """
+    def __init__(self, governor_config_root: Optional[ElementTree.Element] = None):
+        if governor_config_root is None:
+            governor_config_root = ElementTree.Element("Governor")
+        self.enabled = governor_config_root.findtext("Enabled", "false") in ['true', '1', 't', 'y', 'yes']
+        self.budget = float(governor_config_root.findtext("Budget", "0.1"))
+        self.window = int(governor_config_root.findtext("Window", "30"))
+        self.percentile = float(governor_config_root.findtext("Percentile", "90"))
+        self.headroom = float(governor_config_root.findtext("Headroom", "0.6"))
+        # level 0 changes nothing
+        self.levels = [GovernorLevel()]
+        for element in governor_config_root.findall("Level"):
+            self.levels.append(GovernorLevel(element))
+
+
+class LatencyGovernor:
+    """ Keeps end-to-end latency within a budget by stepping through
+        degradation levels.
+
+        The main loop reports every frame's latency with frame_done() and asks
+        skip_frame() before processing a frame. With several cameras, the
+        latencies of all of them count towards the same budget. After every
+        `Window` frames, the governor steps down a level if the latency
+        percentile is over the budget, or back up a level if it is under
+        `Headroom` times the budget.
+        Component settings are changed in the background through
+        Component.reconfigure(), so frames keep flowing while a level is
+        applied, and the window restarts once the new level is in place.
+    """
+    def __init__(self, settings: GovernorSettings, config_manager: "ConfigurationManager", fan_out: PostProcessorFanOut,
+                 metrics: Optional[Metrics] = None):
+        """ Arguments:
+            - settings: The governor's settings.
+            - config_manager: The configuration manager that loaded the
+              components. Level settings are applied as its overrides, so they
+              stay in place when the config file is reloaded.
+            - fan_out: The postprocessors, which levels may disable.
+            - metrics: If given, the level and the number of level changes are
+              exported as gauges.
+        """
+        self.settings = settings
+        self.config_manager = config_manager
+        self.components = config_manager.components
+        self.fan_out = fan_out
+        self.level = 0
+        self.level_changes = 0
+        self.skipped_frames = 0
+        self.latencies = LatencyHistogram(settings.window)
+
+        self._skip_frames = 0
+        # counted for each camera separately, so every camera keeps the same share of its frames
+        self._frames_since_used = dict()  # type: Dict[str, int]
+        self._applying = None  # type: Optional[asyncio.Future]
+        if metrics is not None:
+            metrics.add_gauge("governor.level", lambda: self.level)
+            metrics.add_gauge("governor.level_changes", lambda: self.level_changes)
+            metrics.add_gauge("governor.skipped_frames", lambda: self.skipped_frames)
+
+        for level in settings.levels:
+            for name in set(level.settings) | level.disabled:
+                if name not in self.components:
+                    logging.warning("Governor: ignoring component {}, which isn't loaded".format(name))
+
+    def skip_frame(self, camera: str = "") -> bool:
+        """ Returns True if the frame that was just captured by the given
+            camera should be dropped.
+        """
+        frames_since_used = self._frames_since_used.get(camera, 0)
+        if frames_since_used < self._skip_frames:
+            self._frames_since_used[camera] = frames_since_used + 1
+            self.skipped_frames += 1
+            return True
+        self._frames_since_used[camera] = 0
+        return False
+
+    def frame_done(self, latency: float) -> NoReturn:
+        """ Records the end-to-end latency of a frame, in seconds.
+        """
+        if self._applying is not None:
+            return
+        self.latencies.record(latency)
+        if self.latencies.count < self.settings.window:
+            return
+
+        latency = float(numpy.percentile(self.latencies.window(), self.settings.percentile))
+        self.latencies = LatencyHistogram(self.settings.window)
+        if latency > self.settings.budget and self.level < len(self.settings.levels) - 1:
+            level = self.level + 1
+        elif latency < self.settings.budget * self.settings.headroom and self.level > 0:
+            level = self.level - 1
+        else:
+            return
+        logging.warning("Governor: p{:g} latency {:.1f} ms against a {:.1f} ms budget, moving to level {}".format(
+            self.settings.percentile, latency * 1000, self.settings.budget * 1000, level))
+        self._applying = asyncio.ensure_future(self._apply(level))
+
+    async def _apply(self, level: int) -> NoReturn:
+        old, new = self.settings.levels[self.level], self.settings.levels[level]
+        try:
+            for name in set(old.settings) | set(new.settings):
+                if name not in self.components or old.settings.get(name) == new.settings.get(name):
+                    continue
+                if not await self.config_manager.set_overrides(name, new.settings.get(name, dict())):
+                    logging.warning("Governor: component {} can't be reconfigured while running".format(name))
+            for name in (old.disabled | new.disabled) & set(self.components):
+                self.fan_out.set_enabled(self.components[name], name not in new.disabled)
+            self._skip_frames = new.skip_frames
+            self.level = level
+            self.level_changes += 1
+        except Exception as e:
+            logging.error("Governor: failed to move to level {}: {}".format(level, e))
+        finally:
+            self._applying = None
@@ -2,50 +2,119 @@ import logging
 import argparse
 import signal
 import asyncio
-import collections
+import collections.abc
 import time
 
 from base_classes import *
 import configuration_manager
+import pipeline
+from postprocessor_runner import PostProcessorFanOut
+from metrics import Metrics, MetricsSettings
+from governor import GovernorSettings, LatencyGovernor
 
 
 COMPONENTS = dict()
+PIPELINE_SETTINGS = pipeline.PipelineSettings()
+POSTPROCESSOR_DEADLINES = list()
+METRICS_SETTINGS = MetricsSettings()
+GOVERNOR_SETTINGS = GovernorSettings()
+CONFIG_MANAGER = None  # type: Optional[configuration_manager.ConfigurationManager]
+STARTED = time.monotonic()
 
 
 async def load_components(config_file_name: str) -> NoReturn:
-    global COMPONENTS
-    COMPONENTS = await configuration_manager.ConfigurationManager(config_file_name).load_all_components()
+    global COMPONENTS, PIPELINE_SETTINGS, POSTPROCESSOR_DEADLINES, METRICS_SETTINGS, GOVERNOR_SETTINGS, CONFIG_MANAGER
+    CONFIG_MANAGER = configuration_manager.ConfigurationManager(config_file_name)
+    PIPELINE_SETTINGS = CONFIG_MANAGER.load_pipeline_settings()
+    METRICS_SETTINGS = CONFIG_MANAGER.load_metrics_settings()
+    GOVERNOR_SETTINGS = CONFIG_MANAGER.load_governor_settings()
+    POSTPROCESSOR_DEADLINES = CONFIG_MANAGER.load_postprocessor_deadlines()
+    COMPONENTS = await CONFIG_MANAGER.load_all_components()
 
 
 async def main_loop(frame_generator_cmp: FrameGeneratorBase, processor_cmp: ProcessorBase,
-                    postprocessor_cmps: List[PostProcessorBase]):
+                    postprocessors: PostProcessorFanOut, metrics: Optional[Metrics] = None,
+                    governor: Optional[LatencyGovernor] = None):
+    if metrics is not None:
+        capture_time = metrics.histogram("capture")
+        process_time = metrics.histogram("process")
+        postprocess_time = metrics.histogram("postprocess")
+        latency = metrics.histogram("latency")
+        metrics.add_gauge("frame_generator.dropped_frames", lambda: frame_generator_cmp.dropped_frames)
+    
     while True:
+        if metrics is not None:
+            start = time.perf_counter()
         try:
             frame = frame_generator_cmp.get_frame()
             if frame is None:
                 return
-        except FrameGeneratorBase.RvalException:
+        except FrameGeneratorBase.FrameException:
             return
+        if metrics is not None:
+            captured = time.perf_counter()
+            capture_time.record(captured - start)
+        if governor is not None and governor.skip_frame(frame_generator_cmp.camera):
+            continue
         
         data = processor_cmp.process(frame)
+        pipeline.stamp_frame_info(data, frame_generator_cmp.frame_sequence, frame_generator_cmp.frame_timestamp,
+                                  frame_generator_cmp.camera)
+        if metrics is not None:
+            processed = time.perf_counter()
+            process_time.record(processed - captured)
         
-        for postprocessor_cmp in postprocessor_cmps:
-            await postprocessor_cmp.postprocess(data, frame)
+        await postprocessors.postprocess(data, frame)
+        if metrics is not None:
+            postprocess_time.record(time.perf_counter() - processed)
+            if frame_generator_cmp.frame_timestamp > 0:
+                latency.record(time.time() - frame_generator_cmp.frame_timestamp)
+            metrics.frame_done()
+        if governor is not None and frame_generator_cmp.frame_timestamp > 0:
+            governor.frame_done(time.time() - frame_generator_cmp.frame_timestamp)
+
+
+async def run_main_loop(metrics: Optional[Metrics]) -> NoReturn:
+    postprocessor_fan_out = PostProcessorFanOut(COMPONENTS["POSTPROCESSORS"], POSTPROCESSOR_DEADLINES, metrics,
+                                                STARTED)
+    reporter = asyncio.ensure_future(metrics.serve(METRICS_SETTINGS)) if metrics is not None else None
+    reload_interval = CONFIG_MANAGER.load_reload_interval()
+    watcher = asyncio.ensure_future(CONFIG_MANAGER.watch(reload_interval)) if reload_interval > 0 else None
+    governor = LatencyGovernor(GOVERNOR_SETTINGS, CONFIG_MANAGER, postprocessor_fan_out, metrics) \
+        if GOVERNOR_SETTINGS.enabled else None
+    frame_generators = COMPONENTS["FRAME_GENERATORS"]
+    try:
+        if len(frame_generators) > 1:
+            # cameras always share the processor through the pipeline, whatever the mode
+            await pipeline.multi_camera_loop(frame_generators, COMPONENTS["PROCESSOR"], postprocessor_fan_out,
+                                             PIPELINE_SETTINGS, metrics, governor)
+        elif PIPELINE_SETTINGS.pipelined:
+            await pipeline.pipelined_loop(frame_generators[0], COMPONENTS["PROCESSOR"], postprocessor_fan_out,
+                                          PIPELINE_SETTINGS, metrics, governor)
+        else:
+            await main_loop(frame_generators[0], COMPONENTS["PROCESSOR"], postprocessor_fan_out, metrics, governor)
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+        if reporter is not None:
+            reporter.cancel()
+            metrics.log_summary()
+        postprocessor_fan_out.stop()
 
 
 # noinspection PyShadowingNames
 def signal_handler(sig, _) -> NoReturn:
+    # cleanup runs on the main event loop once the main loop has unwound, since components (e.g. servers started in
+    # setup()) are bound to that loop
     logging.info("Received signal {}, running cleanup functions".format(sig))
-    asyncio.get_event_loop().stop()
-    cleanup_loop = asyncio.new_event_loop()
-    cleanup_loop.run_until_complete(call_cleanup_functions())
+    raise KeyboardInterrupt
 
 
 async def call_cleanup_functions() -> NoReturn:
     # taken from https://stackoverflow.com/a/2158532
     def flatten(l):
         for el in l:
-            if isinstance(el, collections.Iterable) and not isinstance(el, (str, bytes)):
+            if isinstance(el, collections.abc.Iterable) and not isinstance(el, (str, bytes)):
                 yield from flatten(el)
             else:
                 yield el
@@ -72,22 +141,28 @@ if __name__ == "__main__":
     
     logging.basicConfig(filename=log_file, filemode="w", level=logging.DEBUG)
     
-    load_components_loop = asyncio.new_event_loop()
-    load_components_loop.run_until_complete(load_components(config_file))
-    load_components_loop.close()
+    # components are set up, run and cleaned up on one event loop, so anything they start in setup() (e.g. a
+    # server) keeps running alongside the main loop
+    main_async_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(main_async_loop)
+    main_async_loop.run_until_complete(load_components(config_file))
     
     signal.signal(signal.SIGINT, signal_handler)
     
+    main_task = main_async_loop.create_task(
+        run_main_loop(Metrics(METRICS_SETTINGS.window_size) if METRICS_SETTINGS.enabled else None)
+    )
     try:
-        main_async_loop = asyncio.new_event_loop()
-        main_async_loop.run_until_complete(
-            main_loop(COMPONENTS["FRAME_GENERATOR"], COMPONENTS["PROCESSOR"], COMPONENTS["POSTPROCESSORS"])
-        )
-        main_async_loop.close()
+        main_async_loop.run_until_complete(main_task)
+    except KeyboardInterrupt:
+        logging.info("Shutting down")
+        # the interrupt leaves the main loop suspended, so unwind it (stopping the pipeline stages and the
+        # postprocessor threads) before the components are cleaned up
+        main_task.cancel()
+        main_async_loop.run_until_complete(asyncio.gather(main_task, return_exceptions=True))
     except Exception as e:
-    	logging.error(e)
-    	main_async_loop.stop()
-    	raise
+        logging.error(e)
+        raise
     finally:
-        cleanup_loop = asyncio.new_event_loop()
-        cleanup_loop.run_until_complete(call_cleanup_functions())
+        main_async_loop.run_until_complete(call_cleanup_functions())
+        main_async_loop.close()
@@ -0,0 +1,162 @@
+from typing import Any, Callable, Dict, NoReturn, Optional
+from array import array
+import xml.etree.ElementTree as ElementTree
+import asyncio
+import json
+import logging
+import time
+import numpy
+
+
+class MetricsSettings:
+    """ Settings for the built-in timing instrumentation, read from the optional `Metrics` tag in config.xml.
+
+        Configuration info:
+
+        - `Enabled`: If set to true, every stage of the main loop and every postprocessor is timed. Defaults to
+          false, in which case the main loop does no timing work at all.
+
+        - `WindowSize`: The number of most recent samples kept per stage for the rolling statistics. Defaults to
+          1024.
+
+        - `StatsPort`: If set, a JSON snapshot of the statistics is served to anything that connects to this TCP
+          port (e.g. `curl localhost:5809` or `nc localhost 5809`). Ports 5800-5810 are open on the field network.
+
+        - `LogInterval`: If set, a summary of the statistics is logged every this many seconds.
+    """
+    def __init__(self, metrics_config_root: Optional[ElementTree.Element] = None):
+        if metrics_config_root is None:
+            metrics_config_root = ElementTree.Element("Metrics")
+        self.enabled = metrics_config_root.findtext("Enabled", "false") in ['true', '1', 't', 'y', 'yes']
+        self.window_size = int(metrics_config_root.findtext("WindowSize", "1024"))
+        stats_port = metrics_config_root.findtext("StatsPort")
+        self.stats_port = int(stats_port) if stats_port else None
+        log_interval = metrics_config_root.findtext("LogInterval")
+        self.log_interval = float(log_interval) if log_interval else None
+
+
+class LatencyHistogram:
+    """ Keeps the most recent `size` latency samples in a preallocated ring
+        buffer. Recording a sample never allocates; statistics are computed
+        only when they are read.
+    """
+    __slots__ = ("samples", "size", "index", "count")
+
+    def __init__(self, size: int = 1024):
+        self.samples = array("d", bytes(8 * size))
+        self.size = size
+        self.index = 0
+        self.count = 0
+
+    def record(self, seconds: float) -> NoReturn:
+        self.samples[self.index] = seconds
+        self.index = (self.index + 1) % self.size
+        self.count += 1
+
+    def window(self) -> numpy.ndarray:
+        return numpy.frombuffer(self.samples, dtype=numpy.float64)[:min(self.count, self.size)]
+
+    def summary(self) -> Dict[str, float]:
+        milliseconds = self.window() * 1000
+        if len(milliseconds) == 0:
+            return {"count": 0}
+        p50, p99 = numpy.percentile(milliseconds, (50, 99))
+        return {
+            "count": self.count,
+            "mean_ms": float(milliseconds.mean()),
+            "p50_ms": float(p50),
+            "p99_ms": float(p99),
+            "max_ms": float(milliseconds.max()),
+        }
+
+
+class Metrics:
+    """ Rolling per-stage latency statistics, frame rate and counters for the
+        running pipeline.
+
+        Histograms should be fetched with histogram() before the main loop
+        starts, so the hot path only calls LatencyHistogram.record().
+        Gauges are read only when a snapshot is taken, so values that
+        components already track (e.g. dropped frames) cost nothing per frame.
+    """
+    def __init__(self, window_size: int = 1024):
+        self.window_size = window_size
+        self.histograms = dict()  # type: Dict[str, LatencyHistogram]
+        self.counters = dict()  # type: Dict[str, int]
+        self.gauges = dict()  # type: Dict[str, Callable[[], Any]]
+        self.frame_times = LatencyHistogram(window_size)  # completion time of each frame, used for the frame rate
+        self.start_time = time.monotonic()
+
+    def histogram(self, name: str) -> LatencyHistogram:
+        if name not in self.histograms:
+            self.histograms[name] = LatencyHistogram(self.window_size)
+        return self.histograms[name]
+
+    def count(self, name: str, amount: int = 1) -> NoReturn:
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add_gauge(self, name: str, read: Callable[[], Any]) -> NoReturn:
+        self.gauges[name] = read
+
+    def frame_done(self) -> NoReturn:
+        self.frame_times.record(time.monotonic())
+
+    def fps(self) -> float:
+        times = self.frame_times.window()
+        if len(times) < 2:
+            return 0.0
+        elapsed = times.max() - times.min()
+        return (len(times) - 1) / elapsed if elapsed > 0 else 0.0
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "uptime_s": time.monotonic() - self.start_time,
+            "frames": self.frame_times.count,
+            "fps": self.fps(),
+            "stages": {name: histogram.summary() for name, histogram in self.histograms.items()},
+            "counters": dict(self.counters),
+            "gauges": {name: read() for name, read in self.gauges.items()},
+        }
+
+    def log_summary(self) -> NoReturn:
+        snapshot = self.snapshot()
+        stages = ", ".join("{} p50 {:.1f}ms p99 {:.1f}ms".format(name, stage["p50_ms"], stage["p99_ms"])
+                           for name, stage in snapshot["stages"].items() if stage["count"] > 0)
+        counters = ", ".join("{} {}".format(name, value)
+                             for name, value in list(snapshot["counters"].items()) + list(snapshot["gauges"].items()))
+        logging.info("{:.1f} fps; {}; {}".format(snapshot["fps"], stages, counters))
+
+    async def serve(self, settings: MetricsSettings) -> NoReturn:
+        """ Serves snapshots on the stats port and logs summaries periodically
+            until cancelled.
+        """
+        server = None
+        if settings.stats_port is not None:
+            server = await asyncio.start_server(self._send_snapshot, "0.0.0.0", settings.stats_port)
+            logging.debug("Serving metrics on port " + str(settings.stats_port))
+        try:
+            while True:
+                if settings.log_interval is None:
+                    await asyncio.sleep(3600)
+                    continue
+                await asyncio.sleep(settings.log_interval)
+                self.log_summary()
+        finally:
+            if server is not None:
+                server.close()
+
+    async def _send_snapshot(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> NoReturn:
+        try:
+            # HTTP clients send a request first; plain TCP clients may send nothing at all
+            request = await asyncio.wait_for(reader.readline(), 0.1)
+        except asyncio.TimeoutError:
+            request = b""
+        body = json.dumps(self.snapshot(), indent=2).encode("utf-8") + b"\n"
+        if request.startswith(b"GET"):
+            writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: application/json\r\nContent-Length: " +
+                         str(len(body)).encode("ascii") + b"\r\n\r\n")
+        writer.write(body)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
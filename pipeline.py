@@ -0,0 +1,323 @@
+from typing import Any, List, NoReturn, Optional
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+import xml.etree.ElementTree as ElementTree
+import asyncio
+import inspect
+import logging
+import time
+
+from base_classes import FrameGeneratorBase, ProcessorBase, Detections
+from postprocessor_runner import PostProcessorFanOut
+from metrics import Metrics
+from governor import LatencyGovernor
+
+
+class PipelineSettings:
+    """ Settings for the main loop, read from the optional `Pipeline` tag in config.xml.
+
+        Configuration info:
+
+        - `Mode`: Either `serial` (default) or `pipelined`. In serial mode, every frame is captured, processed and
+          postprocessed before the next frame is captured. In pipelined mode, capture, processing and postprocessing
+          run as separate stages connected by bounded queues, so they overlap.
+
+        - `QueueSize`: The maximum number of captured frames waiting to be processed. Defaults to 2.
+
+        - `DropPolicy`: What the capture stage does when the queue is full. `drop-oldest` (default) throws away the
+          oldest waiting frame, which keeps latency low. `block` waits for the processor to catch up, so no frame is
+          skipped.
+
+        - `Executor`: Either `thread` (default) or `process`. Selects where `ProcessorBase.process` runs. Process
+          executors sidestep the GIL, but the processor is pickled with every frame, so it cannot keep state between
+          frames.
+
+        - `Workers`: The number of frames that may be processed at the same time. Defaults to 2.
+    """
+    DROP_OLDEST = "drop-oldest"
+    BLOCK = "block"
+
+    def __init__(self, pipeline_config_root: Optional[ElementTree.Element] = None):
+        if pipeline_config_root is None:
+            pipeline_config_root = ElementTree.Element("Pipeline")
+        self.mode = pipeline_config_root.findtext("Mode", "serial")
+        self.queue_size = int(pipeline_config_root.findtext("QueueSize", "2"))
+        self.drop_policy = pipeline_config_root.findtext("DropPolicy", PipelineSettings.DROP_OLDEST)
+        self.executor = pipeline_config_root.findtext("Executor", "thread")
+        self.workers = int(pipeline_config_root.findtext("Workers", "2"))
+
+        if self.mode not in ("serial", "pipelined"):
+            raise ValueError("Unknown pipeline mode " + self.mode)
+        if self.drop_policy not in (PipelineSettings.DROP_OLDEST, PipelineSettings.BLOCK):
+            raise ValueError("Unknown drop policy " + self.drop_policy)
+        if self.executor not in ("thread", "process"):
+            raise ValueError("Unknown executor " + self.executor)
+
+    @property
+    def pipelined(self) -> bool:
+        return self.mode == "pipelined"
+
+    def create_executor(self) -> Executor:
+        if self.executor == "process":
+            return ProcessPoolExecutor(self.workers)
+        return ThreadPoolExecutor(self.workers, thread_name_prefix="processor")
+
+
+def stamp_frame_info(data: Any, frame_sequence: int, frame_timestamp: float, camera: str = "") -> NoReturn:
+    """ Copies the frame generator's sequence number, capture time and camera
+        tag for a frame onto the processor's result for it, if the result is a
+        Detections batch.
+    """
+    if isinstance(data, Detections):
+        data.frame_sequence = frame_sequence
+        data.frame_timestamp = frame_timestamp
+        data.camera = camera
+
+
+async def pipelined_loop(frame_generator_cmp: FrameGeneratorBase, processor_cmp: ProcessorBase,
+                         postprocessors: PostProcessorFanOut, settings: PipelineSettings,
+                         metrics: Optional[Metrics] = None, governor: Optional[LatencyGovernor] = None) -> NoReturn:
+    """ Runs the pipeline as three overlapping stages:
+
+        capture -> [frame queue] -> process (executor) -> [result queue] -> postprocess
+
+        Up to `settings.workers` frames are processed at once. Results are
+        handed to the postprocessors in capture order.
+
+        If `metrics` is given, the time spent in each stage is recorded. The
+        `process` time includes time spent waiting for a free executor worker.
+
+        If `governor` is given, frames it skips are dropped right after capture
+        and every frame's end-to-end latency is reported to it.
+    """
+    loop = asyncio.get_event_loop()
+    capture_executor = ThreadPoolExecutor(1, thread_name_prefix="capture")
+    processor_executor = settings.create_executor()
+    frame_queue = asyncio.Queue(settings.queue_size)
+    # holds futures in capture order; its size bounds the number of frames in flight
+    result_queue = asyncio.Queue(settings.workers)
+    dropped_frames = 0
+    if metrics is not None:
+        capture_time = metrics.histogram("capture")
+        process_time = metrics.histogram("process")
+        postprocess_time = metrics.histogram("postprocess")
+        latency = metrics.histogram("latency")
+        metrics.add_gauge("frame_generator.dropped_frames", lambda: frame_generator_cmp.dropped_frames)
+        metrics.add_gauge("pipeline.dropped_frames", lambda: dropped_frames)
+
+    async def capture_stage():
+        nonlocal dropped_frames
+        while True:
+            if metrics is not None:
+                start = time.perf_counter()
+            try:
+                frame = await loop.run_in_executor(capture_executor, frame_generator_cmp.get_frame)
+            except FrameGeneratorBase.FrameException:
+                frame = None
+            if frame is None:
+                await frame_queue.put(None)
+                return
+            if metrics is not None:
+                capture_time.record(time.perf_counter() - start)
+            if governor is not None and governor.skip_frame(frame_generator_cmp.camera):
+                continue
+
+            if settings.drop_policy == PipelineSettings.DROP_OLDEST and frame_queue.full():
+                frame_queue.get_nowait()
+                dropped_frames += 1
+            await frame_queue.put((frame, frame_generator_cmp.frame_sequence, frame_generator_cmp.frame_timestamp))
+
+    async def process_stage():
+        while True:
+            item = await frame_queue.get()
+            if item is None:
+                await result_queue.put(None)
+                return
+            frame, sequence, timestamp = item
+            future = loop.run_in_executor(processor_executor, processor_cmp.process, frame)
+            submitted = time.perf_counter() if metrics is not None else 0.0
+            await result_queue.put((frame, sequence, timestamp, submitted, future))
+
+    async def postprocess_stage():
+        while True:
+            item = await result_queue.get()
+            if item is None:
+                return
+            frame, sequence, timestamp, submitted, future = item
+            data = await future
+            stamp_frame_info(data, sequence, timestamp, frame_generator_cmp.camera)
+            if metrics is not None:
+                processed = time.perf_counter()
+                process_time.record(processed - submitted)
+            await postprocessors.postprocess(data, frame)
+            if metrics is not None:
+                postprocess_time.record(time.perf_counter() - processed)
+                if timestamp > 0:
+                    latency.record(time.time() - timestamp)
+                metrics.frame_done()
+            if governor is not None and timestamp > 0:
+                governor.frame_done(time.time() - timestamp)
+
+    stages = [asyncio.ensure_future(capture_stage()), asyncio.ensure_future(process_stage()),
+              asyncio.ensure_future(postprocess_stage())]
+    try:
+        await asyncio.gather(*stages)
+    finally:
+        for stage in stages:
+            stage.cancel()
+        capture_executor.shutdown(wait=False)
+        processor_executor.shutdown(wait=False)
+        logging.info("Pipeline dropped {} frames waiting for the processor".format(dropped_frames))
+
+
+async def multi_camera_loop(frame_generators: List[FrameGeneratorBase], processor_cmp: ProcessorBase,
+                            postprocessors: PostProcessorFanOut, settings: PipelineSettings,
+                            metrics: Optional[Metrics] = None, governor: Optional[LatencyGovernor] = None) -> NoReturn:
+    """ Runs the pipeline for several cameras at once, with one capture stage
+        per camera and one processor executor and set of postprocessors
+        shared between them:
+
+        capture (camera 1) -> [frame queue 1] -+
+        ...                                    +-> process (executor) -> [result queue] -> postprocess
+        capture (camera N) -> [frame queue N] -+
+
+        Every camera has its own frame queue, which follows `QueueSize` and
+        `DropPolicy`, so a camera that captures faster than the processor
+        keeps up only drops its own frames. The process stage takes frames
+        from the queues in turn (round robin), skipping cameras with nothing
+        waiting, so every camera gets an equal share of the executor's
+        `Workers` when the processor is the bottleneck. Results are handed to
+        the postprocessors in the order their frames were submitted, tagged
+        with their camera (see Detections.camera). The loop ends once every
+        camera has run out of frames.
+
+        The processor is passed every frame's camera (see
+        ProcessorBase.process), so processors that keep state between frames
+        (e.g. the contour processor's `RoiTracking`) keep it for each camera
+        separately.
+
+        If `metrics` is given, the stages are timed as in pipelined_loop, the
+        frame rate counts the frames of every camera, and each camera's
+        capture time and end-to-end latency are also recorded as
+        `capture.<camera>` and `latency.<camera>`, with its processed frames
+        counted in `frames.<camera>`.
+
+        If `governor` is given, it skips frames for every camera separately,
+        and every frame's end-to-end latency is reported to it.
+    """
+    loop = asyncio.get_event_loop()
+    processor_executor = settings.create_executor()
+    # holds futures in submission order; its size bounds the number of frames in flight
+    result_queue = asyncio.Queue(settings.workers)
+    frame_ready = asyncio.Event()
+    cameras = [_Camera(frame_generator, settings.queue_size, metrics) for frame_generator in frame_generators]
+    # processors written before process() took the camera still work, they just see the cameras' frames interleaved
+    passes_camera = "camera" in inspect.signature(processor_cmp.process).parameters
+    if metrics is not None:
+        process_time = metrics.histogram("process")
+        postprocess_time = metrics.histogram("postprocess")
+        latency = metrics.histogram("latency")
+
+    async def capture_stage(camera: _Camera):
+        frame_generator_cmp = camera.frame_generator
+        while True:
+            if metrics is not None:
+                start = time.perf_counter()
+            try:
+                frame = await loop.run_in_executor(camera.executor, frame_generator_cmp.get_frame)
+            except FrameGeneratorBase.FrameException:
+                frame = None
+            if frame is None:
+                camera.finished = True
+                frame_ready.set()
+                logging.info("Camera {} ran out of frames".format(frame_generator_cmp.camera))
+                return
+            if metrics is not None:
+                camera.capture_time.record(time.perf_counter() - start)
+            if governor is not None and governor.skip_frame(frame_generator_cmp.camera):
+                continue
+
+            if settings.drop_policy == PipelineSettings.DROP_OLDEST and camera.frame_queue.full():
+                camera.frame_queue.get_nowait()
+                camera.dropped_frames += 1
+            await camera.frame_queue.put((frame, frame_generator_cmp.frame_sequence,
+                                          frame_generator_cmp.frame_timestamp))
+            frame_ready.set()
+
+    async def process_stage():
+        next_camera = 0
+        while True:
+            for offset in range(len(cameras)):
+                camera = cameras[(next_camera + offset) % len(cameras)]
+                if not camera.frame_queue.empty():
+                    break
+            else:
+                if all(camera.finished for camera in cameras):
+                    await result_queue.put(None)
+                    return
+                frame_ready.clear()
+                await frame_ready.wait()
+                continue
+            next_camera = (cameras.index(camera) + 1) % len(cameras)
+
+            frame, sequence, timestamp = camera.frame_queue.get_nowait()
+            if passes_camera:
+                future = loop.run_in_executor(processor_executor, processor_cmp.process, frame,
+                                              camera.frame_generator.camera)
+            else:
+                future = loop.run_in_executor(processor_executor, processor_cmp.process, frame)
+            submitted = time.perf_counter() if metrics is not None else 0.0
+            await result_queue.put((camera, frame, sequence, timestamp, submitted, future))
+
+    async def postprocess_stage():
+        while True:
+            item = await result_queue.get()
+            if item is None:
+                return
+            camera, frame, sequence, timestamp, submitted, future = item
+            data = await future
+            stamp_frame_info(data, sequence, timestamp, camera.frame_generator.camera)
+            if metrics is not None:
+                processed = time.perf_counter()
+                process_time.record(processed - submitted)
+            await postprocessors.postprocess(data, frame)
+            if metrics is not None:
+                postprocess_time.record(time.perf_counter() - processed)
+                if timestamp > 0:
+                    frame_latency = time.time() - timestamp
+                    latency.record(frame_latency)
+                    camera.latency.record(frame_latency)
+                metrics.count(camera.frames_counter)
+                metrics.frame_done()
+            if governor is not None and timestamp > 0:
+                governor.frame_done(time.time() - timestamp)
+
+    stages = [asyncio.ensure_future(capture_stage(camera)) for camera in cameras]
+    stages += [asyncio.ensure_future(process_stage()), asyncio.ensure_future(postprocess_stage())]
+    try:
+        await asyncio.gather(*stages)
+    finally:
+        for stage in stages:
+            stage.cancel()
+        for camera in cameras:
+            camera.executor.shutdown(wait=False)
+            logging.info("Pipeline dropped {} frames from camera {} waiting for the processor".format(
+                camera.dropped_frames, camera.frame_generator.camera))
+        processor_executor.shutdown(wait=False)
+
+
+class _Camera:
+    """ The capture stage state of one camera in multi_camera_loop.
+    """
+    def __init__(self, frame_generator: FrameGeneratorBase, queue_size: int, metrics: Optional[Metrics] = None):
+        self.frame_generator = frame_generator
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="capture-" + frame_generator.camera)
+        self.frame_queue = asyncio.Queue(queue_size)
+        self.finished = False
+        self.dropped_frames = 0
+        if metrics is not None:
+            name = frame_generator.camera
+            self.capture_time = metrics.histogram("capture." + name)
+            self.latency = metrics.histogram("latency." + name)
+            self.frames_counter = "frames." + name
+            metrics.add_gauge("frame_generator.dropped_frames." + name, lambda: frame_generator.dropped_frames)
+            metrics.add_gauge("pipeline.dropped_frames." + name, lambda: self.dropped_frames)
@@ -0,0 +1,182 @@
+from typing import Any, List, NoReturn, Optional, Union
+from concurrent.futures import Future
+from numpy import ndarray
+import asyncio
+import threading
+import logging
+import time
+
+from base_classes import PostProcessorBase
+from metrics import LatencyHistogram, Metrics
+
+
+class ShutdownRequested(Exception):
+    """ Raised in place of KeyboardInterrupt when a postprocessor running on its
+        own thread asks for the program to shut down.
+    """
+    pass
+
+
+class PostProcessorRunner:
+    """ Runs a single postprocessor on a dedicated thread with its own event
+        loop, so a postprocessor that blocks can never stall the main loop or
+        the other postprocessors.
+
+        Postprocessors that set `main_thread` (see PostProcessorBase) run on
+        the event loop that submits their frames instead.
+
+        Only one postprocess() call runs at a time. If the previous call is
+        still running when a new frame arrives, the new frame is skipped for
+        this postprocessor.
+    """
+    def __init__(self, postprocessor: PostProcessorBase, deadline: Optional[float] = None,
+                 histogram: Optional[LatencyHistogram] = None):
+        """ Arguments:
+            - postprocessor: The postprocessor to run.
+            - deadline: The number of seconds the main loop waits for each
+              postprocess() call before moving on without it. None waits
+              until the call finishes.
+            - histogram: If given, the duration of every postprocess() call
+              is recorded in it.
+        """
+        self.postprocessor = postprocessor
+        self.deadline = deadline
+        self.histogram = histogram
+        self.name = type(postprocessor).__name__
+        self.overruns = 0
+        self.skipped_frames = 0
+        # disabled runners are given no frames (see PostProcessorFanOut.set_enabled)
+        self.enabled = True
+
+        self._pending = None  # type: Optional[Union[Future, asyncio.Future]]
+        self._loop = None  # type: Optional[asyncio.AbstractEventLoop]
+        self._thread = None  # type: Optional[threading.Thread]
+        if not postprocessor.main_thread:
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=self._loop.run_forever, name="postprocessor-" + self.name,
+                                            daemon=True)
+            self._thread.start()
+
+    @property
+    def busy(self) -> bool:
+        return self._pending is not None and not self._pending.done()
+
+    def submit(self, data: List[Any], frame: ndarray) -> Optional[Union[Future, asyncio.Future]]:
+        """ Starts postprocessing a frame on the runner's thread.
+
+            Returns a future for the call, or None if the frame was skipped
+            because the previous call is still running.
+        """
+        if self.busy:
+            self.skipped_frames += 1
+            return None
+        # a call that overran its deadline may have failed after the main loop stopped waiting for it
+        self.collect()
+
+        if self._loop is None:
+            self._pending = asyncio.ensure_future(self._postprocess(data, frame))
+        else:
+            self._pending = asyncio.run_coroutine_threadsafe(self._postprocess(data, frame), self._loop)
+        return self._pending
+
+    def collect(self) -> NoReturn:
+        """ Forgets the finished postprocess() call, re-raising the exception
+            it failed with (if any).
+        """
+        pending, self._pending = self._pending, None
+        if pending is not None and pending.result() is not None:
+            raise pending.result()
+
+    async def _postprocess(self, data: List[Any], frame: ndarray) -> Optional[BaseException]:
+        # exceptions are returned rather than raised so they are re-raised on the main loop's thread
+        if self.histogram is not None:
+            start = time.perf_counter()
+        try:
+            await self.postprocessor.postprocess(data, frame)
+        except KeyboardInterrupt:
+            return ShutdownRequested()
+        except Exception as e:
+            return e
+        if self.histogram is not None:
+            self.histogram.record(time.perf_counter() - start)
+        return None
+
+    def stop(self) -> NoReturn:
+        if self._loop is None:
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(1)
+        if not self._thread.is_alive():
+            self._loop.close()
+
+
+class PostProcessorFanOut:
+    """ Dispatches every frame to all postprocessors at the same time and waits
+        for each of them up to its own deadline.
+
+        A postprocessor that misses its deadline is logged and counted as an
+        overrun. It keeps running in the background, and frames that arrive
+        before it finishes are skipped for that postprocessor only.
+
+        If `started` (a time.monotonic() value) is given, the time from then to
+        the first dispatched frame is logged.
+    """
+    def __init__(self, postprocessors: List[PostProcessorBase], deadlines: List[Optional[float]],
+                 metrics: Optional[Metrics] = None, started: Optional[float] = None):
+        self.started = started
+        self.runners = []
+        for postprocessor, deadline in zip(postprocessors, deadlines):
+            name = "postprocessor." + type(postprocessor).__name__
+            runner = PostProcessorRunner(postprocessor, deadline,
+                                         metrics.histogram(name) if metrics is not None else None)
+            if metrics is not None:
+                metrics.add_gauge(name + ".overruns", lambda r=runner: r.overruns)
+                metrics.add_gauge(name + ".skipped_frames", lambda r=runner: r.skipped_frames)
+                for gauge, read in postprocessor.gauges().items():
+                    metrics.add_gauge(name + "." + gauge, read)
+            self.runners.append(runner)
+
+    async def postprocess(self, data: List[Any], frame: ndarray) -> NoReturn:
+        if self.started is not None:
+            logging.info("First frame reached the postprocessors {:.2f}s after startup".format(
+                time.monotonic() - self.started))
+            self.started = None
+        waits = []
+        try:
+            for runner in self.runners:
+                if not runner.enabled:
+                    continue
+                future = runner.submit(data, frame)
+                if future is None:
+                    logging.debug("Skipping frame for busy postprocessor " + runner.name)
+                    continue
+                waits.append(self._wait(runner, asyncio.wrap_future(future)))
+            await asyncio.gather(*waits)
+        except ShutdownRequested:
+            raise KeyboardInterrupt
+
+    @staticmethod
+    async def _wait(runner: PostProcessorRunner, future: asyncio.Future) -> NoReturn:
+        done, _ = await asyncio.wait({future}, timeout=runner.deadline)
+        if not done:
+            runner.overruns += 1
+            # log the first overrun and then every 100th, so a postprocessor that is always late can't flood the log
+            if runner.overruns % 100 == 1:
+                logging.warning("Postprocessor {} missed its {}s deadline ({} overruns)".format(
+                    runner.name, runner.deadline, runner.overruns))
+            return
+        runner.collect()
+
+    def set_enabled(self, postprocessor: PostProcessorBase, enabled: bool) -> NoReturn:
+        """ Starts or stops giving frames to a postprocessor.
+        """
+        for runner in self.runners:
+            if runner.postprocessor is postprocessor and runner.enabled != enabled:
+                runner.enabled = enabled
+                logging.info("Postprocessor {} {}".format(runner.name, "enabled" if enabled else "disabled"))
+
+    def stop(self) -> NoReturn:
+        for runner in self.runners:
+            runner.stop()
+            logging.info("Postprocessor {}: {} overruns, {} skipped frames".format(
+                runner.name, runner.overruns, runner.skipped_frames))
@@ -1,23 +1,34 @@
 from typing import Any, NoReturn, List
 from numpy import ndarray
 import xml.etree.ElementTree as ElementTree
-import cv2
 
 from base_classes import PostProcessorBase
 
+# imported in setup(), so that importing this module doesn't load OpenCV
+cv2 = None
+
 
 class DisplayPostProcessor(PostProcessorBase):
     """
-    Outputs frames to the screen, optionally drawing the detected objects on the screen.
+    Outputs frames to the screen, optionally drawing the detected objects on the screen. With several cameras, each
+    camera's frames are shown in their own window.
+
+    Runs on the main thread, since HighGUI windows can't be used from other threads on several platforms (e.g.
+    macOS and some Qt builds).
     
     Configuration info:
     
     - `Annotate`: If set to true, the location of detected objects will be drawn onto each frame.
     """
     
+    main_thread = True
+
     annotate = bool()
     
     async def setup(self, component_config_root: ElementTree.Element):
+        # imported here so that the import is only paid for when this postprocessor is configured
+        global cv2
+        import cv2
         self.annotate = component_config_root.find("Annotate").text in \
                         ['true', '1', 't', 'y', 'yes']
     
@@ -27,9 +38,12 @@ class DisplayPostProcessor(PostProcessorBase):
     async def postprocess(self, data: List[Any], frame: ndarray) -> NoReturn:
         output_frame = frame
         if self.annotate:
+            # other postprocessors receive the same frame at the same time, so draw on a copy
+            output_frame = frame.copy()
             for i in data:
-                cv2.rectangle(frame, (i.rect[0], i.rect[1]), (i.rect[2], i.rect[3]), (0, 255, 0), 2)
-                cv2.putText(frame, str(i.angle), (int(i.x), int(i.y)), cv2.FONT_HERSHEY_SIMPLEX, 2, (255, 0, 0), 2, cv2.LINE_AA)
+                cv2.rectangle(output_frame, (i.rect[0], i.rect[1]), (i.rect[2], i.rect[3]), (0, 255, 0), 2)
+                cv2.putText(output_frame, str(i.angle), (int(i.x), int(i.y)), cv2.FONT_HERSHEY_SIMPLEX, 2, (255, 0, 0), 2, cv2.LINE_AA)
         
-        cv2.imshow("display", output_frame)
+        camera = getattr(data, "camera", "")
+        cv2.imshow("display " + camera if camera else "display", output_frame)
         cv2.waitKey(1)
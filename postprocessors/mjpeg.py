@@ -0,0 +1,300 @@
+from typing import Any, Dict, NoReturn, List, Optional, Set, Tuple
+from numpy import ndarray
+from urllib.parse import unquote, urlsplit
+import asyncio
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+import logging
+
+from base_classes import PostProcessorBase
+
+# imported in setup(), so that importing this module doesn't load OpenCV
+cv2 = None
+
+
+class MjpegPostProcessor(PostProcessorBase):
+    """
+    Streams frames to web browsers as MJPEG over HTTP, for previews on the driver station. Open
+    `http://<coprocessor address>:<Port>/` in a browser to watch. With several cameras, every camera has its own
+    stream at `/<camera tag>` (e.g. `/front`), and `/` streams the first camera that produced a frame.
+
+    `postprocess()` never waits: it hands the newest frame to a background encoder thread, which JPEG-encodes it at
+    most once and shares the same bytes with every viewer. Nothing is encoded for a camera while no viewers are
+    watching it. A viewer that falls behind skips frames instead of building up a backlog.
+
+    When a frame takes longer than `EncodeBudget` to encode, or a viewer can't keep up, the JPEG quality is lowered
+    (down to `MinQuality`) and then the frames are downscaled (down to `MinScale`). Once there is headroom again,
+    the scale and quality are stepped back up.
+
+    Configuration info:
+
+    - `Port`: The port number of the HTTP server. Ports 5800-5810 are open on the field network.
+
+    - `MaxFPS` (optional, default 15): The highest rate at which each camera's frames are streamed, independent of
+    the pipeline's frame rate.
+
+    - `Quality` (optional, default 70): The JPEG quality (0-100) to use when there is enough headroom.
+
+    - `MinQuality` (optional, default 30): The lowest JPEG quality the stream is lowered to.
+
+    - `Scale` (optional, default 1): The factor frames are resized by when there is enough headroom.
+
+    - `MinScale` (optional, default 0.25): The smallest factor frames are resized by.
+
+    - `EncodeBudget` (optional, default 15): The number of milliseconds encoding a frame may take before the quality
+    or size is lowered.
+
+    - `MaxClientBuffer` (optional, default 131072): The number of bytes that may be waiting to be sent to a single
+    viewer before it is considered to be falling behind.
+
+    - `Annotate` (optional, default false): If set to true, the location of detected objects will be drawn onto each
+    streamed frame.
+    """
+    BOUNDARY = b"frame"
+    QUALITY_STEP = 10
+    SCALE_STEP = 0.75
+    # frames in a row with headroom before the scale or quality is stepped back up
+    HEADROOM_FRAMES = 30
+
+    port = int()
+    max_fps = float()
+    max_quality = int()
+    min_quality = int()
+    max_scale = float()
+    min_scale = float()
+    encode_budget = float()
+    max_client_buffer = int()
+    annotate = bool()
+
+    server = None
+    loop = None
+    quality = int()
+    scale = float()
+    encoded_frames = 0
+
+    # by camera tag; "" is the stream at `/`
+    _streams = None  # type: Dict[str, _Stream]
+    _streams_lock = None  # type: threading.Lock
+    # the camera streamed at `/`
+    _default_camera = None  # type: Optional[str]
+    _client_tasks = None  # type: Set[asyncio.Task]
+    _backlogged_clients = 0
+    _encoder_thread = None
+    _frame_condition = None
+    # the newest frame of every camera that the encoder hasn't started on yet
+    _pending = None  # type: Dict[str, Tuple[List[Any], ndarray]]
+    _running = False
+    _headroom_frames = 0
+
+    async def setup(self, component_config_root: ElementTree.Element):
+        # imported here so that the import is only paid for when this postprocessor is configured
+        global cv2
+        import cv2
+        self.port = int(component_config_root.find("Port").text)
+        self.max_fps = float(component_config_root.findtext("MaxFPS", "15"))
+        self.max_quality = int(component_config_root.findtext("Quality", "70"))
+        self.min_quality = int(component_config_root.findtext("MinQuality", "30"))
+        self.max_scale = float(component_config_root.findtext("Scale", "1"))
+        self.min_scale = float(component_config_root.findtext("MinScale", "0.25"))
+        self.encode_budget = float(component_config_root.findtext("EncodeBudget", "15")) / 1000
+        self.max_client_buffer = int(component_config_root.findtext("MaxClientBuffer", "131072"))
+        self.annotate = component_config_root.findtext("Annotate", "false") in ['true', '1', 't', 'y', 'yes']
+        self.quality = self.max_quality
+        self.scale = self.max_scale
+
+        self.loop = asyncio.get_event_loop()
+        self._streams = dict()
+        self._streams_lock = threading.Lock()
+        self._pending = dict()
+        self._client_tasks = set()
+        self.server = await asyncio.start_server(self._handle_client, "0.0.0.0", self.port, reuse_address=True)
+        logging.debug("Streaming MJPEG on port " + str(self.port))
+
+        self._frame_condition = threading.Condition()
+        self._running = True
+        self._encoder_thread = threading.Thread(target=self._encode_loop, name="mjpeg-encoder", daemon=True)
+        self._encoder_thread.start()
+
+    async def cleanup(self):
+        with self._frame_condition:
+            self._running = False
+            self._frame_condition.notify()
+        self._encoder_thread.join(1)
+        self.server.close()
+        for task in self._client_tasks:
+            task.cancel()
+        await asyncio.gather(*self._client_tasks, return_exceptions=True)
+        await self.server.wait_closed()
+        logging.info("MJPEG: encoded {} frames, final scale {:.2f}, quality {}".format(
+            self.encoded_frames, self.scale, self.quality))
+
+    async def postprocess(self, data: List[Any], frame: ndarray) -> NoReturn:
+        camera = getattr(data, "camera", "")
+        if self._default_camera is None:
+            self._default_camera = camera
+        streams = [self._stream(name) for name in self._stream_names(camera)]
+        if not any(stream.viewers > 0 for stream in streams):
+            return
+        now = time.monotonic()
+        if now - streams[0].last_submitted < 1 / self.max_fps:
+            return
+        streams[0].last_submitted = now
+        with self._frame_condition:
+            # replaces a frame of the same camera the encoder hasn't started on yet, so the encoder never falls behind
+            self._pending[camera] = (data, frame)
+            self._frame_condition.notify()
+
+    def _stream(self, name: str) -> "_Stream":
+        with self._streams_lock:
+            stream = self._streams.get(name)
+            if stream is None:
+                stream = self._streams[name] = _Stream(self.loop)
+            return stream
+
+    def _stream_names(self, camera: str) -> List[str]:
+        # the first camera is also streamed at `/`
+        return [camera, ""] if camera and camera == self._default_camera else [camera]
+
+    def _encode_loop(self) -> NoReturn:
+        while True:
+            with self._frame_condition:
+                while self._running and not self._pending:
+                    self._frame_condition.wait()
+                if not self._running:
+                    return
+                # the cameras take turns, since a camera's newest frame keeps its place while it is replaced
+                camera = next(iter(self._pending))
+                data, frame = self._pending.pop(camera)
+
+            try:
+                start = time.perf_counter()
+                jpeg = self.encode(data, frame)
+                encode_time = time.perf_counter() - start
+            except Exception as e:
+                logging.error("MJPEG: failed to encode frame: " + str(e))
+                continue
+            self.encoded_frames += 1
+            part = (b"--" + self.BOUNDARY + b"\r\nContent-Type: image/jpeg\r\nContent-Length: " +
+                    str(len(jpeg)).encode("ascii") + b"\r\n\r\n" + jpeg + b"\r\n")
+            self.loop.call_soon_threadsafe(self._publish, camera, part)
+            self._adapt(encode_time)
+
+    def encode(self, data: List[Any], frame: ndarray) -> bytes:
+        """ Resizes, annotates and JPEG-encodes a frame with the current scale and quality.
+        """
+        scale = self.scale
+        if scale != 1:
+            # resizing makes a new image, so annotations never touch the frame other postprocessors receive
+            output_frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        else:
+            output_frame = frame.copy() if self.annotate else frame
+        if self.annotate:
+            for i in data:
+                cv2.rectangle(output_frame, (int(i.rect[0] * scale), int(i.rect[1] * scale)),
+                              (int(i.rect[2] * scale), int(i.rect[3] * scale)), (0, 255, 0), 2)
+                cv2.putText(output_frame, "{:.1f}".format(i.angle), (int(i.x * scale), int(i.y * scale)),
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 0, 0), 1, cv2.LINE_AA)
+        ok, jpeg = cv2.imencode(".jpg", output_frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        if not ok:
+            raise ValueError("cv2.imencode failed")
+        return jpeg.tobytes()
+
+    def _adapt(self, encode_time: float) -> NoReturn:
+        if encode_time > self.encode_budget or self._backlogged_clients > 0:
+            self._headroom_frames = 0
+            if self.quality > self.min_quality:
+                self.quality = max(self.min_quality, self.quality - self.QUALITY_STEP)
+            elif self.scale > self.min_scale:
+                self.scale = max(self.min_scale, self.scale * self.SCALE_STEP)
+            else:
+                return
+        elif encode_time < self.encode_budget / 2:
+            self._headroom_frames += 1
+            if self._headroom_frames < self.HEADROOM_FRAMES:
+                return
+            self._headroom_frames = 0
+            if self.scale < self.max_scale:
+                self.scale = min(self.max_scale, self.scale / self.SCALE_STEP)
+            elif self.quality < self.max_quality:
+                self.quality = min(self.max_quality, self.quality + self.QUALITY_STEP)
+            else:
+                return
+        else:
+            return
+        logging.debug("MJPEG: now streaming at scale {:.2f}, quality {} (last encode took {:.1f}ms)".format(
+            self.scale, self.quality, encode_time * 1000))
+
+    def _publish(self, camera: str, part: bytes) -> NoReturn:
+        for name in self._stream_names(camera):
+            stream = self._stream(name)
+            stream.latest_part = part
+            stream.part_version += 1
+            published, stream.part_published = stream.part_published, self.loop.create_future()
+            published.set_result(None)
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> NoReturn:
+        task = asyncio.current_task() if hasattr(asyncio, "current_task") else asyncio.Task.current_task()
+        self._client_tasks.add(task)
+        sender = None
+        stream = None
+        try:
+            # read the request line, whose path selects the camera, and skip the headers
+            request = (await asyncio.wait_for(reader.readline(), 5)).split()
+            line = b"-"
+            while line not in (b"\r\n", b"\n", b""):
+                line = await asyncio.wait_for(reader.readline(), 5)
+            path = request[1].decode("utf-8", "replace") if len(request) > 1 else "/"
+            stream = self._stream(unquote(urlsplit(path).path).strip("/"))
+            stream.viewers += 1
+            logging.debug("MJPEG viewer connected from {} to {}".format(writer.get_extra_info("peername"), path))
+            writer.transport.set_write_buffer_limits(high=self.max_client_buffer)
+            writer.write(b"HTTP/1.0 200 OK\r\nCache-Control: no-cache\r\nConnection: close\r\n"
+                         b"Content-Type: multipart/x-mixed-replace; boundary=" + self.BOUNDARY + b"\r\n\r\n")
+            sender = asyncio.ensure_future(self._send_parts(writer, stream))
+            # viewers don't send anything else; this returns when they disconnect
+            while await reader.read(1024):
+                pass
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        except asyncio.CancelledError:
+            # cancelled by cleanup(); finishing normally keeps asyncio from logging the cancellation as an error
+            pass
+        finally:
+            if sender is not None:
+                sender.cancel()
+            if stream is not None:
+                stream.viewers -= 1
+            self._client_tasks.discard(task)
+            writer.close()
+
+    async def _send_parts(self, writer: asyncio.StreamWriter, stream: "_Stream") -> NoReturn:
+        sent_version = stream.part_version
+        try:
+            while True:
+                if sent_version == stream.part_version:
+                    # shielded: cancelling this sender when its viewer leaves must not cancel the shared future
+                    await asyncio.shield(stream.part_published)
+                sent_version = stream.part_version
+                writer.write(stream.latest_part)
+                if writer.transport.get_write_buffer_size() > self.max_client_buffer:
+                    # the viewer can't keep up; newer frames replace latest_part while it catches up
+                    self._backlogged_clients += 1
+                    try:
+                        await writer.drain()
+                    finally:
+                        self._backlogged_clients -= 1
+        except ConnectionError:
+            pass
+
+
+class _Stream:
+    """ The newest encoded frame of one camera, and how many viewers are watching it. Only changed on the event loop,
+    except for `last_submitted`, which only postprocess() uses.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.latest_part = b""
+        self.part_version = 0
+        self.part_published = loop.create_future()
+        self.viewers = 0
+        self.last_submitted = 0.0
@@ -1,70 +1,196 @@
-from typing import Any, NoReturn, List
+from typing import Any, Callable, Dict, NoReturn, List
 from numpy import ndarray
-from networktables import NetworkTables
-import asyncio
 import xml.etree.ElementTree as ElementTree
 import logging
+import time
+import numpy
 
-from base_classes import PostProcessorBase
+from base_classes import PostProcessorBase, Detections
 
 
 class NetworkTablesPostProcessor(PostProcessorBase):
     """
     Outputs data to a NetworkTables server.
-    
+
     The following keys will be defined in the table:
-    
-    - `vision_value` (number): The first data point returned by the processor.
-    
+
+    - `vision_detections` (number array): Every detected object, as 6 numbers each: the `x1, y1, x2, y2` corners of
+    its rect, its angle and its score. An empty array means nothing was detected.
+
+    - `vision_sequence` (number): The sequence number of the frame `vision_detections` was detected in. It increases
+    with every frame, so the robot can tell new results from old ones.
+
+    - `vision_timestamp` (number): The wall-clock time (in seconds since the epoch) at which that frame was captured.
+
+    - `vision_value` (number): The angle of the first detected object.
+
     - `vision_new_value` (boolean): If true, the value has been updated. If you use this, make sure to set this to
     false after reading it on the server side.
-    
+
     - `vision_shutdown` (boolean): If true, this program will shut down. You can use this to properly clean everything
     up before shutting the robot off.
-    
+
+    With several cameras, the results of each camera are written to a subtable named after its camera tag (e.g.
+    `SmartDashboard/front/vision_detections`) instead, with the same keys except `vision_shutdown`, which stays in the
+    output table.
+
+    Setup does not wait for the server. The client connects (and reconnects) in the background, and values written
+    before then are sent as soon as it is connected, so frames are processed from startup onwards. `vision_shutdown`
+    is watched with a listener, so nothing is read from the table per frame. It is reset to false every time the
+    client connects, and only a change to true after that shuts this program down, so a value left over on the server
+    from an earlier run is ignored.
+
+    Results that differ from the last published ones by less than `Epsilon` are not written. The sequence number and
+    timestamp are still written every `Heartbeat` seconds, so the robot can tell that the results are current.
+
     Configuration info:
-    
+
     - `IP`: The IP address of the NetworkTables server. When connected to the RoboRIO, this should be set to
     `roboRIO-####-FRC.local` where #### is your team number.
-    
+
     - `OutputTable`: The table to output data to. For most teams, this should be set to `SmartDashboard`.
-    
+
     - `FlushOnUpdate`: If true, the client will flush all data immediately. This may reduce latency between the client
     and server.
+
+    - `MaxFlushRate` (optional, default 50): The most flushes per second when `FlushOnUpdate` is set. An update that
+    comes too soon after the last flush is flushed with the next frame instead (or by the client's own periodic
+    update, whichever comes first).
+
+    - `Epsilon` (optional, default 0.01): The smallest change in any published number that is written to the table.
+    A change in the number of detected objects is always written. Set this to 0 to only skip identical results.
+
+    - `Heartbeat` (optional, default 0.5): The longest time in seconds between writes of `vision_sequence` and
+    `vision_timestamp`.
     """
+    DETECTION_FIELDS = 6
+
     ip = str()
     output_table = str()
     flush_on_update = bool()
-    
-    smart_dashboard = None
-    
+    max_flush_rate = float()
+    epsilon = float()
+    heartbeat = float()
+
+    network_tables = None
+    table = None
+    shutdown_requested = False
+    connected = False
+    _shutdown_armed = False
+
+    published_frames = 0
+    skipped_writes = 0
+    flushes = 0
+
+    _cameras = None  # type: Dict[str, _CameraEntries]
+    _last_flush = 0.0
+    _flush_pending = False
+
     async def setup(self, component_config_root: ElementTree.Element):
+        # imported here so that the import is only paid for when this postprocessor is configured
+        from networktables import NetworkTables
+        self.network_tables = NetworkTables
+
         self.ip = component_config_root.find("IP").text
         self.output_table = component_config_root.find("OutputTable").text
         self.flush_on_update = component_config_root.find("FlushOnUpdate").text in \
             ['true', '1', 't', 'y', 'yes']
-        
+        self.max_flush_rate = float(component_config_root.findtext("MaxFlushRate", "50"))
+        self.epsilon = float(component_config_root.findtext("Epsilon", "0.01"))
+        self.heartbeat = float(component_config_root.findtext("Heartbeat", "0.5"))
+
         logging.info("Connecting to {}...".format(self.ip))
         NetworkTables.initialize(server=self.ip)
-        self.smart_dashboard = NetworkTables.getTable("SmartDashboard")
-        while not NetworkTables.isConnected():
-            logging.debug("waiting...")
-            await asyncio.sleep(1)
-        logging.debug("Connected!")
-        self.smart_dashboard.putBoolean("vision_new_value", False)
-        self.smart_dashboard.putNumber("vision_value", 0)
-        self.smart_dashboard.putBoolean("vision_shutdown", False)
-
-    # noinspection PyMethodMayBeStatic
+        self.table = NetworkTables.getTable(self.output_table)
+        self.table.addEntryListener(self._shutdown_changed, immediateNotify=False, key="vision_shutdown")
+        self._cameras = dict()
+        NetworkTables.addConnectionListener(self._connection_changed, immediateNotify=True)
+
     async def cleanup(self):
-        NetworkTables.shutdown()
-    
+        self.network_tables.shutdown()
+        logging.info("NetworkTables: published {} frames, skipped {} unchanged writes, {} flushes".format(
+            self.published_frames, self.skipped_writes, self.flushes))
+
+    def gauges(self) -> Dict[str, Callable[[], Any]]:
+        return {
+            "connected": lambda: self.connected,
+            "published_frames": lambda: self.published_frames,
+            "skipped_writes": lambda: self.skipped_writes,
+            "flushes": lambda: self.flushes,
+        }
+
     async def postprocess(self, data: List[Any], frame: ndarray) -> NoReturn:
-        if self.smart_dashboard.getBoolean("vision_shutdown", False):
+        if self.shutdown_requested:
             raise KeyboardInterrupt
-        
-        if len(data) != 0:
-            self.smart_dashboard.putNumber("vision_value", data[0].angle)
-            self.smart_dashboard.putBoolean("vision_new_value", True)
-            if self.flush_on_update:
-                NetworkTables.flush()
+
+        if not isinstance(data, Detections):
+            data = Detections.from_rects(numpy.array([i.rect for i in data]), frame.shape[1])
+        values = numpy.empty((len(data), self.DETECTION_FIELDS))
+        values[:, 0:4] = data.array["rect"]
+        values[:, 4] = data.array["angle"]
+        values[:, 5] = data.array["score"]
+        values = values.ravel()
+
+        camera = self._cameras.get(data.camera)
+        if camera is None:
+            camera = _CameraEntries(self.table.getSubTable(data.camera) if data.camera else self.table)
+            self._cameras[data.camera] = camera
+
+        now = time.monotonic()
+        changed = len(values) != len(camera.last_values) or \
+            (len(values) > 0 and numpy.max(numpy.abs(values - camera.last_values)) > self.epsilon)
+        if changed:
+            camera.entries["vision_detections"].setDoubleArray(values.tolist())
+            if len(data) != 0:
+                camera.entries["vision_value"].setDouble(float(values[4]))
+                camera.entries["vision_new_value"].setBoolean(True)
+            camera.last_values = values
+        else:
+            self.skipped_writes += 1
+        if changed or now - camera.last_write >= self.heartbeat:
+            camera.entries["vision_sequence"].setDouble(data.frame_sequence)
+            camera.entries["vision_timestamp"].setDouble(data.frame_timestamp)
+            camera.last_write = now
+            self.published_frames += 1
+            self._flush_pending = self.flush_on_update
+
+        if self._flush_pending and now - self._last_flush >= 1 / self.max_flush_rate:
+            self.network_tables.flush()
+            self._last_flush = now
+            self._flush_pending = False
+            self.flushes += 1
+
+    def _connection_changed(self, connected: bool, info) -> NoReturn:
+        self.connected = connected
+        if connected:
+            logging.info("Connected to NetworkTables server {}".format(info.remote_ip))
+            # the server's values win when connecting, so this is only reset once connected
+            self.table.getEntry("vision_shutdown").setBoolean(False)
+            self._shutdown_armed = True
+        else:
+            self._shutdown_armed = False
+            logging.warning("Disconnected from NetworkTables server, reconnecting in the background")
+
+    def _shutdown_changed(self, source, key: str, value: Any, is_new: bool) -> NoReturn:
+        # the server's old value can still be notified after the reset, by which time the entry holds false again
+        if value and self._shutdown_armed and self.table.getEntry("vision_shutdown").getBoolean(False):
+            logging.info("Shutdown requested through NetworkTables")
+            self.shutdown_requested = True
+
+
+class _CameraEntries:
+    """ The entries one camera's results are written to, and the last values
+        written to them.
+    """
+    def __init__(self, table):
+        # entries are looked up once, so each write is a single local update
+        self.entries = {key: table.getEntry(key) for key in
+                        ("vision_detections", "vision_sequence", "vision_timestamp", "vision_value",
+                         "vision_new_value")}
+        self.entries["vision_detections"].setDoubleArray([])
+        self.entries["vision_sequence"].setDouble(0)
+        self.entries["vision_timestamp"].setDouble(0)
+        self.entries["vision_new_value"].setBoolean(False)
+        self.entries["vision_value"].setDouble(0)
+        self.last_values = numpy.empty(0)
+        self.last_write = 0.0
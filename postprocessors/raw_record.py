@@ -0,0 +1,133 @@
+from typing import Any, Callable, Dict, NoReturn, List, Optional
+from numpy import ndarray
+import xml.etree.ElementTree as ElementTree
+import threading
+import logging
+import queue
+import time
+import os
+import numpy
+
+from base_classes import PostProcessorBase, Detections
+from raw_capture import RawCaptureWriter
+
+
+class RawRecordPostProcessor(PostProcessorBase):
+    """
+    Records uncompressed frames together with their sequence numbers, capture times and detections in the raw
+    capture format (see `raw_capture.py`). Captures can be replayed without any decoding by the `raw_replay` frame
+    generator, which makes them useful for regression tests and tuning.
+
+    Raw frames are large (about 0.9 MB per 640x480 frame), so make sure there is enough disk space. Like `record`,
+    frames are written by a background thread.
+
+    Configuration info:
+
+    - `FileName`: The path to write the capture to. Unless `Timestamp` is false, the time recording started is added
+    to the name, e.g. `recordings/capture.raw` becomes `recordings/capture_20190315-141502.raw`. The `raw_replay`
+    frame generator replays the newest of these when it is given the name without the time. With several cameras,
+    every camera is recorded to its own capture, with its camera tag added before the time, e.g.
+    `recordings/capture_front_20190315-141502.raw` (which `raw_replay` finds as `recordings/capture_front.raw`).
+
+    - `Timestamp` (optional, default true): If set to false, the capture is written to `FileName` exactly,
+    replacing any earlier capture there.
+
+    - `QueueSize` (optional, default 30): The number of frames that may wait for the writer thread.
+
+    - `DropPolicy` (optional, default `drop-oldest`): What happens when the queue is full. `drop-oldest` discards the
+    oldest waiting frame; `block` waits for the writer thread to catch up, so no frames are lost.
+    """
+    DROP_OLDEST = "drop-oldest"
+    BLOCK = "block"
+
+    file_name = str()
+    timestamp = bool()
+    queue_size = int()
+    drop_policy = str()
+    # by camera tag, opened when the camera's first frame arrives
+    writers = None  # type: Dict[str, RawCaptureWriter]
+
+    dropped_frames = 0
+    max_queue_depth = 0
+
+    _queue = None  # type: queue.Queue
+    _writer_thread = None
+    _recording_start = str()
+
+    async def setup(self, component_config_root: ElementTree.Element):
+        self.file_name = component_config_root.find("FileName").text
+        self.timestamp = component_config_root.findtext("Timestamp", "true") in ['true', '1', 't', 'y', 'yes']
+        self._recording_start = time.strftime("%Y%m%d-%H%M%S")
+        self.queue_size = int(component_config_root.findtext("QueueSize", "30"))
+        self.drop_policy = component_config_root.findtext("DropPolicy", self.DROP_OLDEST).lower()
+        if self.drop_policy not in (self.DROP_OLDEST, self.BLOCK):
+            raise ValueError("DropPolicy must be one of: drop-oldest, block")
+
+        directory = os.path.dirname(self.file_name)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.writers = dict()
+        self._queue = queue.Queue(self.queue_size)
+        self._writer_thread = threading.Thread(target=self._write_loop, name="raw-record-writer", daemon=True)
+        self._writer_thread.start()
+
+    async def cleanup(self):
+        self._queue.put(None)
+        self._writer_thread.join()
+        for writer in self.writers.values():
+            writer.close()
+            logging.info("Recorded {} raw frames to {}".format(writer.frame_count, writer.file_name))
+        logging.info("Raw recording dropped {} frames, max queue depth {}".format(self.dropped_frames,
+                                                                                 self.max_queue_depth))
+
+    def gauges(self) -> Dict[str, Callable[[], Any]]:
+        return {
+            "written_frames": lambda: sum(writer.frame_count for writer in list(self.writers.values())),
+            "dropped_frames": lambda: self.dropped_frames,
+            "queue_depth": lambda: self._queue.qsize(),
+            "max_queue_depth": lambda: self.max_queue_depth,
+        }
+
+    async def postprocess(self, data: List[Any], frame: ndarray) -> NoReturn:
+        if not isinstance(data, Detections):
+            data = Detections.from_rects(numpy.array([i.rect for i in data]), frame.shape[1])
+        item = (data, frame)
+        if self.drop_policy == self.BLOCK:
+            self._queue.put(item)
+        else:
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                    self.dropped_frames += 1
+                except queue.Empty:
+                    pass
+                self._queue.put_nowait(item)
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+
+    def _write_loop(self) -> NoReturn:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            data, frame = item
+            try:
+                writer = self._writer(data.camera)
+                if not writer.write(frame, data.frame_sequence, data.frame_timestamp or time.time(), data):
+                    logging.warning("Skipping frame of shape {} in a capture of shape {}".format(
+                        frame.shape, writer.frame_shape))
+            except Exception as e:
+                logging.error("Failed to record raw frame: " + str(e))
+
+    def _writer(self, camera: str) -> RawCaptureWriter:
+        writer = self.writers.get(camera)  # type: Optional[RawCaptureWriter]
+        if writer is None:
+            stem, extension = os.path.splitext(self.file_name)
+            if camera:
+                stem += "_" + camera
+            if self.timestamp:
+                stem += "_" + self._recording_start
+            writer = self.writers[camera] = RawCaptureWriter(stem + extension)
+            logging.debug("Recording raw frames to " + writer.file_name)
+        return writer
@@ -1,54 +1,211 @@
-from typing import Any, NoReturn, List
+from typing import Any, Callable, Dict, NoReturn, List, Optional, Tuple
 from numpy import ndarray
 import xml.etree.ElementTree as ElementTree
-import cv2
+import threading
+import logging
+import queue
+import time
+import os
 
 from base_classes import PostProcessorBase
 
+# imported in setup(), so that importing this module doesn't load OpenCV
+cv2 = None
+
 
 class RecordPostProcessor(PostProcessorBase):
     """
-    Records frames to a video file.
+    Records frames to a series of video files.
+
+    `postprocess()` only puts frames into a bounded queue; a background writer thread resizes, annotates and encodes
+    them. The recording is split into segments, so if the program crashes, at most the segment being written is lost.
+    Segments are named after `FileName` with the time recording started and a segment number added, e.g.
+    `recordings/record_20190315-141502_001.avi`. With several cameras, every camera is recorded to its own series of
+    segments, with its camera tag added after `FileName`, e.g. `recordings/record_front_20190315-141502_001.avi`.
 
     Configuration info:
 
     - `FileName`: The path to the video file to write to.
 
-    - `ForceOutputSize`: If set to true, frames are resized to the size specified by `ForceOutputWidth` and
-    `ForceOutputHeight`.
+    - `ForceOutputSize`: If set to true, frames are resized to the size specified by `ForcedOutputWidth` and
+    `ForcedOutputHeight`. Otherwise, frames are recorded at the size they were captured at.
+
+    - `ForcedOutputWidth`: If `ForceOutputSize` is set to true, frames are resized to this width.
 
-    - `ForceOutputWidth`: If `ForceOutputSize` is set to true, frames are resized to this width.
+    - `ForcedOutputHeight`: If `ForceOutputSize` is set to true, frames are resized to this height.
 
-    - `ForceOutputHeight`: If `ForceOutputHeight` is set to true, frames are resized to this height.
-    
     - `TargetFPS`: The frame rate to play video back at. It's recommended to set this to whatever number you used
     for the frame generator.
 
     - `Annotate`: If set to true, output rectangles will be drawn in the output video.
+
+    - `QueueSize` (optional, default 30): The number of frames that may wait for the writer thread.
+
+    - `DropPolicy` (optional, default `drop-oldest`): What happens when the queue is full. `drop-oldest` discards the
+    oldest waiting frame so the vision loop never waits; `block` waits for the writer thread to catch up, so no frames
+    are lost.
+
+    - `SegmentDuration` (optional, default 60): The number of seconds of video after which a new segment is started.
+    0 disables this.
+
+    - `SegmentSize` (optional, default 0): The size in megabytes after which a new segment is started. 0 disables
+    this.
     """
+    DROP_OLDEST = "drop-oldest"
+    BLOCK = "block"
+    # how often (in frames) the size of the current segment is checked
+    SIZE_CHECK_INTERVAL = 30
+
     file_name = str()
+    force_output_size = bool()
     output_width = int()
     output_height = int()
     target_fps = int()
     annotate = bool()
-    out = None
-    
+    queue_size = int()
+    drop_policy = str()
+    segment_duration = float()
+    segment_size = int()
+
+    written_frames = 0
+    dropped_frames = 0
+    max_queue_depth = 0
+    segments = 0
+
+    _queue = None  # type: queue.Queue
+    _writer_thread = None
+    # by camera tag; only used by the writer thread
+    _recordings = None  # type: Dict[str, _Recording]
+    _recording_start = str()
+
     async def setup(self, component_config_root: ElementTree.Element):
+        # imported here so that the import is only paid for when this postprocessor is configured
+        global cv2
+        import cv2
         self.file_name = component_config_root.find("FileName").text
+        self.force_output_size = component_config_root.findtext("ForceOutputSize", "false") in \
+            ['true', '1', 't', 'y', 'yes']
         self.output_width = int(component_config_root.find("ForcedOutputWidth").text)
         self.output_height = int(component_config_root.find("ForcedOutputHeight").text)
         self.target_fps = int(component_config_root.find("TargetFPS").text)
         self.annotate = component_config_root.find("Annotate").text in ['true', '1', 't', 'y', 'yes']
-        
-        self.out = cv2.VideoWriter(self.file_name, cv2.VideoWriter_fourcc(*"XVID"), self.target_fps,
-                                   (self.output_width, self.output_height))
-    
+        self.queue_size = int(component_config_root.findtext("QueueSize", "30"))
+        self.drop_policy = component_config_root.findtext("DropPolicy", self.DROP_OLDEST).lower()
+        if self.drop_policy not in (self.DROP_OLDEST, self.BLOCK):
+            raise ValueError("DropPolicy must be one of: drop-oldest, block")
+        self.segment_duration = float(component_config_root.findtext("SegmentDuration", "60"))
+        self.segment_size = int(float(component_config_root.findtext("SegmentSize", "0")) * 1024 * 1024)
+
+        directory = os.path.dirname(self.file_name)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._recording_start = time.strftime("%Y%m%d-%H%M%S")
+        self._recordings = dict()
+        self._queue = queue.Queue(self.queue_size)
+        self._writer_thread = threading.Thread(target=self._write_loop, name="record-writer", daemon=True)
+        self._writer_thread.start()
+
     async def cleanup(self):
-        self.out.release()
-    
+        # the writer thread finishes the frames already queued before it stops
+        self._queue.put(None)
+        self._writer_thread.join()
+        logging.info("Recorded {} frames in {} segments, dropped {} frames, max queue depth {}".format(
+            self.written_frames, self.segments, self.dropped_frames, self.max_queue_depth))
+
+    def gauges(self) -> Dict[str, Callable[[], Any]]:
+        return {
+            "written_frames": lambda: self.written_frames,
+            "dropped_frames": lambda: self.dropped_frames,
+            "queue_depth": lambda: self._queue.qsize(),
+            "max_queue_depth": lambda: self.max_queue_depth,
+        }
+
     async def postprocess(self, data: List[Any], frame: ndarray) -> NoReturn:
+        item = (data, frame)
+        if self.drop_policy == self.BLOCK:
+            self._queue.put(item)
+        else:
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                    self.dropped_frames += 1
+                except queue.Empty:
+                    pass
+                self._queue.put_nowait(item)
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+
+    def _write_loop(self) -> NoReturn:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            data, frame = item
+            try:
+                self._write(data, frame)
+            except Exception as e:
+                logging.error("Failed to record frame: " + str(e))
+        for recording in self._recordings.values():
+            if recording.out is not None:
+                recording.out.release()
+
+    def _write(self, data: List[Any], frame: ndarray) -> NoReturn:
+        if self.force_output_size and (frame.shape[1], frame.shape[0]) != (self.output_width, self.output_height):
+            scale_x = self.output_width / frame.shape[1]
+            scale_y = self.output_height / frame.shape[0]
+            output_frame = cv2.resize(frame, (self.output_width, self.output_height), interpolation=cv2.INTER_AREA)
+        else:
+            scale_x = scale_y = 1
+            # other postprocessors receive the same frame at the same time, so draw on a copy
+            output_frame = frame.copy() if self.annotate and len(data) > 0 else frame
         if self.annotate:
             for i in data:
-                cv2.rectangle(frame, (i[0], i[1]), (i[2], i[3]), (0, 255, 0), 2)
+                cv2.rectangle(output_frame, (int(i.rect[0] * scale_x), int(i.rect[1] * scale_y)),
+                              (int(i.rect[2] * scale_x), int(i.rect[3] * scale_y)), (0, 255, 0), 2)
 
-        self.out.write(frame)
+        camera = getattr(data, "camera", "")
+        recording = self._recordings.get(camera)
+        if recording is None:
+            recording = self._recordings[camera] = _Recording()
+        if self._segment_finished(recording):
+            self._start_segment(recording, camera, (output_frame.shape[1], output_frame.shape[0]))
+        recording.out.write(output_frame)
+        self.written_frames += 1
+        recording.segment_frames += 1
+
+    def _segment_finished(self, recording: "_Recording") -> bool:
+        if recording.out is None:
+            return True
+        if self.segment_duration > 0 and time.monotonic() - recording.segment_start >= self.segment_duration:
+            return True
+        if self.segment_size > 0 and recording.segment_frames % self.SIZE_CHECK_INTERVAL == 0:
+            return os.path.getsize(recording.segment_file_name) >= self.segment_size
+        return False
+
+    def _start_segment(self, recording: "_Recording", camera: str, size: Tuple[int, int]) -> NoReturn:
+        if recording.out is not None:
+            recording.out.release()
+        self.segments += 1
+        recording.segments += 1
+        stem, extension = os.path.splitext(self.file_name)
+        if camera:
+            stem += "_" + camera
+        recording.segment_file_name = "{}_{}_{:03d}{}".format(stem, self._recording_start, recording.segments,
+                                                              extension)
+        recording.out = cv2.VideoWriter(recording.segment_file_name, cv2.VideoWriter_fourcc(*"XVID"),
+                                        self.target_fps, size)
+        recording.segment_start = time.monotonic()
+        recording.segment_frames = 0
+        logging.debug("Recording to " + recording.segment_file_name)
+
+
+class _Recording:
+    """ The segment one camera is being recorded to.
+    """
+    def __init__(self):
+        self.out = None
+        self.segments = 0
+        self.segment_start = 0.0
+        self.segment_frames = 0
+        self.segment_file_name = None  # type: Optional[str]
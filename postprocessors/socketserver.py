@@ -1,88 +1,133 @@
-from typing import Any, NoReturn, List
+from typing import Any, NoReturn, List, Set
 from numpy import ndarray
-import socket
-import select
+import asyncio
+import time
 import xml.etree.ElementTree as ElementTree
 import logging
-import errno
 
 from base_classes import PostProcessorBase
+import wire_protocol
 
 
 class SocketServerPostProcessor(PostProcessorBase):
     """
     Outputs data to clients as a TCP server.
 
+    The server runs on the main event loop in the background. `postprocess()` only replaces the latest message,
+    and every client is sent the newest message as soon as it can take it. A client that falls behind skips the
+    messages it missed instead of building up a backlog. Clients can send the line `shutdown` to shut the program
+    down.
+
     Configuration info:
 
     - `Port`: The port number of the TCP server. This must follow the port usage rules specified by the FRC Game
     Manual. A port number in the range 5800-5810 is recommended.
+
+    - `MaxClientBuffer` (optional, default 4096): The number of bytes that may be waiting to be sent to a single
+    client before the server stops writing to it until it catches up.
+
+    - `Protocol` (optional, default `text`): `text` sends the angle of the first detected object followed by a
+    newline, and only for frames where something was detected. With several cameras, the angle is preceded by the
+    camera tag and a space (e.g. `front 12.5`). `binary` sends a length-prefixed packet for every frame with its
+    sequence number, capture and publish times, camera tag, and the rect, angle and area of every detected object
+    (see `wire_protocol.py`).
     """
+    TEXT = "text"
+    BINARY = "binary"
+
     port = int()
+    max_client_buffer = int()
+    protocol = str()
+
+    server = None
+    loop = None
+    shutdown_requested = False
+    latest_message = b""
+    message_version = 0
 
-    sock = None
+    _message_published = None
+    _client_tasks = None  # type: Set[asyncio.Task]
 
     async def setup(self, component_config_root: ElementTree.Element):
         self.port = int(component_config_root.find("Port").text)
+        self.max_client_buffer = int(component_config_root.findtext("MaxClientBuffer", "4096"))
+        self.protocol = component_config_root.findtext("Protocol", self.TEXT).lower()
+        if self.protocol not in (self.TEXT, self.BINARY):
+            raise ValueError("Protocol must be one of: text, binary")
 
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock.bind(('0.0.0.0', self.port))
-        self.sock.listen(5)
+        self.loop = asyncio.get_event_loop()
+        self._message_published = self.loop.create_future()
+        self._client_tasks = set()
+        self.server = await asyncio.start_server(self._handle_client, "0.0.0.0", self.port, reuse_address=True)
         logging.debug("Server listening on port " + str(self.port))
-        
-        self.read_list = [self.sock]
-        self.write_list = []
 
-    # noinspection PyMethodMayBeStatic
     async def cleanup(self):
-        self.sock.close()
+        self.server.close()
+        for task in self._client_tasks:
+            task.cancel()
+        await asyncio.gather(*self._client_tasks, return_exceptions=True)
+        await self.server.wait_closed()
 
     async def postprocess(self, data: List[Any], frame: ndarray) -> NoReturn:
-        def disconnect(s: socket.socket) -> NoReturn:
-            if s in self.read_list:
-                self.read_list.remove(s)
-            if s in self.write_list:
-                self.write_list.remove(s)
-            if s in readable:
-                readable.remove(s)
-            if s in writable:
-                writable.remove(s)
-            s.close()
-        
+        if self.shutdown_requested:
+            raise KeyboardInterrupt
+
+        if self.protocol == self.BINARY:
+            # encoded once here and shared by every client
+            message = wire_protocol.encode_packet(data, getattr(data, "frame_sequence", 0),
+                                                  getattr(data, "frame_timestamp", 0.0), time.time(),
+                                                  getattr(data, "camera", ""))
+        elif len(data) > 0:
+            message = bytes(self.to_string(data[0], getattr(data, "camera", "")), "utf-8")
+        else:
+            return
+        # postprocess() may run on another thread's event loop, so hand the message over to the server's loop
+        self.loop.call_soon_threadsafe(self._publish, message)
+
+    def _publish(self, message: bytes) -> NoReturn:
+        self.latest_message = message
+        self.message_version += 1
+        # every client waits on the same future, so publishing costs the same no matter how many are connected
+        published, self._message_published = self._message_published, self.loop.create_future()
+        published.set_result(None)
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> NoReturn:
+        logging.debug("Accepted connection from " + str(writer.get_extra_info("peername")))
+        writer.transport.set_write_buffer_limits(high=self.max_client_buffer)
+        task = asyncio.current_task() if hasattr(asyncio, "current_task") else asyncio.Task.current_task()
+        self._client_tasks.add(task)
+        sender = asyncio.ensure_future(self._send_messages(writer))
         try:
-            readable, writable, errored = select.select(self.read_list, self.write_list, self.read_list, 0.02)
-        except select.error as e:
-            print(e)
-        
-        for s in errored:
-            logging.warn("exceptional condition on " + str(s.getpeername()))
-            disconnect(s)
-        
-        for s in readable:
-            if s is self.sock:
-                client_socket, address = self.sock.accept()
-                logging.debug("Accepted connection from " + str(client_socket.getpeername()))
-                client_socket.setblocking(0)
-                self.read_list.append(client_socket)
-                self.write_list.append(client_socket)
-            else:
-                data_in = s.recv(1024)
-                if data_in:
-                    if data_in.startswith(b"shutdown"):
-                        raise KeyboardInterrupt
-        
-        for s in writable:
-            if len(data) > 0:
-                message = self.to_string(data[0])
-                try:
-                    s.send(bytes(message, "utf-8"))
-                except socket.error as err:
-                    if err.errno == errno.EPIPE:
-                        logging.warn("client unexpectedly disconnected")
-                        disconnect(s)
-    
-    @staticmethod
-    def to_string(data: Any):
-        return str(data.angle) + "\n"
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.startswith(b"shutdown"):
+                    self.shutdown_requested = True
+        except ConnectionError:
+            logging.warning("client unexpectedly disconnected")
+        except asyncio.CancelledError:
+            # cancelled by cleanup(); finishing normally keeps asyncio from logging the cancellation as an error
+            pass
+        finally:
+            sender.cancel()
+            self._client_tasks.discard(task)
+            writer.close()
 
+    async def _send_messages(self, writer: asyncio.StreamWriter) -> NoReturn:
+        sent_version = self.message_version
+        try:
+            while True:
+                if sent_version == self.message_version:
+                    # shielded: cancelling this sender when its client leaves must not cancel the shared future
+                    await asyncio.shield(self._message_published)
+                sent_version = self.message_version
+                writer.write(self.latest_message)
+                # while a slow client drains, newer messages replace latest_message instead of queueing up
+                await writer.drain()
+        except ConnectionError:
+            logging.warning("client unexpectedly disconnected")
+
+    @staticmethod
+    def to_string(data: Any, camera: str = ""):
+        return (camera + " " if camera else "") + str(data.angle) + "\n"
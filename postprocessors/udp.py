@@ -0,0 +1,88 @@
+from typing import Any, NoReturn, List, Tuple
+from numpy import ndarray
+import ipaddress
+import socket
+import time
+import xml.etree.ElementTree as ElementTree
+import logging
+
+from base_classes import PostProcessorBase
+import wire_protocol
+
+
+class UdpPostProcessor(PostProcessorBase):
+    """
+    Sends every frame's results as a single UDP datagram to one or more unicast or multicast targets.
+
+    Each datagram is a `wire_protocol.py` packet (the same format the socketserver postprocessor uses with the binary
+    protocol), so it carries the frame's sequence number, capture and publish times and camera tag. Receivers should
+    ignore any packet whose sequence number is not greater than the last one they used from the same camera. Unlike
+    TCP, a lost or late datagram never delays the ones after it.
+
+    The socket is non-blocking: if a datagram cannot be sent right away it is dropped and counted, so this
+    postprocessor never stalls the main loop.
+
+    Configuration info:
+
+    - `Target`: A `host:port` address to send datagrams to. This tag can be repeated to send to several targets.
+    Multicast addresses (224.0.0.0 - 239.255.255.255) are supported. Ports 5800-5810 are open on the field network.
+
+    - `MulticastTTL` (optional, default 1): The number of network hops multicast datagrams may take. 1 keeps them on
+    the local network.
+
+    - `MulticastInterface` (optional): The IP address of the local interface to send multicast datagrams from.
+
+    - `MaxDetections` (optional, default 90): The largest number of detections sent per frame. The default keeps a
+    datagram within a single 1500 byte Ethernet frame, so it is never fragmented.
+    """
+    targets = list()  # type: List[Tuple[str, int]]
+    multicast_ttl = int()
+    multicast_interface = None
+    max_detections = int()
+
+    sock = None
+    sent_datagrams = 0
+    dropped_datagrams = 0
+    _sequence = 0
+
+    async def setup(self, component_config_root: ElementTree.Element):
+        self.targets = []
+        for target in component_config_root.findall("Target"):
+            host, port = target.text.strip().rsplit(":", 1)
+            self.targets.append((socket.gethostbyname(host), int(port)))
+        if len(self.targets) == 0:
+            raise ValueError("UdpPostProcessor needs at least one Target")
+        self.multicast_ttl = int(component_config_root.findtext("MulticastTTL", "1"))
+        self.multicast_interface = component_config_root.findtext("MulticastInterface")
+        self.max_detections = int(component_config_root.findtext("MaxDetections", "90"))
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        if any(ipaddress.ip_address(host).is_multicast for host, _ in self.targets):
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.multicast_ttl)
+            if self.multicast_interface:
+                self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                                     socket.inet_aton(self.multicast_interface))
+        logging.debug("Sending datagrams to " + ", ".join("{}:{}".format(*i) for i in self.targets))
+
+    async def cleanup(self):
+        self.sock.close()
+        logging.info("UDP: sent {} datagrams, dropped {}".format(self.sent_datagrams, self.dropped_datagrams))
+
+    async def postprocess(self, data: List[Any], frame: ndarray) -> NoReturn:
+        # processors that don't report frame sequence numbers get a counter of our own, which is still increasing
+        self._sequence += 1
+        sequence = getattr(data, "frame_sequence", 0) or self._sequence
+        packet = wire_protocol.encode_packet(data[:self.max_detections], sequence,
+                                             getattr(data, "frame_timestamp", 0.0), time.time(),
+                                             getattr(data, "camera", ""))
+        for target in self.targets:
+            try:
+                self.sock.sendto(packet, target)
+                self.sent_datagrams += 1
+            except OSError as e:
+                # BlockingIOError when the send buffer is full, or e.g. ENETUNREACH while the robot is disconnected
+                self.dropped_datagrams += 1
+                if self.dropped_datagrams % 100 == 1:
+                    logging.warning("UDP: could not send to {}:{} ({}), {} datagrams dropped".format(
+                        target[0], target[1], e, self.dropped_datagrams))
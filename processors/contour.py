@@ -1,9 +1,20 @@
-from typing import List
+from typing import Dict, List, NoReturn, Optional, Tuple
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+import multiprocessing
+import itertools
+import asyncio
+import threading
+import signal
+import queue
+import logging
 import numpy
-import cv2
 import xml.etree.ElementTree as ElementTree
 
-from base_classes import ProcessorBase, FrameData
+from base_classes import ProcessorBase, Detections
+
+# imported in load_config(), so that importing this module doesn't load OpenCV
+cv2 = None
 
 
 class ContourProcessor(ProcessorBase):
@@ -29,6 +40,44 @@ class ContourProcessor(ProcessorBase):
     - `OverlapThreshold`: A float in the range 0-1 specifying the minimum necessary percentage of overlap between
     rectangles before the non-maximum suppression algorithm combines them. Higher values will require more of an
     overlap, while lower values will merge rectangles more aggressively. 0.3-0.5 are recommended.
+    
+    - `HorizontalFOV` (optional, default 68.5): The camera's horizontal field of view in degrees, used to turn the
+    horizontal position of each object into an angle.
+
+    - `Workers` (optional, default 1): The number of worker processes that detect objects. Above 1, every frame is
+    copied into shared memory and detected in a worker, which sidesteps the GIL. `process()` still waits for its own
+    frame's result, so extra workers only raise the frame rate when several frames are processed at once: set `Mode`
+    to `pipelined` and the pipeline's `Workers` to at least this number (see `Pipeline` in config.xml). In the
+    default serial mode only one frame is in flight, and the extra workers sit idle. If a worker process exits, the
+    frames it was working on are lost and objects are detected without the workers from then on. With the pipeline's
+    `Executor` set to `process`, the frames are already detected in other processes and the worker pool isn't used.
+
+    - `RingDepth` (optional, default twice `Workers`): The number of shared memory frame slots, which is the most
+    frames that can be waiting for or inside a worker at once.
+
+    - `RoiTracking` (optional, default false): If set to true, only a window around the objects detected in the
+    last frame is scanned, as long as objects keep being found. When several frames are processed at once (e.g. by a
+    pipelined thread executor), each frame uses the window of the newest frame that has finished, and a frame that
+    finishes after a newer one doesn't move the window. With several cameras, every camera has its own window.
+    Tracking doesn't work with a process executor, where every
+    frame is processed by a fresh copy of the processor, so it is turned off there with a warning.
+
+    - `RoiPadding` (optional, default 40): The number of pixels the window extends past the last objects.
+
+    - `RoiMaxMisses` (optional, default 3): The number of frames in a row without objects after which the full
+    frame is scanned again.
+
+    - `RoiFullScanInterval` (optional, default 30): The full frame is scanned at least this often (in frames), so
+    new objects outside the window are picked up. 0 turns this off.
+
+    - `BufferPool` (optional, default true): If set to true, the working images (downscaled, blurred, HLS and mask
+    images) are written into buffers that are kept between frames instead of being allocated for every frame. Each
+    thread that calls `process()` gets its own buffers, which only grow when a larger frame than any before arrives.
+
+    Every setting except `Workers` and `RingDepth` can be changed while the program is running (see
+    `ReloadInterval` in config.xml). The new configuration, including its lookup table, is prepared in the
+    background and used from the next frame onwards; frames that are already being processed finish with the old one.
+    With several `Workers`, the lookup table is only built once and shared with the workers through shared memory.
     """
     hueRange = (int(), int())
     luminanceRange = (int(), int())
@@ -37,96 +86,690 @@ class ContourProcessor(ProcessorBase):
     heightRange = (int(), int())
     areaRange = (int(), int())
     overlapThreshold = float()
+    horizontalFOV = float()
+    workers = int()
+    ringDepth = int()
+    roiTracking = bool()
+    roiPadding = int()
+    roiMaxMisses = int()
+    roiFullScanInterval = int()
+    downscaleFactor = int()
+    refineAtFullResolution = bool()
+    colorClassifier = str()
+    lutBits = int()
+    bufferPool = bool()
+    
+    # above this many rects, non_max_suppression() switches from a pairwise matrix to a sorted sweep
+    NMS_MATRIX_LIMIT = 128
+    
+    _warned_pickled_tracking = False
+    
+    _pool = None
+    _lut = None
+    # the tracking state of every camera, since several cameras may share the processor
+    _roi_tracks = None  # type: Dict[str, _RoiTrack]
+    # guards _roi_tracks, since process() may be called from several threads at once
+    _roi_lock = None  # type: threading.Lock
+    _buffers = None  # type: threading.local
+    # the version of the configuration in the worker pool, see ContourWorkerPool.configure()
+    _pool_version = 0
+    # set by reconfigure() to the processor that frames are handed to
+    _active = None  # type: ContourProcessor
     
     async def setup(self, component_config_root: ElementTree.Element):
+        self.load_config(component_config_root)
+        if self.workers > 1:
+            self._pool = ContourWorkerPool(self.workers, self.ringDepth)
+            self._pool_version = self._pool.configure(ElementTree.tostring(component_config_root, encoding="unicode"),
+                                                      self._lut)
+    
+    async def reconfigure(self, component_config_root: ElementTree.Element) -> bool:
+        active = self._active or self
+        # a shallow copy shares the worker pool, lookup table (if unchanged) and tracking state with the active
+        # processor; loading the new configuration into it (which may build a new lookup table) and handing it to the
+        # worker pool happen on a worker thread, so frames keep being processed until the single reference swap below
+        replacement = active._clone()
+        replacement._active = None
+        await asyncio.get_event_loop().run_in_executor(None, replacement.load_config, component_config_root)
+        if (replacement.workers, replacement.ringDepth) != (active.workers, active.ringDepth):
+            logging.warning("Changes to Workers and RingDepth only take effect after a restart")
+            replacement.workers, replacement.ringDepth = active.workers, active.ringDepth
+        if replacement._pool is not None:
+            replacement._pool_version = await asyncio.get_event_loop().run_in_executor(
+                None, replacement._pool.configure, ElementTree.tostring(component_config_root, encoding="unicode"),
+                replacement._lut)
+        self._active = replacement
+        return True
+    
+    def load_config(self, component_config_root: ElementTree.Element) -> NoReturn:
+        # imported here so that the import is only paid for when the processor is configured (every other method that
+        # uses OpenCV runs after this)
+        global cv2
+        import cv2
         self.hueRange = tuple([int(i) for i in component_config_root.find("HueRange").text.split('-')])
         self.luminanceRange = tuple([int(i) for i in component_config_root.find("LuminanceRange").text.split('-')])
         self.saturationRange = tuple([int(i) for i in component_config_root.find("SaturationRange").text.split('-')])
         self.widthRange = tuple([int(i) for i in component_config_root.find("WidthRange").text.split('-')])
         self.heightRange = tuple([int(i) for i in component_config_root.find("HeightRange").text.split('-')])
         self.areaRange = tuple([int(i) for i in component_config_root.find("AreaRange").text.split('-')])
+        self.overlapThreshold = float(component_config_root.find("OverlapThreshold").text)
+        self.horizontalFOV = float(component_config_root.findtext("HorizontalFOV", "68.5"))
+        self.workers = int(component_config_root.findtext("Workers", "1"))
+        self.ringDepth = int(component_config_root.findtext("RingDepth", str(2 * self.workers)))
+        self.roiTracking = component_config_root.findtext("RoiTracking", "false") in ['true', '1', 't', 'y', 'yes']
+        self.roiPadding = int(component_config_root.findtext("RoiPadding", "40"))
+        self.roiMaxMisses = int(component_config_root.findtext("RoiMaxMisses", "3"))
+        self.roiFullScanInterval = int(component_config_root.findtext("RoiFullScanInterval", "30"))
+        self.downscaleFactor = max(1, int(component_config_root.findtext("DownscaleFactor", "1")))
+        self.refineAtFullResolution = component_config_root.findtext("RefineAtFullResolution", "false") in \
+            ['true', '1', 't', 'y', 'yes']
+        self.colorClassifier = component_config_root.findtext("ColorClassifier", "hls")
+        self.lutBits = int(component_config_root.findtext("LutBits", "8"))
+        self.bufferPool = component_config_root.findtext("BufferPool", "true") in ['true', '1', 't', 'y', 'yes']
+        if self._buffers is None:
+            self._buffers = threading.local()
+        if self._roi_lock is None:
+            self._roi_lock = threading.Lock()
+            self._roi_tracks = dict()
+        
+        if self.colorClassifier == "lut":
+            lut_key = (self.hueRange, self.luminanceRange, self.saturationRange, self.lutBits)
+            if self._lut is None or self._lut.key != lut_key:
+                self._lut = ColorLookupTable(self.hueRange, self.luminanceRange, self.saturationRange, self.lutBits)
+        elif self.colorClassifier == "hls":
+            self._lut = None
+        else:
+            raise ValueError("Unknown color classifier " + self.colorClassifier)
     
     async def cleanup(self):
-        pass
+        if self._pool is not None:
+            self._pool.close()
     
-    def process(self, frame: numpy.ndarray) -> List[FrameData]:
-        blurred = cv2.blur(frame, (15, 15))
+    def _clone(self) -> "ContourProcessor":
+        # not copy.copy(), which goes through __getstate__() and __setstate__(): those are for copies in other
+        # processes, and would drop the lock and tracking state this copy must share
+        clone = object.__new__(type(self))
+        clone.__dict__.update(self.__dict__)
+        return clone
     
-        hsl_filtered = cv2.inRange(cv2.cvtColor(blurred, cv2.COLOR_BGR2HLS),
-                                   (self.hueRange[0], self.luminanceRange[0], self.saturationRange[0]),
-                                   (self.hueRange[1], self.luminanceRange[1], self.saturationRange[1]))
+    def __getstate__(self):
+        # thread-local buffers and locks can't be pickled (e.g. for a process executor); the copy gets its own. Only
+        # the active configuration is copied. The worker pool stays behind too, so the copy detects objects itself.
+        active = self._active or self
+        state = active.__dict__.copy()
+        for name in ("_buffers", "_active", "_roi_lock", "_roi_tracks", "_pool"):
+            state.pop(name, None)
+        if active.roiTracking and not ContourProcessor._warned_pickled_tracking:
+            ContourProcessor._warned_pickled_tracking = True
+            logging.warning("RoiTracking is turned off in copies of the contour processor (e.g. with a process "
+                            "executor), since their tracking state would be lost after every frame")
+        return state
     
-        eroded = cv2.erode(hsl_filtered, None, (-1, -1), iterations=5, borderType=cv2.BORDER_CONSTANT, borderValue=(-1))
-        dilated = cv2.dilate(eroded, None, (-1, -1), iterations=5, borderType=cv2.BORDER_CONSTANT,
-                             borderValue=(-1))
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._buffers = threading.local()
+        self._roi_lock = threading.Lock()
+        self._roi_tracks = dict()
+        self.roiTracking = False
     
-        contour_image, contours, hierarchy = cv2.findContours(dilated, mode=cv2.RETR_EXTERNAL,
-                                                              method=cv2.CHAIN_APPROX_SIMPLE)
+    def buffer_pool(self) -> Optional["BufferPool"]:
+        """ Returns the calling thread's BufferPool, or None if `BufferPool` is disabled.
+        """
+        if not self.bufferPool:
+            return None
+        if not hasattr(self._buffers, "pool"):
+            self._buffers.pool = BufferPool()
+        return self._buffers.pool
     
-        contours_hulls = []
-        for i in contours:
-            contours_hulls.append(cv2.convexHull(i))
-        contours_filtered = self.filter_contours(contours_hulls)
+    def process(self, frame: numpy.ndarray, camera: str = "") -> Detections:
+        active = self._active
+        if active is not None:
+            return active.process(frame, camera)
+        if self.roiTracking:
+            rects, areas = self._detect_tracked(frame, camera)
+        else:
+            rects, areas = self._detect_anywhere(frame)
         
-        rects = [cv2.boundingRect(i) for i in contours_filtered]
-        # converting coordinate format + using numpy arrays for better performance
-        rects = numpy.array([(i[0], i[1], i[0] + i[2], i[1] + i[3]) for i in rects])
-        rects = self.non_max_suppression(rects, self.overlapThreshold)
-
-        return [FrameData(rect, frame.shape[1]) for rect in rects]
+        return Detections.from_rects(rects, frame.shape[1], self.horizontalFOV, areas)
+    
+    def _detect_anywhere(self, frame: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        if self._pool is not None and not self._pool.broken:
+            return self._pool.detect(frame, self._pool_version)
+        return self.detect(frame)
+    
+    def _detect_tracked(self, frame: numpy.ndarray, camera: str) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        with self._roi_lock:
+            track = self._roi_tracks.setdefault(camera, _RoiTrack())
+            ticket = next(track.tickets)
+            window = self._roi_window(track, frame.shape)
+            if window is None:
+                track.frames_since_full_scan = 0
+            else:
+                track.frames_since_full_scan += 1
+        
+        if window is None:
+            rects, areas = self._detect_anywhere(frame)
+        else:
+            x1, y1, x2, y2 = window
+            rects, areas = self._detect_anywhere(frame[y1:y2, x1:x2])
+            if len(rects) > 0:
+                rects = rects + (x1, y1, x1, y1)
+        
+        with self._roi_lock:
+            # a frame that finishes after a newer one must not move the newer one's window
+            if ticket > track.applied:
+                track.applied = ticket
+                if len(rects) > 0:
+                    track.rects = rects
+                    track.misses = 0
+                else:
+                    track.misses += 1
+                    if track.misses >= self.roiMaxMisses:
+                        track.rects = None
+        return rects, areas
+    
+    def _roi_window(self, track: "_RoiTrack", frame_shape: Tuple[int, ...]) -> Tuple[int, int, int, int]:
+        """ Returns the padded window around the last detections as (x1, y1, x2, y2), or None if the next frame
+        should be scanned in full.
+        """
+        if track.rects is None:
+            return None
+        if 0 < self.roiFullScanInterval <= track.frames_since_full_scan:
+            return None
+        
+        x1 = max(0, int(track.rects[:, 0].min()) - self.roiPadding)
+        y1 = max(0, int(track.rects[:, 1].min()) - self.roiPadding)
+        x2 = min(frame_shape[1], int(track.rects[:, 2].max()) + self.roiPadding)
+        y2 = min(frame_shape[0], int(track.rects[:, 3].max()) + self.roiPadding)
+        return x1, y1, x2, y2
+    
+    def detect(self, frame: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """ Runs the detection pipeline on a frame and returns the rects that survive non-maximum suppression
+        in [x1, y1, x2, y2] format, along with the area of each object's convex hull.
+        """
+        scale = self.downscaleFactor
+        if scale > 1:
+            size = (frame.shape[1] // scale, frame.shape[0] // scale)
+            small = cv2.resize(frame, size, dst=self._buffer("small", (size[1], size[0]) + frame.shape[2:]),
+                               interpolation=cv2.INTER_AREA)
+        else:
+            small = frame
+        
+        rects, areas = self.find_objects(self.threshold(small, scale))
+        passed = self.filter_mask(rects, areas, scale)
+        rects, areas = rects[passed] * scale, areas[passed] * (scale * scale)
+        if scale > 1 and self.refineAtFullResolution:
+            rects = self.refine_rects(frame, rects)
+        pick = self.non_max_suppression_pick(rects, self.overlapThreshold)
+        return rects[pick], areas[pick]
+    
+    def threshold(self, image: numpy.ndarray, scale: int = 1) -> numpy.ndarray:
+        """ Blurs, color filters and opens (erode, then dilate) an image, returning a binary mask. `scale` is the
+        factor the image was shrunk by; the blur kernel and the number of erode/dilate iterations shrink with it.
+        """
+        blurred = self.blur(image, scale)
+    
+        if self._lut is not None:
+            hsl_filtered = self._lut.classify(blurred, self.buffer_pool())
+        else:
+            hsl_filtered = cv2.inRange(cv2.cvtColor(blurred, cv2.COLOR_BGR2HLS, dst=self._buffer("hls", image.shape)),
+                                       (self.hueRange[0], self.luminanceRange[0], self.saturationRange[0]),
+                                       (self.hueRange[1], self.luminanceRange[1], self.saturationRange[1]),
+                                       dst=self._buffer("mask", image.shape[:2]))
+        return self.open_mask(hsl_filtered, scale)
+    
+    def blur(self, image: numpy.ndarray, scale: int = 1) -> numpy.ndarray:
+        """ The first step of threshold(). The result may be a pooled buffer, which the next call overwrites.
+        """
+        blur_size = max(1, int(round(15 / scale)))
+        return cv2.blur(image, (blur_size, blur_size), dst=self._buffer("blurred", image.shape))
+    
+    def open_mask(self, mask: numpy.ndarray, scale: int = 1) -> numpy.ndarray:
+        """ The last step of threshold(): erodes, then dilates a color mask to remove specks. `mask` is overwritten
+        if it is the pooled mask buffer.
+        """
+        iterations = max(1, int(round(5 / scale)))
+        eroded = cv2.erode(mask, None, dst=self._buffer("eroded", mask.shape), anchor=(-1, -1),
+                           iterations=iterations, borderType=cv2.BORDER_CONSTANT, borderValue=(-1))
+        # the color mask isn't needed any more, so its buffer takes the result
+        return cv2.dilate(eroded, None, dst=self._buffer("mask", mask.shape), anchor=(-1, -1),
+                          iterations=iterations, borderType=cv2.BORDER_CONSTANT, borderValue=(-1))
+    
+    def find_objects(self, mask: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """ Returns the rect and convex hull area of every object in a binary mask (see contour_geometry()), before
+        any filtering. `mask` may be modified.
+        """
+        contour_image, contours, hierarchy = cv2.findContours(mask, mode=cv2.RETR_EXTERNAL,
+                                                              method=cv2.CHAIN_APPROX_SIMPLE)
+        return self.contour_geometry([cv2.convexHull(i) for i in contours])
+    
+    def _buffer(self, name: str, shape: Tuple[int, ...]) -> Optional[numpy.ndarray]:
+        pool = self.buffer_pool()
+        return pool.get(name, shape) if pool is not None else None
+    
+    def refine_rects(self, frame: numpy.ndarray, rects: numpy.ndarray) -> numpy.ndarray:
+        """ Re-measures downscaled rects at full resolution, inside a window padded by one downscaled pixel's
+        worth of error (plus the blur radius) on every side.
+        """
+        padding = self.downscaleFactor + 8
+        refined = []
+        for x1, y1, x2, y2 in rects:
+            wx1, wy1 = max(0, x1 - padding), max(0, y1 - padding)
+            wx2, wy2 = min(frame.shape[1], x2 + padding), min(frame.shape[0], y2 + padding)
+            x, y, w, h = cv2.boundingRect(self.threshold(frame[wy1:wy2, wx1:wx2]))
+            if w == 0 or h == 0:
+                refined.append((x1, y1, x2, y2))
+            else:
+                refined.append((wx1 + x, wy1 + y, wx1 + x + w, wy1 + y + h))
+        return numpy.array(refined, dtype=rects.dtype).reshape(-1, 4)
 
-    def filter_contours(self, contours: List[numpy.ndarray]) -> List[numpy.ndarray]:
-        output = []
-        for contour in contours:
-            x, y, w, h = cv2.boundingRect(contour)
-            if w < self.widthRange[0] or w > self.widthRange[1]:  # min/max width
-                continue
-            if h < self.heightRange[0] or h > self.heightRange[1]:  # min/max height
-                continue
+    @staticmethod
+    def contour_geometry(contours: List[numpy.ndarray]) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """ Computes the bounding rect (in [x1, y1, x2, y2] format, where x2 and y2 are exclusive like
+        `cv2.boundingRect`'s width and height) and the area of every contour in one vectorized pass.
         
-            area = cv2.contourArea(contour)
-            if area < self.areaRange[0] or area > self.areaRange[1]:  # min/max area
-                continue
+        Returns a tuple of an (N, 4) int array of rects and an (N,) float array of areas.
+        """
+        if len(contours) == 0:
+            return numpy.empty((0, 4), dtype=numpy.int64), numpy.empty(0)
         
-            output.append(contour)
+        lengths = numpy.array([len(i) for i in contours])
+        starts = numpy.concatenate(([0], numpy.cumsum(lengths)[:-1]))
+        points = numpy.concatenate(contours).reshape(-1, 2).astype(numpy.int64)
+        x = points[:, 0]
+        y = points[:, 1]
+        
+        rects = numpy.stack((numpy.minimum.reduceat(x, starts), numpy.minimum.reduceat(y, starts),
+                             numpy.maximum.reduceat(x, starts) + 1, numpy.maximum.reduceat(y, starts) + 1), axis=1)
+        
+        # shoelace formula; the point after the last point of a contour is its first point
+        following = numpy.arange(1, len(points) + 1)
+        following[starts + lengths - 1] = starts
+        cross = x * y[following] - x[following] * y
+        areas = numpy.abs(numpy.add.reduceat(cross, starts)) / 2
+        return rects, areas
     
-        return output
+    def filter_mask(self, rects: numpy.ndarray, areas: numpy.ndarray, scale: int = 1) -> numpy.ndarray:
+        """ Returns a boolean mask of the rects that pass the width, height and area limits. `scale` converts the
+        rects and areas to full resolution pixels, which the limits are given in.
+        """
+        widths = (rects[:, 2] - rects[:, 0]) * scale
+        heights = (rects[:, 3] - rects[:, 1]) * scale
+        areas = areas * (scale * scale)
+        return ((widths >= self.widthRange[0]) & (widths <= self.widthRange[1]) &
+                (heights >= self.heightRange[0]) & (heights <= self.heightRange[1]) &
+                (areas >= self.areaRange[0]) & (areas <= self.areaRange[1]))
     
-    # based off of https://www.pyimagesearch.com/2015/02/16/faster-non-maximum-suppression-python/
     @staticmethod
-    def non_max_suppression(rects: numpy.array, overlap_thresh: float) -> numpy.array:
+    def non_max_suppression(rects: numpy.ndarray, overlap_thresh: float) -> numpy.ndarray:
+        """ Returns the rects kept by non_max_suppression_pick().
+        """
         if len(rects) == 0:
-            return []
+            return numpy.empty((0, 4), dtype=numpy.int64)
+        rects = numpy.asarray(rects)
+        return rects[ContourProcessor.non_max_suppression_pick(rects, overlap_thresh)].astype("int")
+    
+    # based off of https://www.pyimagesearch.com/2015/02/16/faster-non-maximum-suppression-python/
+    @staticmethod
+    def non_max_suppression_pick(rects: numpy.ndarray, overlap_thresh: float) -> numpy.ndarray:
+        """ Greedy non-maximum suppression. Rects are visited from the lowest bottom edge upwards; every rect that
+        is kept suppresses the remaining rects it covers by more than `overlap_thresh` of their own area.
+        
+        Small batches compare every pair of rects at once. Large batches sort the rects by their left edge and only
+        compare each kept rect against the rects whose left edge is close enough to overlap it.
         
-        if rects.dtype.kind == "i":
-            rects = rects.astype("float")
+        Returns the indices of the kept rects, in the order they were kept.
+        """
+        if len(rects) == 0:
+            return numpy.empty(0, dtype=numpy.int64)
         
+        x1, y1, x2, y2 = (rects[:, i].astype(numpy.float64) for i in range(4))
+        area = (x2 - x1 + 1) * (y2 - y1 + 1)
+        order = numpy.argsort(-y2, kind="stable")
+        suppressed = numpy.zeros(len(rects), dtype=bool)
         pick = []
         
-        x1 = rects[:, 0]
-        y1 = rects[:, 1]
-        x2 = rects[:, 2]
-        y2 = rects[:, 3]
+        if len(rects) <= ContourProcessor.NMS_MATRIX_LIMIT:
+            w = numpy.minimum(x2[:, None], x2[None, :]) - numpy.maximum(x1[:, None], x1[None, :]) + 1
+            h = numpy.minimum(y2[:, None], y2[None, :]) - numpy.maximum(y1[:, None], y1[None, :]) + 1
+            # overlap[i, j] is the fraction of rect j covered by rect i
+            overlap = numpy.maximum(0, w) * numpy.maximum(0, h) / area[None, :]
+            for i in order:
+                if suppressed[i]:
+                    continue
+                pick.append(i)
+                suppressed |= overlap[i] > overlap_thresh
+        else:
+            by_x1 = numpy.argsort(x1, kind="stable")
+            sorted_x1 = x1[by_x1]
+            max_width = (x2 - x1).max()
+            # alive[k] is true while the k-th rect in visiting order has not been suppressed
+            alive = numpy.ones(len(rects), dtype=bool)
+            rank = numpy.empty(len(rects), dtype=numpy.int64)
+            rank[order] = numpy.arange(len(rects))
+            position = 0
+            while position < len(rects):
+                position += int(alive[position:].argmax())
+                if not alive[position]:
+                    break
+                i = order[position]
+                pick.append(i)
+                nearby = by_x1[numpy.searchsorted(sorted_x1, x1[i] - max_width, "left"):
+                               numpy.searchsorted(sorted_x1, x2[i], "right")]
+                w = numpy.minimum(x2[i], x2[nearby]) - numpy.maximum(x1[i], x1[nearby]) + 1
+                h = numpy.minimum(y2[i], y2[nearby]) - numpy.maximum(y1[i], y1[nearby]) + 1
+                overlap = numpy.maximum(0, w) * numpy.maximum(0, h) / area[nearby]
+                alive[rank[nearby[overlap > overlap_thresh]]] = False
+                alive[position] = False
         
-        area = (x2 - x1 + 1) * (y2 - y1 + 1)
-        idxs = numpy.argsort(y2)
-        
-        while len(idxs) > 0:
-            last = len(idxs) - 1
-            i = idxs[last]
-            pick.append(i)
-            
-            xx1 = numpy.maximum(x1[i], x1[idxs[:last]])
-            yy1 = numpy.maximum(y1[i], y1[idxs[:last]])
-            xx2 = numpy.maximum(x2[i], x2[idxs[:last]])
-            yy2 = numpy.maximum(y2[i], y2[idxs[:last]])
-            
-            w = numpy.maximum(0, xx2 - xx1 + 1)
-            h = numpy.maximum(0, yy2 - yy1 + 1)
-            
-            overlap = (w * h) / area[idxs[:last]]
-
-            idxs = numpy.delete(idxs, numpy.concatenate(([last],
-                                                         numpy.where(overlap > overlap_thresh)[0])))
-        
-        return rects[pick].astype("int")
+        return numpy.array(pick, dtype=numpy.int64)
+
+
+class ColorLookupTable:
+    """ A quantized BGR => mask bit table equivalent to converting to HLS and filtering with `cv2.inRange`.
+    
+    Every BGR color (with each channel cut down to `bits` bits) gets one bit in the table, so the table takes
+    2^(3 * bits) / 8 bytes. It is built by running the HLS conversion and range check once over every color.
+    """
+    def __init__(self, hue_range: Tuple[int, int], luminance_range: Tuple[int, int],
+                 saturation_range: Tuple[int, int], bits: int = 8):
+        if not 1 <= bits <= 8:
+            raise ValueError("LutBits must be between 1 and 8")
+        self.key = (hue_range, luminance_range, saturation_range, bits)
+        self.bits = bits
+        self.shift = 8 - bits
+        
+        # index layout is (b << 2 * bits) | (g << bits) | r
+        index = numpy.arange(1 << (3 * bits), dtype=numpy.uint32)
+        channel_mask = (1 << bits) - 1
+        # quantized colors are represented by the middle of the range of colors they stand for
+        center = (1 << self.shift) >> 1
+        colors = numpy.empty((len(index), 1, 3), numpy.uint8)
+        colors[:, 0, 0] = (((index >> (2 * bits)) & channel_mask) << self.shift) | center
+        colors[:, 0, 1] = (((index >> bits) & channel_mask) << self.shift) | center
+        colors[:, 0, 2] = ((index & channel_mask) << self.shift) | center
+        
+        mask = cv2.inRange(cv2.cvtColor(colors, cv2.COLOR_BGR2HLS),
+                           (hue_range[0], luminance_range[0], saturation_range[0]),
+                           (hue_range[1], luminance_range[1], saturation_range[1]))
+        self.table = numpy.packbits(mask.ravel() != 0, bitorder="little")
+    
+    @classmethod
+    def from_buffer(cls, key: Tuple[Tuple[int, int], Tuple[int, int], Tuple[int, int], int],
+                    buffer: memoryview) -> "ColorLookupTable":
+        """ Returns the table with the given `key` whose bits are read from `buffer` (e.g. shared memory holding
+        another table's `table`) instead of being built.
+        """
+        lut = cls.__new__(cls)
+        lut.key = key
+        lut.bits = key[3]
+        lut.shift = 8 - lut.bits
+        lut.table = numpy.frombuffer(buffer, numpy.uint8, count=((1 << (3 * lut.bits)) + 7) // 8)
+        return lut
+    
+    def classify(self, image: numpy.ndarray, buffers: Optional["BufferPool"] = None) -> numpy.ndarray:
+        """ Returns a mask of `image` that is 255 where the pixel's color is inside the ranges and 0 elsewhere.
+        If `buffers` is given, the mask and the intermediate arrays are taken from it instead of being allocated.
+        """
+        if buffers is None:
+            buffers = BufferPool()
+        index = buffers.get("lut_index", image.shape[:2], numpy.uint32)
+        if self.bits == 8:
+            # assemble the index by writing the channels straight into the bytes of each uint32
+            index_bytes = index.view(numpy.uint8).reshape(image.shape[0], image.shape[1], 4)
+            b_byte, g_byte, r_byte, unused_byte = (2, 1, 0, 3) if numpy.little_endian else (1, 2, 3, 0)
+            index_bytes[..., b_byte] = image[..., 0]
+            index_bytes[..., g_byte] = image[..., 1]
+            index_bytes[..., r_byte] = image[..., 2]
+            index_bytes[..., unused_byte] = 0
+        else:
+            quantized = numpy.right_shift(image, self.shift, out=buffers.get("lut_quantized", image.shape))
+            numpy.left_shift(quantized[..., 0], 2 * self.bits, out=index, dtype=numpy.uint32)
+            channel = buffers.get("lut_channel", image.shape[:2], numpy.uint32)
+            numpy.left_shift(quantized[..., 1], self.bits, out=channel, dtype=numpy.uint32)
+            index |= channel
+            index |= quantized[..., 2]
+        
+        byte_index = numpy.right_shift(index, 3, out=buffers.get("lut_byte_index", image.shape[:2], numpy.uint32))
+        mask = numpy.take(self.table, byte_index, out=buffers.get("mask", image.shape[:2]))
+        bit = numpy.bitwise_and(index, 7, out=buffers.get("lut_bit", image.shape[:2]), casting="unsafe")
+        mask >>= bit
+        mask &= 1
+        mask *= 255
+        return mask
+
+
+class _RoiTrack:
+    """ The region of interest tracking state of a ContourProcessor for one camera. Frames take increasing tickets
+    when they start, and only the frame with the highest ticket that has finished so far updates the window.
+    """
+    def __init__(self):
+        self.rects = None  # type: Optional[numpy.ndarray]
+        self.misses = 0
+        self.frames_since_full_scan = 0
+        self.tickets = itertools.count(1)
+        self.applied = 0
+
+
+class BufferPool:
+    """ Working arrays that are reused from one frame to the next.
+    
+    Each named buffer is one flat block of memory. get() returns a contiguous view of the start of the block with
+    the requested shape, so a smaller image (such as a region of interest) reuses the same memory. A block is only
+    reallocated when an image larger than any before it is requested. A pool must only be used by one thread.
+    """
+    def __init__(self):
+        self.blocks = dict()  # type: Dict[str, numpy.ndarray]
+        self.allocations = 0
+    
+    def get(self, name: str, shape: Tuple[int, ...], dtype: numpy.dtype = numpy.uint8) -> numpy.ndarray:
+        dtype = numpy.dtype(dtype)
+        size = int(numpy.prod(shape)) * dtype.itemsize
+        block = self.blocks.get(name)
+        if block is None or len(block) < size:
+            block = numpy.empty(size, numpy.uint8)
+            self.blocks[name] = block
+            self.allocations += 1
+        return block[:size].view(dtype).reshape(shape)
+
+
+class _FrameRing:
+    """ A block of shared memory divided into equally sized frame slots. Each slot can hold one frame of the
+    ring's shape or any smaller frame (such as a region of interest).
+    """
+    def __init__(self, shape: Tuple[int, ...], depth: int):
+        self.shape = shape
+        self.slot_size = int(numpy.prod(shape))
+        self.shared_memory = shared_memory.SharedMemory(create=True, size=self.slot_size * depth)
+        self.free_slots = queue.Queue()
+        for slot in range(depth):
+            self.free_slots.put(slot)
+    
+    def fits(self, shape: Tuple[int, ...]) -> bool:
+        return int(numpy.prod(shape)) <= self.slot_size
+    
+    def slot_view(self, slot: int, shape: Tuple[int, ...]) -> numpy.ndarray:
+        return numpy.ndarray(shape, numpy.uint8, buffer=self.shared_memory.buf, offset=slot * self.slot_size)
+    
+    def close(self) -> NoReturn:
+        self.shared_memory.close()
+        self.shared_memory.unlink()
+
+
+def _contour_worker(config_queue: multiprocessing.Queue, task_queue: multiprocessing.Queue,
+                   result_queue: multiprocessing.Queue):
+    # Ctrl+C reaches the whole process group; the parent shuts the workers down through close() instead
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    processor = ContourProcessor()
+    loaded_version = 0
+    lut_memory = None  # type: Optional[shared_memory.SharedMemory]
+    attached = dict()  # type: Dict[str, shared_memory.SharedMemory]
+    try:
+        while True:
+            task = task_queue.get()
+            if task is None:
+                return
+            sequence, memory_name, offset, shape, version = task
+            while loaded_version < version:
+                loaded_version, config_xml, lut_name, lut_key = config_queue.get()
+                if lut_name is not None:
+                    # the parent already built the lookup table, so load_config() finds one with the right key
+                    previous_memory = lut_memory
+                    if lut_memory is None or lut_memory.name != lut_name:
+                        lut_memory = shared_memory.SharedMemory(name=lut_name)
+                    processor._lut = ColorLookupTable.from_buffer(lut_key, lut_memory.buf)
+                    if previous_memory is not None and previous_memory is not lut_memory:
+                        previous_memory.close()
+                processor.load_config(ElementTree.fromstring(config_xml))
+            if memory_name not in attached:
+                attached[memory_name] = shared_memory.SharedMemory(name=memory_name)
+            frame = numpy.ndarray(shape, numpy.uint8, buffer=attached[memory_name].buf, offset=offset)
+            try:
+                result_queue.put((sequence, processor.detect(frame)))
+            except Exception as e:
+                result_queue.put((sequence, e))
+            del frame
+    finally:
+        processor._lut = None
+        for memory in list(attached.values()) + ([lut_memory] if lut_memory is not None else []):
+            memory.close()
+
+
+class ContourWorkerPool:
+    """ Runs ContourProcessor.detect() in worker processes.
+    
+    Frames are copied once into a free slot of a shared memory ring and only the slot's location is sent to a worker,
+    together with the version of the configuration to process it with. configure() sends every new configuration to
+    each worker once, and its lookup table is copied into shared memory, so the workers use the table built by the
+    parent instead of building their own. The ring is reallocated whenever a frame does not fit in its slots.
+    
+    If a worker exits while the pool is open, the pool is marked as `broken` and is not used again. Frames that are
+    still waiting when the pool is closed or broken fail with a RuntimeError instead of blocking.
+    """
+    def __init__(self, workers: int, ring_depth: int):
+        context = multiprocessing.get_context("spawn")
+        self.ring_depth = ring_depth
+        self._ring = None
+        self._retired_rings = []
+        self._ring_lock = threading.Lock()
+        self._sequence = itertools.count()
+        self._futures = dict()  # type: Dict[int, Future]
+        self._closed = False
+        self.broken = False
+        self._config_lock = threading.Lock()
+        self._version = 0
+        self._lut_memory = None  # type: Optional[shared_memory.SharedMemory]
+        self._lut_key = None
+        self._retired_memory = []  # type: List[shared_memory.SharedMemory]
+        self._config_queues = [context.Queue() for _ in range(workers)]
+        self._task_queue = context.Queue()
+        self._result_queue = context.Queue()
+        self._workers = [context.Process(target=_contour_worker, args=(config_queue, self._task_queue,
+                                                                      self._result_queue), daemon=True)
+                         for config_queue in self._config_queues]
+        for worker in self._workers:
+            worker.start()
+        self._result_thread = threading.Thread(target=self._collect_results, name="contour-results", daemon=True)
+        self._result_thread.start()
+        logging.debug("Started {} contour worker processes".format(workers))
+    
+    def configure(self, config_xml: str, lut: Optional[ColorLookupTable]) -> int:
+        """ Sends a new configuration (a `Component` tag) to the workers, along with its lookup table (if it uses
+        one), and returns its version for detect().
+        """
+        with self._config_lock:
+            lut_name = None
+            if lut is not None:
+                if self._lut_memory is None or self._lut_key != lut.key:
+                    if self._lut_memory is not None:
+                        # workers may still be using the old table, so it is only freed in close()
+                        self._retired_memory.append(self._lut_memory)
+                    self._lut_memory = shared_memory.SharedMemory(create=True, size=len(lut.table))
+                    self._lut_memory.buf[:len(lut.table)] = lut.table
+                    self._lut_key = lut.key
+                lut_name = self._lut_memory.name
+            self._version += 1
+            for config_queue in self._config_queues:
+                config_queue.put((self._version, config_xml, lut_name, self._lut_key))
+            return self._version
+    
+    def detect(self, frame: numpy.ndarray, version: int) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """ Same as ContourProcessor.detect(), but runs in a worker process with the configuration passed to
+        configure() that returned `version`. Blocks until a ring slot is free and the result is ready. Can be called
+        from several threads at once.
+        """
+        with self._ring_lock:
+            if self._ring is None or not self._ring.fits(frame.shape):
+                if self._ring is not None:
+                    # workers may still be reading the old ring, so it is only freed in close()
+                    self._retired_rings.append(self._ring)
+                self._ring = _FrameRing(frame.shape, self.ring_depth)
+            ring = self._ring
+        
+        slot = ring.free_slots.get()
+        try:
+            ring.slot_view(slot, frame.shape)[...] = frame
+            sequence = next(self._sequence)
+            future = Future()
+            self._futures[sequence] = future
+            if self._closed or self.broken:
+                self._fail_pending("contour worker pool closed" if self._closed else "contour worker process exited")
+            else:
+                self._task_queue.put((sequence, ring.shared_memory.name, slot * ring.slot_size, frame.shape,
+                                      version))
+            return future.result()
+        finally:
+            ring.free_slots.put(slot)
+    
+    def _collect_results(self):
+        while True:
+            if not self.broken and not self._closed:
+                for worker in self._workers:
+                    if not worker.is_alive():
+                        # its frame is lost, and it may have died holding a queue's lock, so the pool isn't reused
+                        self.broken = True
+                        logging.error("Contour worker process {} exited with code {}, objects are detected without "
+                                      "worker processes from now on".format(worker.pid, worker.exitcode))
+                        break
+            if self.broken:
+                self._fail_pending("contour worker process exited")
+            try:
+                result = self._result_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            if result is None:
+                self._fail_pending("contour worker pool closed")
+                return
+            sequence, detected = result
+            future = self._futures.pop(sequence, None)
+            if future is None:
+                continue
+            if isinstance(detected, Exception):
+                future.set_exception(detected)
+            else:
+                future.set_result(detected)
+    
+    def _fail_pending(self, reason: str) -> NoReturn:
+        for sequence in list(self._futures):
+            future = self._futures.pop(sequence, None)
+            if future is not None:
+                future.set_exception(RuntimeError(reason))
+    
+    def close(self) -> NoReturn:
+        self._closed = True
+        for _ in self._workers:
+            self._task_queue.put(None)
+        for worker in self._workers:
+            worker.join(1)
+        self._result_queue.put(None)
+        self._result_thread.join(2)
+        # in case the result thread is stuck, e.g. on a worker that died while putting a result
+        self._fail_pending("contour worker pool closed")
+        # tasks left for workers that have exited are dropped, rather than blocking the interpreter's exit
+        for worker_queue in self._config_queues + [self._task_queue, self._result_queue]:
+            worker_queue.cancel_join_thread()
+        for ring in self._retired_rings + ([self._ring] if self._ring is not None else []):
+            ring.close()
+        for memory in self._retired_memory + ([self._lut_memory] if self._lut_memory is not None else []):
+            memory.close()
+            memory.unlink()
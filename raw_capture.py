@@ -0,0 +1,127 @@
+from typing import BinaryIO, Optional, Tuple
+import struct
+import os
+import numpy
+
+from base_classes import Detections, DETECTION_DTYPE
+
+""" The raw capture format written by the raw_record postprocessor and replayed
+    by the raw_replay frame generator. Frames are stored uncompressed, so
+    replaying a capture costs no decoding and every frame can be read as a
+    zero-copy numpy.memmap view.
+
+    A capture is made of three append-only files:
+
+    - `<name>`: A 4096 byte header (see HEADER) followed by every frame's
+      pixels, one after the other. Every frame in a capture has the same
+      shape.
+    - `<name>.index`: One INDEX_DTYPE record per frame, holding its sequence
+      number, capture timestamp and where its detections are stored.
+    - `<name>.detections`: Every frame's detections as DETECTION_DTYPE rows
+      (in native byte order).
+
+    A frame's index record is written last, so a capture that was cut off
+    (e.g. by a crash) can still be read up to the last complete frame.
+"""
+
+MAGIC = b"FRCRAW01"
+# magic, height, width, channels
+HEADER = struct.Struct("<8sIII")
+# frames start on a page boundary, so every frame view is aligned
+FRAMES_OFFSET = 4096
+
+INDEX_DTYPE = numpy.dtype([
+    ("sequence", "<u8"),
+    ("timestamp", "<f8"),
+    ("detection_offset", "<u8"),  # in rows
+    ("detection_count", "<u4"),
+    ("frame_width", "<u4"),
+])
+
+
+class RawCaptureWriter:
+    """ Appends frames and their metadata to a raw capture.
+    """
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.frame_shape = None  # type: Optional[Tuple[int, int, int]]
+        self.frame_count = 0
+        self._detection_rows = 0
+        self._frames_file = None  # type: Optional[BinaryIO]
+        self._index_file = open(file_name + ".index", "wb")
+        self._detections_file = open(file_name + ".detections", "wb")
+
+    def write(self, frame: numpy.ndarray, sequence: int, timestamp: float, detections: Detections) -> bool:
+        """ Appends a frame. Returns False (and writes nothing) if the frame's
+            shape differs from the first frame's.
+        """
+        shape = frame.shape if frame.ndim == 3 else frame.shape + (1,)
+        if self._frames_file is None:
+            self.frame_shape = shape
+            self._frames_file = open(self.file_name, "wb")
+            self._frames_file.write(HEADER.pack(MAGIC, *shape).ljust(FRAMES_OFFSET, b"\0"))
+        elif shape != self.frame_shape:
+            return False
+
+        record = numpy.zeros(1, INDEX_DTYPE)
+        record["sequence"] = sequence
+        record["timestamp"] = timestamp
+        record["detection_offset"] = self._detection_rows
+        record["detection_count"] = len(detections)
+        record["frame_width"] = detections.frame_width
+
+        self._detections_file.write(Detections(detections.array.astype(DETECTION_DTYPE, copy=False)).to_bytes())
+        self._frames_file.write(numpy.ascontiguousarray(frame, numpy.uint8).data)
+        self._detections_file.flush()
+        self._frames_file.flush()
+        self._index_file.write(record.tobytes())
+        self._index_file.flush()
+        self._detection_rows += len(detections)
+        self.frame_count += 1
+        return True
+
+    def close(self):
+        for output in (self._frames_file, self._index_file, self._detections_file):
+            if output is not None:
+                output.close()
+
+
+class RawCaptureReader:
+    """ Memory-maps a raw capture for reading. Frames and detections are
+        returned as read-only views of the files; nothing is copied.
+    """
+    def __init__(self, file_name: str):
+        with open(file_name, "rb") as frames_file:
+            magic, height, width, channels = HEADER.unpack(frames_file.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(file_name + " is not a raw capture")
+        self.frame_shape = (height, width, channels)
+        frame_size = height * width * channels
+
+        self.index = self._map(file_name + ".index", INDEX_DTYPE)
+        self.detections = self._map(file_name + ".detections", DETECTION_DTYPE)
+        stored_frames = (os.path.getsize(file_name) - FRAMES_OFFSET) // frame_size
+        self.frame_count = min(stored_frames, len(self.index))
+        self.index = self.index[:self.frame_count]
+        self.frames = numpy.memmap(file_name, numpy.uint8, "r", FRAMES_OFFSET, (self.frame_count,) + self.frame_shape) \
+            if self.frame_count > 0 else numpy.empty((0,) + self.frame_shape, numpy.uint8)
+
+    def __len__(self) -> int:
+        return self.frame_count
+
+    def frame(self, i: int) -> numpy.ndarray:
+        frame = self.frames[i]
+        return frame if frame.shape[2] > 1 else frame[:, :, 0]
+
+    def recorded_detections(self, i: int) -> Detections:
+        record = self.index[i]
+        start = int(record["detection_offset"])
+        return Detections(self.detections[start:start + int(record["detection_count"])], int(record["frame_width"]),
+                          int(record["sequence"]), float(record["timestamp"]))
+
+    @staticmethod
+    def _map(file_name: str, dtype: numpy.dtype) -> numpy.ndarray:
+        count = os.path.getsize(file_name) // dtype.itemsize
+        if count == 0:
+            return numpy.empty(0, dtype)
+        return numpy.memmap(file_name, dtype, "r", 0, (count,))
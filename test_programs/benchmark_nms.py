@@ -0,0 +1,91 @@
+import os
+import sys
+import time
+import argparse
+import numpy
+import cv2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from processors.contour import ContourProcessor  # noqa: E402
+
+""" Micro-benchmark for ContourProcessor's geometry and non-maximum suppression
+    stages on synthetic noisy frames with up to tens of thousands of candidate
+    contours. The matrix and sweep NMS strategies are checked against each
+    other and against the original delete-in-a-loop implementation.
+"""
+
+
+def reference_nms(rects: numpy.ndarray, overlap_thresh: float) -> numpy.ndarray:
+    # the original pyimagesearch-style loop, with the intersection fixed to use minimum()
+    x1, y1, x2, y2 = (rects[:, i].astype(float) for i in range(4))
+    area = (x2 - x1 + 1) * (y2 - y1 + 1)
+    idxs = numpy.argsort(-y2, kind="stable")[::-1]
+    pick = []
+    while len(idxs) > 0:
+        last = len(idxs) - 1
+        i = idxs[last]
+        pick.append(i)
+        w = numpy.maximum(0, numpy.minimum(x2[i], x2[idxs[:last]]) - numpy.maximum(x1[i], x1[idxs[:last]]) + 1)
+        h = numpy.maximum(0, numpy.minimum(y2[i], y2[idxs[:last]]) - numpy.maximum(y1[i], y1[idxs[:last]]) + 1)
+        overlap = (w * h) / area[idxs[:last]]
+        idxs = numpy.delete(idxs, numpy.concatenate(([last], numpy.where(overlap > overlap_thresh)[0])))
+    return rects[pick]
+
+
+def reference_geometry(contours):
+    rects = [cv2.boundingRect(i) for i in contours]
+    areas = [cv2.contourArea(i) for i in contours]
+    return rects, areas
+
+
+def time_call(function, *args, repeat: int = 5) -> float:
+    function(*args)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function(*args)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def noisy_hulls(count: int, rng: numpy.random.Generator):
+    # salt-and-pepper noise, similar to what a badly tuned color filter produces
+    mask = ((rng.random((480, 640)) < count / (640 * 480 * 2)) * 255).astype(numpy.uint8)
+    _, contours, _ = cv2.findContours(mask, mode=cv2.RETR_EXTERNAL, method=cv2.CHAIN_APPROX_SIMPLE)
+    return [cv2.convexHull(i) for i in contours]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", help="comma separated candidate counts", type=str,
+                        default="10,100,500,1000,5000,20000")
+    parser.add_argument("--threshold", help="overlap threshold", type=float, default=0.3)
+    args = parser.parse_args()
+    rng = numpy.random.default_rng(1777)
+
+    print("{:>7} {:>12} {:>12} {:>12} {:>8} {:>9} {:>12} {:>12}".format(
+        "N", "matrix ms", "sweep ms", "reference ms", "kept", "contours", "geometry ms", "ref geom ms"))
+    for size in [int(i) for i in args.sizes.split(",")]:
+        corners = rng.integers(0, 600, (size, 2))
+        rects = numpy.hstack((corners, corners + rng.integers(4, 120, (size, 2))))
+
+        default_limit = ContourProcessor.NMS_MATRIX_LIMIT
+        ContourProcessor.NMS_MATRIX_LIMIT = size if size <= 5000 else 0
+        matrix_result = ContourProcessor.non_max_suppression(rects, args.threshold)
+        matrix_ms = time_call(ContourProcessor.non_max_suppression, rects, args.threshold) \
+            if size <= 5000 else float("nan")
+        ContourProcessor.NMS_MATRIX_LIMIT = 0
+        sweep_result = ContourProcessor.non_max_suppression(rects, args.threshold)
+        sweep_ms = time_call(ContourProcessor.non_max_suppression, rects, args.threshold)
+        ContourProcessor.NMS_MATRIX_LIMIT = default_limit
+
+        reference_result = reference_nms(rects, args.threshold)
+        reference_ms = time_call(reference_nms, rects, args.threshold, repeat=1)
+        assert numpy.array_equal(sweep_result, reference_result), "sweep NMS differs from reference"
+        assert numpy.array_equal(matrix_result, reference_result), "matrix NMS differs from reference"
+
+        hulls = noisy_hulls(size, rng)
+        geometry_ms = time_call(ContourProcessor.contour_geometry, hulls)
+        reference_geometry_ms = time_call(reference_geometry, hulls)
+
+        print("{:>7} {:>12.2f} {:>12.2f} {:>12.2f} {:>8} {:>9} {:>12.2f} {:>12.2f}".format(
+            size, matrix_ms, sweep_ms, reference_ms, len(sweep_result), len(hulls), geometry_ms,
+            reference_geometry_ms))
@@ -0,0 +1,63 @@
+import os
+import sys
+import time
+import argparse
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from base_classes import Detections  # noqa: E402
+from postprocessors.socketserver import SocketServerPostProcessor  # noqa: E402
+import wire_protocol  # noqa: E402
+
+""" Compares the socketserver's text and binary protocols: the time to encode
+    one frame's detections, the time for a client to decode them, and the
+    number of bytes sent per frame.
+
+    The text protocol only carries the angle of the first detection, while a
+    binary packet carries every detection plus its frame's sequence number
+    and timestamps.
+"""
+
+
+def time_call(function, *args, repeat: int = 2000) -> float:
+    function(*args)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function(*args)
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def encode_text(detections: Detections) -> bytes:
+    return bytes(SocketServerPostProcessor.to_string(detections[0]), "utf-8") if len(detections) > 0 else b""
+
+
+def decode_text(message: bytes) -> float:
+    return float(message) if message else 0.0
+
+
+def encode_binary(detections: Detections) -> bytes:
+    return wire_protocol.encode_packet(detections, 1777, 1.5e9, 1.5e9)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", help="comma separated detection counts", type=str, default="0,1,5,20,100")
+    args = parser.parse_args()
+    rng = numpy.random.default_rng(1777)
+
+    print("{:>5} {:>14} {:>14} {:>11} {:>16} {:>16} {:>13}".format(
+        "N", "text enc us", "text dec us", "text bytes", "binary enc us", "binary dec us", "binary bytes"))
+    for size in [int(i) for i in args.sizes.split(",")]:
+        corners = rng.integers(0, 600, (size, 2))
+        detections = Detections.from_rects(numpy.hstack((corners, corners + rng.integers(4, 120, (size, 2)))))
+
+        text = encode_text(detections)
+        packet = encode_binary(detections)
+        decoded = wire_protocol.decode_packet(packet)
+        assert len(decoded.detections) == size and decoded.sequence == 1777
+        if size > 0:
+            assert abs(decoded.detections[0].angle - decode_text(text)) < 1e-3
+
+        print("{:>5} {:>14.2f} {:>14.2f} {:>11} {:>16.2f} {:>16.2f} {:>13}".format(
+            size, time_call(encode_text, detections), time_call(decode_text, text), len(text),
+            time_call(encode_binary, detections), time_call(wire_protocol.decode_packet, packet), len(packet)))
@@ -0,0 +1,80 @@
+import time
+import argparse
+import threading
+from networktables import NetworkTables
+
+""" A stand-in for the robot's NetworkTables server, for testing the
+    networktables postprocessor without a RoboRIO. Set the postprocessor's
+    `IP` to `127.0.0.1` (or this device's address), start this script and
+    then main.py, in either order.
+
+    Every second it prints how many times each vision_* key was updated, the
+    newest sequence number and detections, and the age of the newest result
+    (receive time minus capture time, so both programs should run on the same
+    device). With `--shutdown_after`, it sets `vision_shutdown` to true after
+    that many seconds, which should shut main.py down.
+
+    Usage: python3 networktables_server.py [--table <name>] [--duration <seconds>] [--shutdown_after <seconds>]
+"""
+
+
+class Monitor:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.updates = dict()
+        self.ages = []
+        self.sequence = 0
+        self.detections = []
+
+    def entry_changed(self, source, key: str, value, is_new: bool):
+        with self.lock:
+            self.updates[key] = self.updates.get(key, 0) + 1
+            if key == "vision_timestamp" and value > 0:
+                self.ages.append(time.time() - value)
+            elif key == "vision_sequence":
+                self.sequence = int(value)
+            elif key == "vision_detections":
+                self.detections = [tuple(value[i:i + 6]) for i in range(0, len(value), 6)]
+
+    def report(self):
+        with self.lock:
+            ages = sorted(self.ages)
+            age = "age p50 {:.1f} ms, max {:.1f} ms".format(ages[len(ages) // 2] * 1000, ages[-1] * 1000) \
+                if ages else "no timestamps"
+            print("sequence {}, {} detections, {}, updates {}".format(
+                self.sequence, len(self.detections), age, dict(sorted(self.updates.items()))))
+            self.updates = dict()
+            self.ages = []
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--table", help="the postprocessor's OutputTable", type=str, default="SmartDashboard")
+    parser.add_argument("--duration", help="how long to run for in seconds", type=float, default=60)
+    parser.add_argument("--shutdown_after", help="set vision_shutdown after this many seconds", type=float)
+    args = parser.parse_args()
+
+    # with no server address, NetworkTables runs as a server like the robot does
+    NetworkTables.initialize()
+    NetworkTables.addConnectionListener(
+        lambda connected, info: print(("connected: " if connected else "disconnected: ") + info.remote_ip),
+        immediateNotify=True)
+    table = NetworkTables.getTable(args.table)
+    monitor = Monitor()
+    table.addEntryListener(monitor.entry_changed)
+
+    start = time.monotonic()
+    shutdown_sent = False
+    try:
+        while time.monotonic() - start < args.duration:
+            time.sleep(1)
+            monitor.report()
+            if args.shutdown_after is not None and not shutdown_sent and \
+                    time.monotonic() - start >= args.shutdown_after:
+                print("requesting shutdown")
+                table.putBoolean("vision_shutdown", True)
+                shutdown_sent = True
+    except KeyboardInterrupt:
+        pass
+    finally:
+        NetworkTables.shutdown()
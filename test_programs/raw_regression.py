@@ -0,0 +1,86 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from base_classes import Detections  # noqa: E402
+from raw_capture import RawCaptureReader, RawCaptureWriter  # noqa: E402
+import configuration_manager  # noqa: E402
+
+""" Regression test for ContourProcessor using raw captures (see
+    raw_capture.py).
+
+    Usage:
+        python3 raw_regression.py --create <video> --capture <path> [--config_file <path>] [--frames <n>]
+        python3 raw_regression.py --capture <path> [--config_file <path>]
+
+    With `--create`, the video is decoded once and written to a raw capture
+    together with the detections ContourProcessor finds with the current
+    code and configuration. Without it, the capture is replayed through
+    ContourProcessor and every frame's detections are compared with the
+    recorded ones. The exit code is non-zero if any frame differs.
+"""
+
+
+async def load_processor(config_file: str):
+    manager = configuration_manager.ConfigurationManager(config_file)
+    return await manager.load_component("processors.contour")
+
+
+async def create(args: argparse.Namespace):
+    import cv2
+    processor = await load_processor(args.config_file)
+    cap = cv2.VideoCapture(args.create)
+    writer = RawCaptureWriter(args.capture)
+    try:
+        while args.frames is None or writer.frame_count < args.frames:
+            rval, frame = cap.read()
+            if not rval:
+                break
+            writer.write(frame, writer.frame_count + 1, time.time(), processor.process(frame))
+    finally:
+        writer.close()
+        cap.release()
+        await processor.cleanup()
+    print("wrote {} frames to {}".format(writer.frame_count, args.capture))
+
+
+async def compare(args: argparse.Namespace) -> bool:
+    processor = await load_processor(args.config_file)
+    reader = RawCaptureReader(args.capture)
+    mismatches = 0
+    start = time.perf_counter()
+    try:
+        for i in range(len(reader)):
+            expected = reader.recorded_detections(i)
+            actual = processor.process(reader.frame(i))
+            if not isinstance(actual, Detections) or not numpy.array_equal(actual.array, expected.array):
+                mismatches += 1
+                if mismatches <= 10:
+                    print("frame {}: expected {} detections, got {}".format(i, len(expected), len(actual)))
+    finally:
+        await processor.cleanup()
+    elapsed = time.perf_counter() - start
+    print("replayed {} frames in {:.2f}s ({:.0f} fps), {} differed".format(
+        len(reader), elapsed, len(reader) / elapsed if elapsed > 0 else 0, mismatches))
+    return mismatches == 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--capture", help="the raw capture to create or replay", type=str, required=True)
+    parser.add_argument("--create", help="create the capture from this video", type=str)
+    parser.add_argument("--config_file", help="use the specified config file", type=str, default="config.xml")
+    parser.add_argument("--frames", help="the largest number of frames to capture", type=int)
+    args = parser.parse_args()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    if args.create:
+        loop.run_until_complete(create(args))
+    elif not loop.run_until_complete(compare(args)):
+        sys.exit(1)
+    loop.close()
@@ -0,0 +1,76 @@
+import os
+import sys
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import configuration_manager  # noqa: E402
+from processors.contour import ContourProcessor  # noqa: E402
+
+""" Checks that reconfiguring ContourProcessor while it runs (a reload of
+    config.xml or a governor level change) keeps its RoiTracking state.
+
+    Usage: python3 reconfigure_tracking.py [--video <path>] [--config_file <path>] [--frames <n>]
+
+    A few frames of the video are processed with RoiTracking on for two
+    cameras, the processor is reconfigured with a different RoiPadding, and
+    the tracking state of both cameras must still be there (and keep being
+    updated) afterwards. The exit code is non-zero if it isn't.
+"""
+
+
+async def check(args: argparse.Namespace) -> bool:
+    import cv2
+    manager = configuration_manager.ConfigurationManager(args.config_file)
+    manager.overrides["contour"] = {"RoiTracking": "true", "Workers": "1"}
+    processor = ContourProcessor()
+    await processor.setup(manager.component_element("contour"))
+
+    cap = cv2.VideoCapture(args.video)
+    frames = [cap.read()[1] for _ in range(2 * args.frames)]
+    for frame in frames[:args.frames]:
+        processor.process(frame, "front")
+        processor.process(frame, "rear")
+    tracks, lock = processor._roi_tracks, processor._roi_lock
+    applied = {camera: track.applied for camera, track in tracks.items()}
+
+    manager.overrides["contour"]["RoiPadding"] = "50"
+    await processor.reconfigure(manager.component_element("contour"))
+    for frame in frames[args.frames:]:
+        processor.process(frame, "front")
+        processor.process(frame, "rear")
+
+    active = processor._active
+    failures = []
+    if active.roiPadding != 50:
+        failures.append("the new configuration wasn't applied")
+    if not active.roiTracking:
+        failures.append("RoiTracking was turned off")
+    if active._roi_tracks is not tracks or active._roi_lock is not lock:
+        failures.append("the tracking state or its lock was replaced")
+    if sorted(applied) != ["front", "rear"] or \
+            any(tracks[camera].applied != applied[camera] + args.frames for camera in applied):
+        failures.append("the tracks weren't kept updated: {} before, {} after".format(
+            applied, {camera: track.applied for camera, track in tracks.items()}))
+    if ContourProcessor._warned_pickled_tracking:
+        failures.append("the warning for pickled copies was logged")
+    await processor.cleanup()
+
+    for failure in failures:
+        print("FAILED: " + failure)
+    if not failures:
+        print("tracking state survived reconfiguring")
+    return not failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--video", help="the recording to process", type=str, default="test_files/test_video.mp4")
+    parser.add_argument("--config_file", help="use the specified config file", type=str, default="config.xml")
+    parser.add_argument("--frames", help="frames processed before and after reconfiguring", type=int, default=10)
+    args = parser.parse_args()
+
+    loop = asyncio.new_event_loop()
+    passed = loop.run_until_complete(check(args))
+    loop.close()
+    sys.exit(0 if passed else 1)
@@ -1,30 +1,72 @@
+import os
+import sys
+import time
 import socket
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import wire_protocol  # noqa: E402
 
 """ This file runs a simple client that connects to the SocketServer
-	Component running on the same device. It outputs all data
-	packets received. On Linux, netcat can be used instead (nc
-	localhost 5810).
+    Component and prints every message it receives. With the text protocol,
+    netcat can be used instead on Linux (nc localhost 5810).
+
+    Usage: python3 socketclient.py [--host <host>] [--port <port>] [--protocol text|binary]
+
+    The client sends the shutdown command to the server when it exits.
 """
 
 
-sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-print("connecting to localhost:5810...")
-sock.connect(('localhost', 5810))
-print("connected")
-
-try:
-	data_received = b''
-	while True:
-		data = sock.recv(16)
-		data_received += data
-		if data_received.endswith(b"\n"):
-			print("Angle: " + str(data_received))
-		data_received = b''
-except Exception as e:
-	print(e)
-	raise e
-finally:
-	print("disconnecting")
-	sock.send(b"shutdown")
-	sock.close()
+def print_text(sock: socket.socket):
+    data_received = b""
+    while True:
+        data = sock.recv(64)
+        if not data:
+            return
+        data_received += data
+        *lines, data_received = data_received.split(b"\n")
+        for line in lines:
+            # with several cameras, the angle is preceded by the camera tag
+            *camera, angle = line.decode("utf-8").split(" ")
+            print(("Camera {} angle: ".format(camera[0]) if camera else "Angle: ") + angle)
+
+
+def print_binary(sock: socket.socket):
+    while True:
+        packet = wire_protocol.read_packet(sock)
+        if packet is None:
+            return
+        now = time.time()
+        print("{}Frame {}: {} detections, {:.1f}ms old when published, {:.1f}ms old now".format(
+            "Camera {} ".format(packet.camera) if packet.camera else "", packet.sequence, len(packet.detections), (packet.publish_timestamp - packet.capture_timestamp) * 1000,
+            (now - packet.capture_timestamp) * 1000))
+        for detection in packet.detections:
+            print("    rect ({}, {}, {}, {}), angle {:.2f}, area {:.0f}".format(
+                detection.x1, detection.y1, detection.x2, detection.y2, detection.angle, detection.area))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", help="the address of the vision server", type=str, default="localhost")
+    parser.add_argument("--port", help="the port of the vision server", type=int, default=5810)
+    parser.add_argument("--protocol", help="the protocol the server is configured to use", type=str,
+                        choices=["text", "binary"], default="text")
+    args = parser.parse_args()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    print("connecting to {}:{}...".format(args.host, args.port))
+    sock.connect((args.host, args.port))
+    print("connected")
 
+    try:
+        if args.protocol == "binary":
+            print_binary(sock)
+        else:
+            print_text(sock)
+    finally:
+        print("disconnecting")
+        try:
+            sock.sendall(b"shutdown\n")
+        except OSError:
+            pass
+        sock.close()
@@ -0,0 +1,117 @@
+import os
+import sys
+import time
+import socket
+import asyncio
+import ipaddress
+import argparse
+import threading
+import numpy
+import xml.etree.ElementTree as ElementTree
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from base_classes import Detections  # noqa: E402
+from postprocessors.udp import UdpPostProcessor  # noqa: E402
+import wire_protocol  # noqa: E402
+
+""" Loopback test harness for the udp postprocessor. A receiver on this device
+    listens on a unicast or multicast address while the postprocessor publishes
+    synthetic results at a fixed rate, optionally with other threads keeping
+    the CPU busy. It reports the one-way latency (receive time minus publish
+    time, both taken from this device's clock), lost and out-of-order
+    datagrams, and how many sends the postprocessor dropped.
+
+    Usage: python3 udp_loopback.py [--target <host:port>] [--rate <fps>] [--duration <seconds>]
+                                   [--detections <n>] [--load_threads <n>]
+"""
+
+
+class Receiver(threading.Thread):
+    def __init__(self, host: str, port: int):
+        super().__init__(daemon=True)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("", port))
+        if ipaddress.ip_address(socket.gethostbyname(host)).is_multicast:
+            membership = socket.inet_aton(host) + socket.inet_aton("0.0.0.0")
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        self.sock.settimeout(0.5)
+        self.latencies = []
+        self.sequences = []
+        self.running = True
+
+    def run(self):
+        while self.running:
+            try:
+                datagram = self.sock.recv(65536)
+            except socket.timeout:
+                continue
+            received = time.time()
+            packet = wire_protocol.decode_packet(datagram)
+            self.latencies.append(received - packet.publish_timestamp)
+            self.sequences.append(packet.sequence)
+
+
+def burn_cpu(stop: threading.Event):
+    values = numpy.random.random((256, 256))
+    while not stop.is_set():
+        values = numpy.sqrt(values + 1.0) * 0.5
+
+
+async def publish(postprocessor: UdpPostProcessor, rate: float, duration: float, count: int) -> int:
+    rng = numpy.random.default_rng(1777)
+    frame = numpy.zeros((1, 1, 3), numpy.uint8)
+    interval = 1 / rate
+    sent = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        corners = rng.integers(0, 600, (count, 2))
+        detections = Detections.from_rects(numpy.hstack((corners, corners + 20)))
+        sent += 1
+        detections.frame_sequence = sent
+        detections.frame_timestamp = time.time()
+        await postprocessor.postprocess(detections, frame)
+        await asyncio.sleep(max(0.0, start + sent * interval - time.perf_counter()))
+    return sent
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target", help="the address to publish to", type=str, default="127.0.0.1:5805")
+    parser.add_argument("--rate", help="datagrams per second", type=float, default=200)
+    parser.add_argument("--duration", help="seconds to publish for", type=float, default=5)
+    parser.add_argument("--detections", help="detections per datagram", type=int, default=5)
+    parser.add_argument("--load_threads", help="threads keeping the CPU busy while publishing", type=int, default=0)
+    args = parser.parse_args()
+
+    host, port = args.target.rsplit(":", 1)
+    receiver = Receiver(host, int(port))
+    receiver.start()
+
+    stop_load = threading.Event()
+    load_threads = [threading.Thread(target=burn_cpu, args=(stop_load,), daemon=True)
+                    for _ in range(args.load_threads)]
+    for thread in load_threads:
+        thread.start()
+
+    config = ElementTree.fromstring("<Component><Target>{}</Target></Component>".format(args.target))
+    udp = UdpPostProcessor()
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(udp.setup(config))
+    sent = loop.run_until_complete(publish(udp, args.rate, args.duration, args.detections))
+    time.sleep(0.5)
+    receiver.running = False
+    stop_load.set()
+    receiver.join()
+    loop.run_until_complete(udp.cleanup())
+    loop.close()
+
+    sequences = numpy.array(receiver.sequences)
+    latencies = numpy.array(receiver.latencies) * 1000
+    received = len(numpy.unique(sequences))
+    out_of_order = int(numpy.sum(numpy.diff(sequences) <= 0)) if len(sequences) > 1 else 0
+    print("sent {}, received {}, lost {} ({:.2%}), out of order {}, dropped by sender {}".format(
+        sent, received, sent - received, (sent - received) / max(sent, 1), out_of_order, udp.dropped_datagrams))
+    if len(latencies) > 0:
+        print("one-way latency: mean {:.3f}ms, p50 {:.3f}ms, p99 {:.3f}ms, max {:.3f}ms".format(
+            latencies.mean(), *numpy.percentile(latencies, (50, 99)), latencies.max()))
@@ -0,0 +1,325 @@
+from typing import Any, Dict, List, NoReturn, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import xml.etree.ElementTree as ElementTree
+import multiprocessing
+import argparse
+import itertools
+import random
+import json
+import copy
+import time
+import os
+import re
+import numpy
+import cv2
+
+from processors.contour import ContourProcessor
+
+""" Searches for the `contour` processor settings that best find a few
+    labelled targets in a recording, using every core.
+
+    Usage: python3 tune.py --labels <path> [--video <path>] [--config_file <path>] [--space <path>]
+                           [--search grid|random] [--trials <n>] [--seed <n>] [--workers <n>] [--iou <fraction>]
+                           [--top <n>] [--output <path>] [--write_config <path>]
+
+    `--labels` is a JSON file mapping frame numbers (counting from 0) to the
+    targets in that frame, each as an `[x1, y1, x2, y2]` box in full
+    resolution pixels. Frames with an empty list should contain no targets.
+    Only labelled frames are evaluated, e.g.
+
+        {"0": [[412, 180, 530, 305]], "40": [], "80": [[380, 170, 510, 300], [700, 175, 820, 300]]}
+
+    `--space` is a JSON file mapping `contour` settings to the values to try
+    (see DEFAULT_SPACE). Settings it doesn't list keep their value from the
+    config file. `grid` search tries every combination; `random` search tries
+    `--trials` of them.
+
+    Every labelled frame is decoded once. For each `DownscaleFactor` in the
+    search, the frames are downscaled, blurred and converted to HLS once, and
+    the results are shared with the worker processes through shared memory.
+    Trials with that factor are grouped by their color ranges: each group's
+    masks and contours are computed once, and only the size limits and
+    non-maximum suppression are run for each trial in it.
+
+    Trials are ranked by F1 score (a detection matches a label if their
+    intersection over union is at least `--iou`), then by per-frame cost. The
+    cost adds up the time of each step the trial's configuration would run on
+    its own, measured while all workers are busy, so costs are comparable with
+    each other rather than with the main loop. Trials always use the `hls`
+    color classifier (`lut` gives the same masks up to its quantization) and
+    don't refine rects at full resolution.
+
+    The best configuration is printed as a `<Component name="contour">` block.
+    `--write_config` replaces the block in that config file with it.
+"""
+
+DEFAULT_SPACE = {
+    "HueRange": ["20-60", "25-60", "30-60", "25-70"],
+    "LuminanceRange": ["70-250", "90-250", "110-250"],
+    "SaturationRange": ["10-250", "25-250", "50-250"],
+    "WidthRange": ["50-400", "100-400"],
+    "HeightRange": ["50-400", "100-400"],
+    "AreaRange": ["2000-160000", "4000-160000"],
+    "OverlapThreshold": ["0.3", "0.5"],
+}
+# settings that change the frames before the color mask; trials that share them share the prepared frames
+FRAME_SETTINGS = ("DownscaleFactor",)
+# settings that change the color mask; trials that share them (and the frames) share everything up to the contours
+COLOR_SETTINGS = ("HueRange", "LuminanceRange", "SaturationRange")
+
+# set up in each worker process by _init_worker()
+_worker = dict()  # type: Dict[str, Any]
+
+
+def load_labels(file_name: str) -> Dict[int, numpy.ndarray]:
+    with open(file_name) as labels_file:
+        labels = json.load(labels_file)
+    return {int(frame): numpy.array(boxes, dtype=numpy.int64).reshape(-1, 4) for frame, boxes in labels.items()}
+
+
+def make_trials(space: Dict[str, List[str]], search: str, trials: int, seed: int) -> List[Dict[str, str]]:
+    names = sorted(space)
+    combinations = [dict(zip(names, values)) for values in itertools.product(*(space[name] for name in names))]
+    if search == "random" and trials < len(combinations):
+        combinations = random.Random(seed).sample(combinations, trials)
+    return combinations
+
+
+def configured_element(base: ElementTree.Element, settings: Dict[str, str]) -> ElementTree.Element:
+    element = copy.deepcopy(base)
+    element.tail = None
+    for name, value in settings.items():
+        setting = element.find(name)
+        if setting is None:
+            setting = ElementTree.SubElement(element, name)
+        setting.text = value
+    return element
+
+
+def score(detected: List[numpy.ndarray], labels: List[numpy.ndarray], iou_threshold: float) -> Dict[str, float]:
+    """ Matches detections to labels greedily, from the pair with the highest intersection over union down, and
+        returns the precision, recall, F1 score and mean IoU of the matches.
+    """
+    true_positives = false_positives = false_negatives = 0
+    matched_ious = []
+    for rects, boxes in zip(detected, labels):
+        if len(rects) > 0 and len(boxes) > 0:
+            rects = rects.astype(numpy.float64)
+            boxes = boxes.astype(numpy.float64)
+            x1, y1, x2, y2 = (rects[:, None, i] for i in range(4))
+            w = numpy.minimum(x2, boxes[None, :, 2]) - numpy.maximum(x1, boxes[None, :, 0])
+            h = numpy.minimum(y2, boxes[None, :, 3]) - numpy.maximum(y1, boxes[None, :, 1])
+            intersection = numpy.maximum(0, w) * numpy.maximum(0, h)
+            rect_areas = (rects[:, 2] - rects[:, 0]) * (rects[:, 3] - rects[:, 1])
+            box_areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+            ious = intersection / (rect_areas[:, None] + box_areas[None, :] - intersection)
+            matches = 0
+            while ious.size > 0 and ious.max() >= iou_threshold:
+                i, j = numpy.unravel_index(ious.argmax(), ious.shape)
+                matched_ious.append(float(ious[i, j]))
+                ious[i, :] = -1
+                ious[:, j] = -1
+                matches += 1
+        else:
+            matches = 0
+        true_positives += matches
+        false_positives += len(rects) - matches
+        false_negatives += len(boxes) - matches
+
+    precision = true_positives / (true_positives + false_positives) if true_positives + false_positives else 1.0
+    recall = true_positives / (true_positives + false_negatives) if true_positives + false_negatives else 1.0
+    return {
+        "f1": 2 * precision * recall / (precision + recall) if precision + recall else 0.0,
+        "precision": precision,
+        "recall": recall,
+        "mean_iou": float(numpy.mean(matched_ious)) if matched_ious else 0.0,
+    }
+
+
+def _init_worker(memory_name: str, shape: Tuple[int, ...], base_xml: str, labels: List[numpy.ndarray],
+                 iou_threshold: float):
+    memory = shared_memory.SharedMemory(name=memory_name)
+    _worker.update(memory=memory, frames=numpy.ndarray(shape, numpy.uint8, buffer=memory.buf),
+                   base=ElementTree.fromstring(base_xml), labels=labels, iou_threshold=iou_threshold)
+
+
+def evaluate_group(trials: List[Dict[str, str]]) -> List[Dict[str, Any]]:
+    """ Runs trials that share their color ranges over every shared frame. Returns each trial's score and the time
+        its steps took per frame, in milliseconds.
+    """
+    processors = []
+    for settings in trials:
+        processor = ContourProcessor()
+        processor.load_config(configured_element(_worker["base"], settings))
+        processors.append(processor)
+    first = processors[0]
+    scale = first.downscaleFactor
+    frames = _worker["frames"]
+    low = (first.hueRange[0], first.luminanceRange[0], first.saturationRange[0])
+    high = (first.hueRange[1], first.luminanceRange[1], first.saturationRange[1])
+
+    start = time.perf_counter()
+    objects = []
+    for hls in frames:
+        objects.append(first.find_objects(first.open_mask(cv2.inRange(hls, low, high), scale)))
+    group_time = time.perf_counter() - start
+
+    results = []
+    for settings, processor in zip(trials, processors):
+        start = time.perf_counter()
+        detected = []
+        for rects, areas in objects:
+            rects = rects[processor.filter_mask(rects, areas, scale)] * scale
+            detected.append(rects[processor.non_max_suppression_pick(rects, processor.overlapThreshold)])
+        trial_time = time.perf_counter() - start
+        result = {"settings": settings, "cost_ms": (group_time + trial_time) / len(frames) * 1000}
+        result.update(score(detected, _worker["labels"], _worker["iou_threshold"]))
+        results.append(result)
+    return results
+
+
+class Tuner:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.config_root = ElementTree.parse(args.config_file).getroot()
+        self.base = None  # type: ElementTree.Element
+        for element in self.config_root.find("ComponentData").findall("Component"):
+            if element.attrib.get("name") == "contour":
+                self.base = copy.deepcopy(element)
+        if self.base is None:
+            raise ValueError("No configuration for component contour in " + args.config_file)
+        # every trial process configures its own processors; lookup tables and worker pools would only slow that down
+        self.base = configured_element(self.base, {"ColorClassifier": "hls", "Workers": "1",
+                                                   "RefineAtFullResolution": "false"})
+
+        self.space = dict(DEFAULT_SPACE)
+        if args.space:
+            with open(args.space) as space_file:
+                self.space = json.load(space_file)
+        self.labels = load_labels(args.labels)
+
+    def decode_frames(self) -> Tuple[List[numpy.ndarray], List[numpy.ndarray]]:
+        """ Decodes the labelled frames. Returns them and their labels in the same order.
+        """
+        wanted = sorted(self.labels)
+        cap = cv2.VideoCapture(self.args.video)
+        frames, labels = [], []
+        try:
+            for index in range(wanted[-1] + 1):
+                rval, frame = cap.read()
+                if not rval:
+                    break
+                if index in self.labels:
+                    frames.append(frame)
+                    labels.append(self.labels[index])
+        finally:
+            cap.release()
+        if len(frames) < len(wanted):
+            raise ValueError("{} ends after frame {}, but frame {} is labelled".format(
+                self.args.video, index - 1, wanted[-1]))
+        return frames, labels
+
+    def prepare_frames(self, frames: List[numpy.ndarray], settings: Dict[str, str]) -> Tuple[numpy.ndarray, float]:
+        """ Runs the steps every trial with the given frame settings (see FRAME_SETTINGS) shares on the decoded
+            frames: downscaling, blurring and the HLS conversion. Returns the HLS images and the time these steps took
+            per frame, in milliseconds.
+        """
+        processor = ContourProcessor()
+        processor.load_config(configured_element(self.base, dict(settings, BufferPool="false")))
+        scale = processor.downscaleFactor
+        images = []
+        start = time.perf_counter()
+        for frame in frames:
+            if scale > 1:
+                frame = cv2.resize(frame, (frame.shape[1] // scale, frame.shape[0] // scale),
+                                   interpolation=cv2.INTER_AREA)
+            images.append(cv2.cvtColor(processor.blur(frame, scale), cv2.COLOR_BGR2HLS))
+        return numpy.stack(images), (time.perf_counter() - start) / len(frames) * 1000
+
+    def run(self) -> List[Dict[str, Any]]:
+        frames, labels = self.decode_frames()
+        trials = make_trials(self.space, self.args.search, self.args.trials, self.args.seed)
+        batches = dict()  # type: Dict[Tuple[str, ...], Dict[Tuple[str, ...], List[Dict[str, str]]]]
+        for settings in trials:
+            frame_key = tuple(settings.get(name, "") for name in FRAME_SETTINGS)
+            color_key = tuple(settings.get(name, "") for name in COLOR_SETTINGS)
+            batches.setdefault(frame_key, dict()).setdefault(color_key, []).append(settings)
+        print("{} trials in {} color groups over {} labelled frames on {} workers".format(
+            len(trials), sum(len(groups) for groups in batches.values()), len(frames), self.args.workers))
+
+        base_xml = ElementTree.tostring(self.base, encoding="unicode")
+        results = []
+        start = time.perf_counter()
+        for frame_key, groups in batches.items():
+            frame_settings = {name: value for name, value in zip(FRAME_SETTINGS, frame_key) if value}
+            images, shared_ms = self.prepare_frames(frames, frame_settings)
+            memory = shared_memory.SharedMemory(create=True, size=images.nbytes)
+            try:
+                numpy.ndarray(images.shape, numpy.uint8, buffer=memory.buf)[...] = images
+                with ProcessPoolExecutor(self.args.workers, multiprocessing.get_context("spawn"), _init_worker,
+                                         (memory.name, images.shape, base_xml, labels, self.args.iou)) as executor:
+                    batch = [result for group in executor.map(evaluate_group, groups.values()) for result in group]
+            finally:
+                memory.close()
+                memory.unlink()
+            for result in batch:
+                result["cost_ms"] += shared_ms
+            results.extend(batch)
+        print("searched in {:.1f}s".format(time.perf_counter() - start))
+
+        results.sort(key=lambda result: (-result["f1"], result["cost_ms"]))
+        return results
+
+    def component_block(self, settings: Dict[str, str]) -> str:
+        original = None
+        for element in self.config_root.find("ComponentData").findall("Component"):
+            if element.attrib.get("name") == "contour":
+                original = element
+        return ElementTree.tostring(configured_element(original, settings), encoding="unicode")
+
+
+def write_config(file_name: str, block: str) -> NoReturn:
+    with open(file_name) as config_file:
+        text = config_file.read()
+    text, replaced = re.subn(r'<Component name="contour">.*?</Component>', lambda _: block, text, count=1,
+                             flags=re.DOTALL)
+    if replaced == 0:
+        raise ValueError("No contour Component tag in " + file_name)
+    with open(file_name, "w") as config_file:
+        config_file.write(text)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--labels", help="the labelled targets (see above)", type=str, required=True)
+    parser.add_argument("--video", help="the recording to tune against", type=str,
+                        default="test_files/test_video.mp4")
+    parser.add_argument("--config_file", help="read the other contour settings from this file", type=str,
+                        default="config.xml")
+    parser.add_argument("--space", help="the settings and values to search", type=str)
+    parser.add_argument("--search", help="grid or random", choices=["grid", "random"], default="grid")
+    parser.add_argument("--trials", help="the number of random trials", type=int, default=200)
+    parser.add_argument("--seed", help="the random search seed", type=int, default=0)
+    parser.add_argument("--workers", help="the number of worker processes", type=int, default=os.cpu_count())
+    parser.add_argument("--iou", help="the intersection over union a match needs", type=float, default=0.5)
+    parser.add_argument("--top", help="the number of trials to print", type=int, default=10)
+    parser.add_argument("--output", help="write every trial's results as JSON to this file", type=str)
+    parser.add_argument("--write_config", help="replace the contour settings in this config file", type=str)
+    args = parser.parse_args()
+
+    tuner = Tuner(args)
+    results = tuner.run()
+    for rank, result in enumerate(results[:args.top], 1):
+        print("{:3d}. f1 {:.3f} (precision {:.3f}, recall {:.3f}, iou {:.3f}) {:.2f} ms/frame  {}".format(
+            rank, result["f1"], result["precision"], result["recall"], result["mean_iou"], result["cost_ms"],
+            " ".join("{}={}".format(name, value) for name, value in sorted(result["settings"].items()))))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+
+    block = tuner.component_block(results[0]["settings"])
+    print(block)
+    if args.write_config:
+        write_config(args.write_config, block)
+        print("wrote the best settings to " + args.write_config)
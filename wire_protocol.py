@@ -0,0 +1,162 @@
+from typing import Any, List, NamedTuple, Optional, Union
+import socket
+import struct
+import numpy
+
+""" The binary wire protocol used by the socketserver postprocessor when its
+    `Protocol` is set to `binary`, plus a decoder for clients.
+
+    Every packet describes one processed frame. All values are little-endian.
+
+    | Offset | Type       | Field                                              |
+    |--------|------------|----------------------------------------------------|
+    | 0      | uint32     | length of the rest of the packet in bytes          |
+    | 4      | uint8      | protocol version (currently 2)                     |
+    | 5      | uint8      | flags (reserved, always 0)                         |
+    | 6      | uint16     | detection count (N)                                |
+    | 8      | uint32     | frame sequence number (wraps around at 2^32)       |
+    | 12     | float64    | capture time (Unix time in seconds)                |
+    | 20     | float64    | publish time (Unix time in seconds)                |
+    | 28     | uint8      | camera tag length in bytes (C)                     |
+    | 29     | C bytes    | camera tag (UTF-8), empty with a single camera     |
+    | 29 + C | N records  | one 16 byte record per detection, see below        |
+
+    Sequence numbers are counted for each camera separately, so with several
+    cameras, clients should compare them per camera tag.
+
+    Detection record:
+
+    | Offset | Type       | Field                                              |
+    |--------|------------|----------------------------------------------------|
+    | 0      | int16 * 4  | rect as x1, y1, x2, y2 (pixels)                    |
+    | 8      | float32    | angle (degrees, positive is left of center)        |
+    | 12     | float32    | area (pixels)                                      |
+
+    Clients can use decode_packet(), PacketReader or read_packet() to decode
+    packets (see test_programs/socketclient.py).
+"""
+
+VERSION = 2
+HEADER = struct.Struct("<IBBHIddB")
+DETECTION = struct.Struct("<4hff")
+LENGTH = struct.Struct("<I")
+MAX_DETECTIONS = 0xFFFF
+MAX_CAMERA_LENGTH = 0xFF
+
+WIRE_DETECTION_DTYPE = numpy.dtype([
+    ("rect", "<i2", (4,)),
+    ("angle", "<f4"),
+    ("area", "<f4"),
+])
+
+
+class WireDetection(NamedTuple):
+    x1: int
+    y1: int
+    x2: int
+    y2: int
+    angle: float
+    area: float
+
+
+class Packet(NamedTuple):
+    sequence: int
+    capture_timestamp: float
+    publish_timestamp: float
+    detections: List[WireDetection]
+    camera: str = ""
+
+
+def encode_packet(data: Any, sequence: int, capture_timestamp: float, publish_timestamp: float,
+                  camera: str = "") -> bytes:
+    """ Encodes a processor's output for one frame as a packet.
+
+        Arguments:
+        - data: A Detections batch or a list of FrameData objects. Only the
+          first 65535 objects are sent.
+        - sequence: The frame's sequence number.
+        - capture_timestamp: The wall-clock time the frame was captured at.
+        - publish_timestamp: The wall-clock time the packet is sent at.
+        - camera: The tag of the camera that captured the frame (see
+          Detections.camera). Only its first 255 bytes are sent.
+    """
+    count = min(len(data), MAX_DETECTIONS)
+    records = numpy.empty(count, WIRE_DETECTION_DTYPE)
+    if hasattr(data, "array"):
+        # Detections: copy whole columns at once
+        array = data.array[:count]
+        records["rect"] = numpy.clip(array["rect"], -0x8000, 0x7FFF)
+        records["angle"] = array["angle"]
+        records["area"] = array["area"]
+    else:
+        for i, item in enumerate(data[:count]):
+            rect = numpy.clip(item.rect, -0x8000, 0x7FFF)
+            records[i] = (rect, item.angle, getattr(item, "area", (rect[2] - rect[0]) * (rect[3] - rect[1])))
+    camera_bytes = camera.encode("utf-8")[:MAX_CAMERA_LENGTH]
+    return HEADER.pack(HEADER.size - LENGTH.size + len(camera_bytes) + records.nbytes, VERSION, 0, count,
+                       sequence & 0xFFFFFFFF, capture_timestamp, publish_timestamp, len(camera_bytes)) + \
+        camera_bytes + records.tobytes()
+
+
+def decode_packet(packet: Union[bytes, bytearray, memoryview]) -> Packet:
+    """ Decodes a single complete packet, including its length prefix.
+    """
+    length, version, _, count, sequence, capture_timestamp, publish_timestamp, camera_length = \
+        HEADER.unpack_from(packet)
+    if version != VERSION:
+        raise ValueError("Unsupported protocol version " + str(version))
+    camera_end = HEADER.size + camera_length
+    end = camera_end + count * DETECTION.size
+    if length + LENGTH.size != end or len(packet) < end:
+        raise ValueError("Malformed packet")
+    camera = bytes(packet[HEADER.size:camera_end]).decode("utf-8", "replace")
+    detections = [WireDetection(*i) for i in DETECTION.iter_unpack(packet[camera_end:end])]
+    return Packet(sequence, capture_timestamp, publish_timestamp, detections, camera)
+
+
+class PacketReader:
+    """ Splits a stream of bytes (e.g. from a non-blocking socket) into
+        packets. Bytes can be fed in chunks of any size.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> List[Packet]:
+        """ Adds received bytes and returns every packet they complete.
+        """
+        self.buffer += data
+        packets = []
+        offset = 0
+        while len(self.buffer) - offset >= LENGTH.size:
+            end = offset + LENGTH.size + LENGTH.unpack_from(self.buffer, offset)[0]
+            if len(self.buffer) < end:
+                break
+            packets.append(decode_packet(bytes(self.buffer[offset:end])))
+            offset = end
+        del self.buffer[:offset]
+        return packets
+
+
+def read_packet(sock: socket.socket) -> Optional[Packet]:
+    """ Reads the next packet from a blocking socket. Returns None if the
+        server closed the connection.
+    """
+    header = _receive_exactly(sock, LENGTH.size)
+    if header is None:
+        return None
+    body = _receive_exactly(sock, LENGTH.unpack(header)[0])
+    if body is None:
+        return None
+    return decode_packet(header + body)
+
+
+def _receive_exactly(sock: socket.socket, size: int) -> Optional[bytes]:
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            return None
+        received += count
+    return bytes(buffer)